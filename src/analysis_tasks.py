@@ -4,6 +4,8 @@
 """
 
 import json
+from multiprocessing import Pool
+import os
 import os.path as osp
 from datetime import datetime
 
@@ -18,25 +20,41 @@ from sklearn.decomposition import PCA
 from sklearn.cluster import KMeans
 from sklearn.metrics import silhouette_score
 
+import changesets
 import data_preparation_tasks
 from extract_user_editor import editor_count, get_top_editor, editor_name
+import normalization
+import osmparsing
 import tagmetanalyse
 import unsupervised_learning as ul
 import utils
 
 OUTPUT_DIR = 'output-extracts'
 
+def approximation_error(task):
+    """Relative standard error of the approximate distinct counts of a Luigi
+    task, None if its 'error' parameter is 0 (exact counts)
+    """
+    return task.error if task.error > 0 else None
+
 ### OSM Evolution through time ####################################
 class OSMChronology(luigi.Task):
     """ Luigi task: evaluation of OSM element historical evolution
+
+    The statistics are evaluated at every 'freq' period (pandas offset alias)
+    between 'start_date' and 'end_date'.
     """
     datarep = luigi.Parameter("data")
     dsname = luigi.Parameter("bordeaux-metropole")
     start_date = luigi.Parameter('2006-01-01')
     end_date = luigi.Parameter('2017-01-01')
+    freq = luigi.Parameter('1M')
 
     def outputpath(self):
-        return osp.join(self.datarep, OUTPUT_DIR, self.dsname, "chronology.csv")
+        fname = "chronology.csv"
+        if self.freq != '1M':
+            fname = "chronology-" + self.freq + ".csv"
+        return osp.join(self.datarep, OUTPUT_DIR, self.dsname, fname)
 
     def output(self):
         return luigi.LocalTarget(self.outputpath())
@@ -45,22 +63,29 @@ class OSMChronology(luigi.Task):
         return data_preparation_tasks.OSMHistoryParsing(self.datarep, self.dsname)
 
     def run(self):
-        with self.input().open('r') as inputflow:
-            osm_elements = pd.read_csv(inputflow,
-                                       index_col=0,
-                                       parse_dates=['ts'])
+        osm_elements = data_preparation_tasks.read_elements(
+            self.input().path)
         osm_stats = utils.osm_chronology(osm_elements,
                                          self.start_date,
-                                         self.end_date)
+                                         self.end_date,
+                                         self.freq)
         with self.output().open('w') as outputflow:
             osm_stats.to_csv(outputflow, date_format='%Y-%m-%d %H:%M:%S')
 
 ### OSM tag genome analysis ####################################
 class OSMTagCount(luigi.Task):
     """ Luigi task: OSM tag count
+
+    If 'streaming' is set, the count comes from the tag cube aggregated while
+    parsing the OSM history, instead of the tag genome. If 'error' is strictly
+    positive, the numbers of unique elements of the tag genome are
+    approximated with sketches of this relative standard error (see
+    tagmetanalyse.group_aggregate).
     """
     datarep = luigi.Parameter("data")
     dsname = luigi.Parameter("bordeaux-metropole")
+    streaming = luigi.BoolParameter(default=False)
+    error = luigi.FloatParameter(default=0.)
 
     def outputpath(self):
         return osp.join(self.datarep, OUTPUT_DIR, self.dsname, "tagcount.csv")
@@ -69,24 +94,34 @@ class OSMTagCount(luigi.Task):
         return luigi.LocalTarget(self.outputpath())
 
     def requires(self):
-        return data_preparation_tasks.OSMTagParsing(self.datarep, self.dsname)
+        if self.streaming:
+            return OSMTagCube(self.datarep, self.dsname, streaming=True,
+                              error=self.error)
+        return data_preparation_tasks.OSMEncodedTagParsing(self.datarep,
+                                                           self.dsname)
 
     def run(self):
-        with self.input().open('r') as inputflow:
-            tag_genome = pd.read_csv(inputflow, index_col=0)
-
-        tagcount = (tag_genome.groupby('elem')['tagkey']
-                    .nunique()
-                    .reset_index())
+        if self.streaming:
+            tagcount = (tagmetanalyse.TagCube(self.input().path).tag_count()
+                        .reset_index())
+        else:
+            tag_genome = osmparsing.load_encoded_genome(self.input().path)
+            tagcount = (tagmetanalyse.group_aggregate(
+                tag_genome, ['elem'], 'tagkey',
+                error=approximation_error(self)).reset_index())
 
         with self.output().open('w') as outputflow:
             tagcount.to_csv(outputflow, date_format='%Y-%m-%d %H:%M:%S')
 
 class OSMTagKeyCount(luigi.Task):
     """ Luigi task: OSM tag key count
+
+    If 'streaming' is set, the count comes from the tag cube aggregated while
+    parsing the OSM history, instead of the tag genome.
     """
     datarep = luigi.Parameter("data")
     dsname = luigi.Parameter("bordeaux-metropole")
+    streaming = luigi.BoolParameter(default=False)
 
     def outputpath(self):
         return osp.join(self.datarep, OUTPUT_DIR, self.dsname, "tagkey-count.csv")
@@ -95,17 +130,23 @@ class OSMTagKeyCount(luigi.Task):
         return luigi.LocalTarget(self.outputpath())
 
     def requires(self):
-        return data_preparation_tasks.OSMTagParsing(self.datarep, self.dsname)
+        if self.streaming:
+            return OSMTagCube(self.datarep, self.dsname, streaming=True)
+        return data_preparation_tasks.OSMEncodedTagParsing(self.datarep,
+                                                           self.dsname)
 
     def run(self):
-        with self.input().open('r') as inputflow:
-            tag_genome = pd.read_csv(inputflow, index_col=0)
-
         # List of tag keys and number of elements they are associated with
-        tagkeycount = (tag_genome.groupby(['tagkey','elem'])['elem']
-                       .count()
-                       .unstack()
-                       .fillna(0))
+        if self.streaming:
+            tagkeycount = tagmetanalyse.TagCube(
+                self.input().path).tagkey_count()
+        else:
+            tag_genome = osmparsing.load_encoded_genome(self.input().path)
+            tagkeycount = (tagmetanalyse.group_aggregate(tag_genome,
+                                                         ['tagkey', 'elem'],
+                                                         'elem', 'count')
+                           .unstack()
+                           .fillna(0))
         tagkeycount['elem'] = tagkeycount.apply(sum, axis=1)
         tagkeycount = tagkeycount.sort_values('elem', ascending=False)
 
@@ -113,11 +154,75 @@ class OSMTagKeyCount(luigi.Task):
             tagkeycount.to_csv(outputflow,
                                date_format='%Y-%m-%d %H:%M:%S')
 
+class OSMTagCube(luigi.Task):
+    """ Luigi task: aggregation of the numbers of unique elements of the tag
+    genome, for every tag key (see tagmetanalyse.TagCube)
+
+    If 'streaming' is set, the cube is aggregated while parsing the OSM
+    history file, without extracting the tag genome; only the 'topk' most
+    frequent values of each tag key are then kept (see
+    osmparsing.TagStatisticsHandler). Otherwise, if 'error' is strictly
+    positive, numbers of unique elements are approximated with sketches of
+    this relative standard error (see tagmetanalyse.TagCube.build); streaming
+    counts are exact, and exclusive with 'error'.
+    """
+    datarep = luigi.Parameter("data")
+    dsname = luigi.Parameter("bordeaux-metropole")
+    streaming = luigi.BoolParameter(default=False)
+    topk = luigi.IntParameter(default=1000)
+    error = luigi.FloatParameter(default=0.)
+
+    def outputpath(self):
+        fname = "tag-cube.h5"
+        if self.streaming:
+            fname = "tag-cube-streaming.h5"
+        return osp.join(self.datarep, OUTPUT_DIR, self.dsname, fname)
+
+    def output(self):
+        return luigi.LocalTarget(self.outputpath(), format=MixedUnicodeBytes)
+
+    def requires(self):
+        if self.streaming:
+            if self.error > 0:
+                raise ValueError("Streaming tag cubes are exact; they cannot "
+                                 "be approximated (error={})"
+                                 .format(self.error))
+            return
+        return {'history': data_preparation_tasks.OSMHistoryParsing(self.datarep,
+                                                                  self.dsname),
+                'taggenome': data_preparation_tasks.OSMEncodedTagParsing(
+                    self.datarep, self.dsname)}
+
+    def run(self):
+        tmppath = self.outputpath() + "-tmp"
+        if self.streaming:
+            datapath = osp.join(self.datarep, "raw", self.dsname + ".osh.pbf")
+            handler = osmparsing.TagStatisticsHandler(self.topk)
+            handler.apply_file(datapath)
+            self.output().makedirs()
+            tagmetanalyse.TagCube.from_statistics(handler.to_dataframes(),
+                                                  tmppath)
+            os.replace(tmppath, self.outputpath())
+            return
+        osm_elements = data_preparation_tasks.read_elements(
+            self.input()['history'].path)
+        tag_genome = osmparsing.load_encoded_genome(
+            self.input()['taggenome'].path)
+        tagmetanalyse.TagCube.build(tag_genome, tmppath, osm_elements,
+                                    approximation_error(self))
+        os.replace(tmppath, self.outputpath())
+
 class OSMTagFreq(luigi.Task):
     """ Luigi task: analyse of tag key frequency (amongst all elements)
+
+    If 'streaming' is set, the analysis comes from the tag cube aggregated
+    while parsing the OSM history, otherwise from a tag cube approximated with
+    relative standard error 'error' if strictly positive (see OSMTagCube).
     """
     datarep = luigi.Parameter("data")
     dsname = luigi.Parameter("bordeaux-metropole")
+    streaming = luigi.BoolParameter(default=False)
+    error = luigi.FloatParameter(default=0.)
 
     def outputpath(self):
         return osp.join(self.datarep, OUTPUT_DIR, self.dsname, "tag-freq.csv")
@@ -126,126 +231,437 @@ class OSMTagFreq(luigi.Task):
         return luigi.LocalTarget(self.outputpath())
 
     def requires(self):
-        return {'history': data_preparation_tasks.OSMHistoryParsing(self.datarep,
-                                                                  self.dsname),
-                'taggenome': data_preparation_tasks.OSMTagParsing(self.datarep,
-                                                                self.dsname)}
+        return OSMTagCube(self.datarep, self.dsname, streaming=self.streaming,
+                          error=self.error)
 
     def run(self):
-        with self.input()['history'].open('r') as inputflow:
-            osm_elements = pd.read_csv(inputflow, index_col=0)
-        with self.input()['taggenome'].open('r') as inputflow:
-            tag_genome = pd.read_csv(inputflow, index_col=0)
-        fulltaganalys = pd.merge(osm_elements[['elem', 'id', 'version']],
-                                 tag_genome,
-                                 on=['elem','id','version'],
-                                 how="outer")
-        tagfreq = tagmetanalyse.tag_frequency(fulltaganalys,
-                                              ['elem','version'])
+        tag_cube = tagmetanalyse.TagCube(self.input().path)
+        tagfreq = tag_cube.tag_frequency(['elem','version'])
         with self.output().open('w') as outputflow:
             tagfreq.to_csv(outputflow, date_format='%Y-%m-%d %H:%M:%S')
 
 class OSMTagValue(luigi.Task):
-    """ Luigi task: analyse of tag value frequency (among all tagged elements)
+    """ Luigi task: analyse of tag value frequency (among all tagged elements),
+    with a specific tag key (e.g. 'highway')
+
+    If 'streaming' is set, the analysis comes from the tag cube aggregated
+    while parsing the OSM history, otherwise from a tag cube approximated with
+    relative standard error 'error' if strictly positive (see OSMTagCube).
     """
     datarep = luigi.Parameter("data")
     dsname = luigi.Parameter("bordeaux-metropole")
+    streaming = luigi.BoolParameter(default=False)
+    error = luigi.FloatParameter(default=0.)
+    tagkey = luigi.Parameter("highway")
 
     def outputpath(self):
-        return osp.join(self.datarep, OUTPUT_DIR, self.dsname, "tag-value.csv")
+        fname = "tag-value.csv"
+        if self.tagkey != 'highway':
+            fname = "tag-value-" + self.tagkey + ".csv"
+        return osp.join(self.datarep, OUTPUT_DIR, self.dsname, fname)
 
     def output(self):
         return luigi.LocalTarget(self.outputpath())
 
     def requires(self):
-        return data_preparation_tasks.OSMTagParsing(self.datarep, self.dsname)
+        return OSMTagCube(self.datarep, self.dsname, streaming=self.streaming,
+                          error=self.error)
 
     def run(self):
-        with self.input().open('r') as inputflow:
-            tag_genome = pd.read_csv(inputflow, index_col=0)
-        tagvalue = tagmetanalyse.tagvalue_analysis(tag_genome, 'highway',
-                                                   ['version'])
+        tag_cube = tagmetanalyse.TagCube(self.input().path)
+        tagvalue = tag_cube.tagvalue_analysis(self.tagkey, ['version'])
         with self.output().open('w') as outputflow:
             tagvalue.to_csv(outputflow, date_format='%Y-%m-%d %H:%M:%S')
 
 class OSMTagValueFreq(luigi.Task):
     """Luigi task: Analyse of tag value frequency
     (amongst all tagged element), with a specific tag key (e.g. 'highway')
+
+    If 'streaming' is set, the analysis comes from the tag cube aggregated
+    while parsing the OSM history, otherwise from a tag cube approximated with
+    relative standard error 'error' if strictly positive (see OSMTagCube).
     """
     datarep = luigi.Parameter("data")
     dsname = luigi.Parameter("bordeaux-metropole")
+    streaming = luigi.BoolParameter(default=False)
+    error = luigi.FloatParameter(default=0.)
+    tagkey = luigi.Parameter("highway")
 
     def outputpath(self):
-        return osp.join(self.datarep, OUTPUT_DIR, self.dsname, "tag-value-freq.csv")
+        fname = "tag-value-freq.csv"
+        if self.tagkey != 'highway':
+            fname = "tag-value-freq-" + self.tagkey + ".csv"
+        return osp.join(self.datarep, OUTPUT_DIR, self.dsname, fname)
 
     def output(self):
         return luigi.LocalTarget(self.outputpath())
 
     def requires(self):
-        return data_preparation_tasks.OSMTagParsing(self.datarep, self.dsname)
+        return OSMTagCube(self.datarep, self.dsname, streaming=self.streaming,
+                          error=self.error)
 
     def run(self):
-        with self.input().open('r') as inputflow:
-            tag_genome = pd.read_csv(inputflow, index_col=0)
-        tagvalue_freq = tagmetanalyse.tagvalue_frequency(tag_genome,
-                                                         "highway",
-                                                         ['elem', 'version'])
+        tag_cube = tagmetanalyse.TagCube(self.input().path)
+        tagvalue_freq = tag_cube.tagvalue_frequency(self.tagkey,
+                                                    ['elem', 'version'])
         with self.output().open('w') as outputflow:
             tagvalue_freq.to_csv(outputflow, date_format='%Y-%m-%d %H:%M:%S')
 
 
+class OSMTagEventCount(luigi.Task):
+    """ Luigi task: number of tag change events (additions, modifications and
+    removals) of each tag key, by element type
+    """
+    datarep = luigi.Parameter("data")
+    dsname = luigi.Parameter("bordeaux-metropole")
+
+    def outputpath(self):
+        return osp.join(self.datarep, OUTPUT_DIR, self.dsname,
+                        "tag-event-count.csv")
+
+    def output(self):
+        return luigi.LocalTarget(self.outputpath())
+
+    def requires(self):
+        return data_preparation_tasks.OSMTagDiffParsing(self.datarep,
+                                                        self.dsname)
+
+    def run(self):
+        tag_diff = osmparsing.load_tag_diff(self.input().path)
+        tag_events = tagmetanalyse.tag_event_count(tag_diff, ['elem', 'event'])
+        with self.output().open('w') as outputflow:
+            tag_events.to_csv(outputflow, date_format='%Y-%m-%d %H:%M:%S')
+
 ### OSM Metadata Extraction ####################################
+def registers_of(osm_elements, grp_feat, error):
+    """Register table of the approximate distinct counts of change set
+    ('chgset') or user ('uid') metadata, None in exact mode
+    """
+    if error is None:
+        return None
+    element_types = utils.ELEMENT_TYPES if grp_feat == 'chgset' else None
+    return utils.metadata_registers(osm_elements, grp_feat, error,
+                                    element_types)
+
+def chgset_partition_metadata(path, partition, error, extraction_date):
+    """Extract the change set metadata of a partition of the enriched OSM
+    history (see data_preparation_tasks.partition_elements), and their
+    register table in approximate mode
+    """
+    osm_elements = data_preparation_tasks.read_elements(
+        path, "partition{}".format(partition))
+    if osm_elements is None:
+        return None
+    chgset_md = utils.extract_chgset_metadata(osm_elements, drop_ts=False,
+                                              extraction_date=extraction_date,
+                                              error=error)
+    return chgset_md, registers_of(osm_elements, 'chgset', error)
+
+def user_partition_metadata(path, partition, nb_partitions, chgset_md, error,
+                            extraction_date):
+    """Extract the user metadata of a partition of the enriched OSM history
+    (see data_preparation_tasks.partition_elements), and their register table
+    in approximate mode
+    """
+    osm_elements = data_preparation_tasks.read_elements(
+        path, "partition{}".format(partition))
+    if osm_elements is None:
+        return None
+    chgset_md = chgset_md[chgset_md.uid % nb_partitions == partition]
+    user_md = utils.extract_user_metadata(osm_elements, chgset_md,
+                                          drop_ts=False,
+                                          extraction_date=extraction_date,
+                                          error=error)
+    return user_md, registers_of(osm_elements, 'uid', error)
+
+def partitioned_metadata(task, key, extract, *args):
+    """Extract metadata from the enriched OSM history of a Luigi task, by
+    hash-partitioning the history according to 'key' ('task.partitions'
+    partitions, processed by 'task.processes' processes); return the list of
+    partial metadata, and the merged register table of the partitions in
+    approximate mode (None otherwise)
+    """
+    path = task.outputpath() + "-partitions"
+    extraction_date = data_preparation_tasks.partition_elements(
+        data_preparation_tasks.iter_elements(task.input()['enrichhist'].path),
+        key, task.partitions, path)
+    tasks = [(path, partition, *args, extraction_date)
+             for partition in range(task.partitions)]
+    if task.processes > 1:
+        with Pool(task.processes) as pool:
+            parts = pool.starmap(extract, tasks)
+    else:
+        parts = [extract(*args) for args in tasks]
+    os.remove(path)
+    parts = [part for part in parts if part is not None]
+    registers = None
+    if approximation_error(task) is not None:
+        registers = utils.merge_registers([registers for _, registers in parts],
+                                          key)
+    return [metadata for metadata, _ in parts], registers
+
+
+def write_metadata_state(metadata, path, registers=None, error=None):
+    """Write timestamped metadata (i.e. extracted with drop_ts=False) into an
+    HDF5 file, so as to update them incrementally (see MetadataUpdate), with
+    the register table of their approximate distinct counts and its relative
+    standard error, in approximate mode
+    """
+    tmppath = path + "-tmp"
+    metadata.to_hdf(tmppath, 'metadata', mode='w', format='fixed')
+    if registers is not None:
+        registers.to_hdf(tmppath, 'registers', format='fixed')
+        pd.Series({'error': error}).to_hdf(tmppath, 'error', format='fixed')
+    os.replace(tmppath, path)
+
+def read_metadata_state(path):
+    """Read timestamped metadata written by write_metadata_state"""
+    if not osp.isfile(path):
+        raise FileNotFoundError("Metadata state '{}' not found; remove the "
+                                "corresponding metadata so as to extract "
+                                "them again".format(path))
+    return pd.read_hdf(path, 'metadata')
+
+def read_metadata_registers(path, error):
+    """Read the register table written by write_metadata_state, None in exact
+    mode; raise a ValueError if the state was not extracted with the same
+    relative standard error
+    """
+    with pd.HDFStore(path, mode='r') as store:
+        state_error = (store.get('error')['error'] if '/error' in store.keys()
+                       else None)
+        if state_error != error:
+            raise ValueError("Metadata state '{}' was extracted with "
+                             "error={}, not {}; remove the corresponding "
+                             "metadata so as to extract them again"
+                             .format(path, state_error, error))
+        return store.get('registers') if error is not None else None
+
+def write_metadata(task, metadata, registers=None):
+    """Write the state of timestamped metadata (and of their register table,
+    in approximate mode), then the metadata of a Luigi task without their
+    timestamps
+    """
+    write_metadata_state(metadata, task.statepath(), registers,
+                         approximation_error(task))
+    with task.output().open('w') as outputflow:
+        utils.drop_features(metadata, '_at').to_csv(
+            outputflow, date_format='%Y-%m-%d %H:%M:%S')
+
+
 class ChangeSetMetadataExtract(luigi.Task):
     """ Luigi task: extraction of metadata for each OSM change set
+
+    If 'partitions' is strictly positive, the enriched history is split into
+    as many partitions of change sets, processed one at a time (or by
+    'processes' processes), instead of being loaded entirely into memory.
+
+    If 'error' is strictly positive, distinct counts are approximated with
+    sketches of this relative standard error (see cardinality); the register
+    tables of the partitions are then merged, and kept in the state file.
+
+    Timestamped metadata are kept in a state file, see MetadataUpdate.
     """
     datarep = luigi.Parameter("data")
     dsname = luigi.Parameter("bordeaux-metropole")
+    partitions = luigi.IntParameter(default=0)
+    processes = luigi.IntParameter(default=1)
+    error = luigi.FloatParameter(default=0.)
 
     def outputpath(self):
         return osp.join(self.datarep, OUTPUT_DIR, self.dsname, "changeset-metadata.csv")
 
+    def statepath(self):
+        return osp.join(self.datarep, OUTPUT_DIR, self.dsname,
+                        "changeset-metadata-state.h5")
+
     def output(self):
         return luigi.LocalTarget(self.outputpath())
 
     def requires(self):
-        return data_preparation_tasks.OSMElementEnrichment(self.datarep, self.dsname)
+        if self.partitions > 0:
+            return {'enrichhist': data_preparation_tasks.OSMElementEnrichment(
+                self.datarep, self.dsname, partitioned=True,
+                processes=self.processes)}
+        return data_preparation_tasks.OSMMappedEnrichment(self.datarep, self.dsname)
 
     def run(self):
-        with self.input().open('r') as inputflow:
-            osm_elements = pd.read_csv(inputflow,
-                                       index_col=0,
-                                       parse_dates=['ts'])
-        chgset_md = utils.extract_chgset_metadata(osm_elements)
-        with self.output().open('w') as outputflow:
-            chgset_md.to_csv(outputflow, date_format='%Y-%m-%d %H:%M:%S')
+        error = approximation_error(self)
+        if self.partitions > 0:
+            parts, registers = partitioned_metadata(
+                self, 'chgset', chgset_partition_metadata, error)
+            chgset_md = utils.combine_chgset_metadata(parts, drop_ts=False,
+                                                      registers=registers,
+                                                      error=error)
+        else:
+            osm_elements = data_preparation_tasks.read_mapped_elements(
+                self.input().path)
+            chgset_md = utils.extract_chgset_metadata(osm_elements,
+                                                      drop_ts=False,
+                                                      error=error)
+            registers = registers_of(osm_elements, 'chgset', error)
+        write_metadata(self, chgset_md, registers)
 
 
 class UserMetadataExtract(luigi.Task):
     """ Luigi task: extraction of metadata for each OSM user
+
+    If 'partitions' is strictly positive, the enriched history is split into
+    as many partitions of users (see ChangeSetMetadataExtract), and distinct
+    counts are approximated if 'error' is strictly positive (idem).
+    Timestamped metadata are kept in a state file, see MetadataUpdate.
     """
     datarep = luigi.Parameter("data")
     dsname = luigi.Parameter("bordeaux-metropole")
+    partitions = luigi.IntParameter(default=0)
+    processes = luigi.IntParameter(default=1)
+    error = luigi.FloatParameter(default=0.)
 
     def outputpath(self):
         return osp.join(self.datarep, OUTPUT_DIR, self.dsname, "user-metadata.csv")
 
+    def statepath(self):
+        return osp.join(self.datarep, OUTPUT_DIR, self.dsname,
+                        "user-metadata-state.h5")
+
     def output(self):
         return luigi.LocalTarget(self.outputpath())
 
     def requires(self):
-        return {'changeset': ChangeSetMetadataExtract(self.datarep, self.dsname),
-                'enrichhist': data_preparation_tasks.OSMElementEnrichment(self.datarep, self.dsname)}
+        changeset = ChangeSetMetadataExtract(self.datarep, self.dsname,
+                                             self.partitions, self.processes,
+                                             self.error)
+        if self.partitions > 0:
+            return {'changeset': changeset,
+                    'enrichhist': data_preparation_tasks.OSMElementEnrichment(
+                        self.datarep, self.dsname, partitioned=True,
+                        processes=self.processes)}
+        return {'changeset': changeset,
+                'enrichhist': data_preparation_tasks.OSMMappedEnrichment(self.datarep, self.dsname)}
 
     def run(self):
         with self.input()['changeset'].open('r') as inputflow:
             chgset_md = pd.read_csv(inputflow, index_col=0)
-        with self.input()['enrichhist'].open('r') as inputflow:
-            osm_elements = pd.read_csv(inputflow,
-                                       index_col=0,
-                                       parse_dates=['ts'])
-        user_md = utils.extract_user_metadata(osm_elements, chgset_md)
+        error = approximation_error(self)
+        if self.partitions > 0:
+            parts, registers = partitioned_metadata(
+                self, 'uid', user_partition_metadata, self.partitions,
+                chgset_md, error)
+            user_md = utils.combine_user_metadata(parts, drop_ts=False,
+                                                  registers=registers,
+                                                  error=error)
+        else:
+            osm_elements = data_preparation_tasks.read_mapped_elements(
+                self.input()['enrichhist'].path)
+            user_md = utils.extract_user_metadata(osm_elements, chgset_md,
+                                                  drop_ts=False, error=error)
+            registers = registers_of(osm_elements, 'uid', error)
+        write_metadata(self, user_md, registers)
+
+
+class MetadataUpdate(luigi.Task):
+    """ Luigi task: incremental update of change set and user metadata after
+    an update of the OSM history (see OSMHistoryUpdate)
+
+    Only the metadata of the change sets and users that contributed to the
+    updated elements are extracted again, from their own history; the other
+    ones are refreshed from the metadata states (extraction date-related
+    features, and user-related change set features). Metadata files are
+    updated in place, hence their derived outputs must be removed so as to be
+    rebuilt; the output lists the refreshed change sets and users.
+
+    If 'error' is strictly positive, it must be the one of the metadata
+    extraction: the register rows of the dirty items are replaced in the
+    states by the ones of their updated history, from which their distinct
+    counts are estimated again.
+    """
+    datarep = luigi.Parameter("data")
+    dsname = luigi.Parameter("bordeaux-metropole")
+    changefiles = luigi.ListParameter()
+    label = luigi.Parameter()
+    error = luigi.FloatParameter(default=0.)
+
+    def outputpath(self):
+        return osp.join(self.datarep, OUTPUT_DIR, self.dsname, "updates",
+                        "refreshed-metadata-" + self.label + ".csv")
+
+    def output(self):
+        return luigi.LocalTarget(self.outputpath())
+
+    def requires(self):
+        return {'update': data_preparation_tasks.OSMHistoryUpdate(
+                    self.datarep, self.dsname, self.changefiles, self.label),
+                'changeset': ChangeSetMetadataExtract(self.datarep,
+                                                      self.dsname,
+                                                      error=self.error),
+                'user': UserMetadataExtract(self.datarep, self.dsname,
+                                            error=self.error)}
+
+    def dirty_elements(self, dirty_chgsets, dirty_users):
+        """Return the enriched history of dirty change sets and users, and the
+        date of the history extraction
+        """
+        enrichment = data_preparation_tasks.OSMElementEnrichment(self.datarep,
+                                                                 self.dsname)
+        chunks = []
+        extraction_date = None
+        for chunk in data_preparation_tasks.iter_elements(
+                enrichment.outputpath()):
+            last_ts = chunk.ts.max()
+            if extraction_date is None or last_ts > extraction_date:
+                extraction_date = last_ts
+            chunks.append(chunk[chunk.chgset.isin(dirty_chgsets)
+                                | chunk.uid.isin(dirty_users)])
+        return pd.concat(chunks), extraction_date
+
+    def refreshed_registers(self, task, dirty_elements, grp_feat, dirty_keys,
+                            error):
+        """Replace the register rows of the dirty items in the metadata state
+        of a task by the ones of their updated history (see
+        utils.refresh_registers); None in exact mode
+        """
+        registers = read_metadata_registers(task.statepath(), error)
+        if error is None:
+            return None
+        return utils.refresh_registers(
+            registers, registers_of(dirty_elements, grp_feat, error),
+            grp_feat, dirty_keys)
+
+    def run(self):
+        with self.input()['update'].open('r') as inputflow:
+            dirty = pd.read_csv(inputflow)
+        dirty_chgsets = dirty.query("metadata == 'changeset'").key.values
+        dirty_users = dirty.query("metadata == 'user'").key.values
+        osm_elements, extraction_date = self.dirty_elements(dirty_chgsets,
+                                                            dirty_users)
+        changeset_task = self.requires()['changeset']
+        user_task = self.requires()['user']
+        error = approximation_error(self)
+        # Change set metadata
+        dirty_elements = osm_elements[osm_elements.chgset.isin(dirty_chgsets)]
+        dirty_md = utils.extract_chgset_metadata(
+            dirty_elements, drop_ts=False, extraction_date=extraction_date,
+            error=error)
+        registers = self.refreshed_registers(changeset_task, dirty_elements,
+                                             'chgset', dirty_chgsets, error)
+        chgset_md = utils.combine_chgset_metadata(utils.refresh_metadata(
+            read_metadata_state(changeset_task.statepath()), dirty_md,
+            'chgset', extraction_date), drop_ts=False, registers=registers,
+            error=error)
+        write_metadata(changeset_task, chgset_md, registers)
+        # User metadata
+        dirty_elements = osm_elements[osm_elements.uid.isin(dirty_users)]
+        dirty_md = utils.extract_user_metadata(
+            dirty_elements, chgset_md[chgset_md.uid.isin(dirty_users)],
+            drop_ts=False, extraction_date=extraction_date, error=error)
+        registers = self.refreshed_registers(user_task, dirty_elements, 'uid',
+                                             dirty_users, error)
+        user_md = utils.combine_user_metadata(utils.refresh_metadata(
+            read_metadata_state(user_task.statepath()), dirty_md, 'uid',
+            extraction_date), drop_ts=False, registers=registers, error=error)
+        write_metadata(user_task, user_md, registers)
         with self.output().open('w') as outputflow:
-            user_md.to_csv(outputflow, date_format='%Y-%m-%d %H:%M:%S')
+            dirty.to_csv(outputflow, index=False)
 
 class ElementMetadataExtract(luigi.Task):
     """ Luigi task: extraction of metadata for each OSM element
@@ -261,14 +677,12 @@ class ElementMetadataExtract(luigi.Task):
 
     def requires(self):
         return {
-            'osm_elements': data_preparation_tasks.OSMElementEnrichment(self.datarep, self.dsname),
+            'osm_elements': data_preparation_tasks.OSMMappedEnrichment(self.datarep, self.dsname),
             'user_groups': AutoKMeans(self.datarep, self.dsname, 'user')}
 
     def run(self):
-        with self.input()['osm_elements'].open('r') as inputflow:
-            osm_elements = pd.read_csv(inputflow,
-                                       index_col=0,
-                                       parse_dates=['ts'])
+        osm_elements = data_preparation_tasks.read_mapped_elements(
+            self.input()['osm_elements'].path)
         inputpath = self.input()['user_groups'].path
         user_kmind  = pd.read_hdf(inputpath, 'individuals')
         elem_md = utils.extract_elem_metadata(osm_elements, user_kmind,
@@ -278,11 +692,102 @@ class ElementMetadataExtract(luigi.Task):
 
 
 ### OSM Editor analysis ####################################
+def editor_count_by_user(user_editor, top_editor, n_top_editor):
+    """Count the changesets of each user by editor, for the n_top_editor most
+    used editors, the other ones being gathered under the 'other' label; the
+    'known' column is the total of the user changesets with a known editor
+
+    Parameters
+    ----------
+    user_editor: pd.DataFrame
+        number of changesets by user and editor ('uid', 'value', 'num')
+    top_editor: pd.DataFrame
+        most used editors, sorted by use (see TopMostUsedEditors)
+    n_top_editor: int
+        number of kept editors
+
+    """
+    user_editor = user_editor.copy()
+    # extract the unique editor name aka fullname
+    user_editor['fullname'] = user_editor['value'].apply(editor_name)
+    selection = (top_editor.fullname[:n_top_editor].tolist()
+                 + ['other'])
+    # Set the 'other' label for editors which are not in the top selection
+    other_mask = np.logical_not(user_editor['fullname'].isin(selection))
+    user_editor.loc[other_mask, 'fullname'] = 'other'
+    data = (user_editor.groupby(["uid", "fullname"])["num"].sum()
+            .unstack()
+            .reset_index()
+            .fillna(0))
+    data['known'] = data.iloc[:,1:].apply(lambda x: x.sum(), axis=1)
+    data.columns.values[1:] = ['n_total_chgset_'+name.replace(' ', '_')
+                               for name in data.columns.values[1:]]
+    return data
+
+class ChangesetUserIndex(luigi.Task):
+    """ Luigi task: build the per-user changeset index (see
+    changesets.UserIndex), i.e. the number of changesets, the first and last
+    changeset dates and the editor usage of every user
+
+    'changeset_path' is the path, relatively to the data directory, of a
+    changeset store or of a changeset XML file (see extract-changesets.py).
+    """
+    datarep = luigi.Parameter("data")
+    changeset_path = luigi.Parameter("changesets")
+
+    def outputpath(self):
+        return osp.join(self.datarep, OUTPUT_DIR, "changeset-user-index.h5")
+
+    def output(self):
+        return luigi.LocalTarget(self.outputpath())
+
+    def run(self):
+        source = changesets.changeset_source(osp.join(self.datarep,
+                                                      self.changeset_path))
+        changesets.UserIndex.build(source, self.outputpath())
+
+class ChangesetUserIndexUpdate(luigi.Task):
+    """ Luigi task: add new changesets to the per-user changeset index, from
+    changeset XML files (new dump, or replication diffs, in id order)
+
+    The index is updated in place, hence the outputs derived from it must be
+    removed so as to be rebuilt; the output lists the updated users.
+    'changefiles' are given relatively to the raw data directory, 'label'
+    names the update (e.g. the replication sequence number).
+    """
+    datarep = luigi.Parameter("data")
+    changeset_path = luigi.Parameter("changesets")
+    changefiles = luigi.ListParameter()
+    label = luigi.Parameter()
+
+    def outputpath(self):
+        return osp.join(self.datarep, OUTPUT_DIR, "updates",
+                        "changeset-users-" + self.label + ".csv")
+
+    def output(self):
+        return luigi.LocalTarget(self.outputpath())
+
+    def requires(self):
+        return ChangesetUserIndex(self.datarep, self.changeset_path)
+
+    def run(self):
+        user_index = changesets.UserIndex(self.input().path)
+        updated = user_index.update([osp.join(self.datarep, "raw", changefile)
+                                     for changefile in self.changefiles])
+        with self.output().open('w') as outputflow:
+            pd.DataFrame({'uid': updated}).to_csv(outputflow, index=False)
+
 class TopMostUsedEditors(luigi.Task):
     """Compute the most used editor. Transform the editor name such as JOSM/1.2.3
     into josm in order to have
+
+    If 'user_index' is set, the editors used by each user are read from the
+    per-user changeset index (see ChangesetUserIndex) instead of the
+    'all-editors-by-user.csv' file.
     """
     datarep = luigi.Parameter("data")
+    user_index = luigi.BoolParameter(default=False)
+    changeset_path = luigi.Parameter("changesets")
     fname = 'most-used-editor'
     editor_fname = 'all-editors-by-user.csv'
 
@@ -291,9 +796,17 @@ class TopMostUsedEditors(luigi.Task):
             osp.join(self.datarep, OUTPUT_DIR, self.fname + ".csv"),
             format=UTF8)
 
+    def requires(self):
+        if self.user_index:
+            return ChangesetUserIndex(self.datarep, self.changeset_path)
+
     def run(self):
-        with open(osp.join(self.datarep, OUTPUT_DIR, self.editor_fname)) as fobj:
-            user_editor = pd.read_csv(fobj, header=None, names=['uid', 'value', 'num'])
+        if self.user_index:
+            user_editor = changesets.UserIndex(
+                self.input().path).editor_usage().copy()
+        else:
+            with open(osp.join(self.datarep, OUTPUT_DIR, self.editor_fname)) as fobj:
+                user_editor = pd.read_csv(fobj, header=None, names=['uid', 'value', 'num'])
         # extract the unique editor name aka fullname
         user_editor['fullname'] = user_editor['value'].apply(editor_name)
         editor = editor_count(user_editor)
@@ -319,32 +832,27 @@ class EditorCountByUser(luigi.Task):
         with open(osp.join(self.datarep, OUTPUT_DIR, self.editor_fname)) as fobj:
             user_editor = pd.read_csv(fobj, header=None,
                                       names=['uid', 'value', 'num'])
-        # extract the unique editor name aka fullname
-        user_editor['fullname'] = user_editor['value'].apply(editor_name)
         with self.input().open('r') as fobj:
             top_editor = pd.read_csv(fobj)
-        selection = (top_editor.fullname[:self.n_top_editor].tolist()
-                     + ['other'])
-        # Set the 'other' label for editors which are not in the top selection
-        other_mask = np.logical_not(user_editor['fullname'].isin(selection))
-        user_editor.loc[other_mask, 'fullname'] = 'other'
-        data = (user_editor.groupby(["uid", "fullname"])["num"].sum()
-                .unstack()
-                .reset_index()
-                .fillna(0))
-        data['known'] = data.iloc[:,1:].apply(lambda x: x.sum(), axis=1)
-        data.columns.values[1:] = ['n_total_chgset_'+name.replace(' ', '_')
-                            for name in data.columns.values[1:]]
+        data = editor_count_by_user(user_editor, top_editor,
+                                    self.n_top_editor)
         with self.output().open("w") as fobj:
             data.to_csv(fobj, index=False)
 
 class AddExtraInfoUserMetadata(luigi.Task):
     """Add extra info to User metadata such as used editor and total number of
     changesets
+
+    If 'user_index' is set, the changeset counts and the editors of the users
+    are looked up in the per-user changeset index (see ChangesetUserIndex),
+    instead of being read for all the users from the
+    'all-changesets-by-user.csv' and 'all-editors-by-user.csv' files.
     """
     datarep = luigi.Parameter("data")
     dsname = luigi.Parameter("bordeaux-metropole")
     n_top_editor = luigi.IntParameter(default=5)
+    user_index = luigi.BoolParameter(default=False)
+    changeset_path = luigi.Parameter("changesets")
     editor_fname = 'editor-counts-by-user.csv'
     total_user_changeset_fname = 'all-changesets-by-user.csv'
 
@@ -353,17 +861,36 @@ class AddExtraInfoUserMetadata(luigi.Task):
             osp.join(self.datarep, OUTPUT_DIR, self.dsname, "user-metadata-extra.csv"), format=UTF8)
 
     def requires(self):
+        if self.user_index:
+            return {'user_index': ChangesetUserIndex(self.datarep,
+                                                     self.changeset_path),
+                    'top_editor': TopMostUsedEditors(self.datarep, True,
+                                                     self.changeset_path),
+                    'user_metadata': UserMetadataExtract(self.datarep,
+                                                         self.dsname)}
         return {'editor_count_by_user': EditorCountByUser(self.datarep, self.n_top_editor),
                 'user_metadata': UserMetadataExtract(self.datarep, self.dsname)}
 
     def run(self):
         with self.input()['user_metadata'].open() as fobj:
             users = pd.read_csv(fobj, index_col=0)
-        with self.input()['editor_count_by_user'].open() as fobj:
-            user_editor = pd.read_csv(fobj)
-        with open(osp.join(self.datarep, OUTPUT_DIR, self.total_user_changeset_fname)) as fobj:
-            changeset_count_users = pd.read_csv(fobj, header=None,
-                                                names=['uid', 'num'])
+        if self.user_index:
+            user_index = changesets.UserIndex(self.input()['user_index'].path)
+            changeset_count_users = (user_index.lookup(users.index)
+                                     .n_chgset.dropna().astype(int)
+                                     .rename('num')
+                                     .reset_index())
+            with self.input()['top_editor'].open() as fobj:
+                top_editor = pd.read_csv(fobj)
+            user_editor = editor_count_by_user(
+                user_index.editor_usage(users.index), top_editor,
+                self.n_top_editor)
+        else:
+            with self.input()['editor_count_by_user'].open() as fobj:
+                user_editor = pd.read_csv(fobj)
+            with open(osp.join(self.datarep, OUTPUT_DIR, self.total_user_changeset_fname)) as fobj:
+                changeset_count_users = pd.read_csv(fobj, header=None,
+                                                    names=['uid', 'num'])
         users = utils.add_chgset_metadata(users, changeset_count_users)
         users = utils.add_editor_metadata(users, user_editor)
         with self.output().open('w') as fobj:
@@ -373,7 +900,7 @@ class AddExtraInfoUserMetadata(luigi.Task):
 ### OSM Metadata analysis with unsupervised learning tool #########
 class MetadataNormalization(luigi.Task):
     """ Luigi task: normalize every features into metadata, so as to apply PCA
-    and Kmeans
+    and Kmeans, following the plan of the metadata type (see normalization)
     """
     datarep = luigi.Parameter("data")
     dsname = luigi.Parameter("bordeaux-metropole")
@@ -387,42 +914,29 @@ class MetadataNormalization(luigi.Task):
 
     def requires(self):
         if self.metadata_type == "changeset":
-            return {'osmelem': data_preparation_tasks.OSMElementEnrichment(self.datarep, self.dsname),
+            return {'osmelem': data_preparation_tasks.OSMMappedEnrichment(self.datarep, self.dsname),
                     'metadata': ChangeSetMetadataExtract(self.datarep, self.dsname)}
         elif self.metadata_type == "user":
-            return {'osmelem': data_preparation_tasks.OSMElementEnrichment(self.datarep, self.dsname),
+            return {'osmelem': data_preparation_tasks.OSMMappedEnrichment(self.datarep, self.dsname),
                     'metadata': AddExtraInfoUserMetadata(self.datarep, self.dsname)}
         else:
             raise ValueError("Metadata type '{}' not known. Please use 'user' or 'changeset'".format(self.metadata_type))
 
     def run(self):
-        with self.input()['osmelem'].open('r') as inputflow:
-            osm_elements  = pd.read_csv(inputflow, index_col=0,
-                                        parse_dates=['ts'])
+        osm_elements = data_preparation_tasks.read_mapped_elements(
+            self.input()['osmelem'].path, columns=['ts'])
         with self.input()['metadata'].open('r') as inputflow:
             metadata  = pd.read_csv(inputflow, index_col=0)
         timehorizon = ((osm_elements.ts.max() - osm_elements.ts.min())
                        / pd.Timedelta('1d'))
         if self.metadata_type == "changeset":
             # By definition, a change set takes 24h max
-            utils.normalize_temporal_features(metadata,
-                                              24*60, timehorizon)
-        else:
-            utils.normalize_temporal_features(metadata,
-                                              timehorizon, timehorizon)
-        if self.metadata_type == "changeset":
-            self.metadata_type # TODO - chgset normalization
+            max_lifespan = 24*60
         else:
-            utils.normalize_features(metadata, 'n_total_modif')
-            utils.normalize_features(metadata, 'n_node_modif')
-            utils.normalize_features(metadata, 'n_way_modif')
-            utils.normalize_features(metadata, 'n_relation_modif')
-            metadata = utils.ecdf_transform(metadata, 'nmean_modif_byelem')
-            metadata = utils.ecdf_transform(metadata, 'n_total_modif')
-            metadata = utils.ecdf_transform(metadata, 'n_node_modif')
-            metadata = utils.ecdf_transform(metadata, 'n_way_modif')
-            metadata = utils.ecdf_transform(metadata, 'n_relation_modif')
-            metadata = utils.transform_editor_features(metadata)
+            max_lifespan = timehorizon
+        metadata = normalization.normalize_metadata(
+            metadata, normalization.PLANS[self.metadata_type],
+            max_lifespan=max_lifespan, timehorizon=timehorizon)
         with self.output().open('w') as fobj:
             metadata.to_csv(fobj)
 
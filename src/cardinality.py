@@ -0,0 +1,251 @@
+# coding: utf-8
+
+"""Approximate distinct counting of grouped values with HyperLogLog sketches
+
+A sketch of precision p hashes the values on 64 bits, splits them into
+m = 2^p registers with the first p bits, and keeps in each register the
+maximal rank of the other bits (position of their first 1-bit); the number of
+distinct values is estimated from the ranks with a relative standard error of
+about 1.04/sqrt(m), i.e. 1% for p=14, whatever the number of values.
+
+Sketches of groups are stored as register tables, i.e. DataFrames with the
+group key features, and the 'register' and 'rank' columns, that only keep the
+non-empty registers. They are mergeable: the sketch of the union of several
+datasets (e.g. history partitions, or a history and its update) is the maximal
+rank of each group register, hence distinct counts can be maintained without
+scanning the values again.
+
+The cardinality estimator is the one of O. Ertl (New cardinality estimation
+algorithms for HyperLogLog sketches, 2017), which does not need any empirical
+bias correction.
+"""
+
+import math
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_categorical_dtype
+
+
+DEFAULT_ERROR = 0.01
+MIN_PRECISION = 4
+MAX_PRECISION = 18
+# Number of register slots under which sketches are gathered densely
+DENSE_SLOTS = 1 << 24
+
+
+def precision(error=DEFAULT_ERROR):
+    """Return the lowest sketch precision whose relative standard error is
+    lower or equal to 'error'
+    """
+    p = int(math.ceil(math.log2((1.04 / error) ** 2)))
+    return min(max(p, MIN_PRECISION), MAX_PRECISION)
+
+def hash_values(values):
+    """Hash values on 64 bits; categorical values are hashed through their
+    categories, so that hashes do not depend on the category dictionary
+    """
+    if is_categorical_dtype(values):
+        values = pd.Categorical(values)
+        return pd.util.hash_array(np.asarray(values.categories))[values.codes]
+    return pd.util.hash_array(np.asarray(values))
+
+def register_ranks(values, p):
+    """Return the register and the rank of each value, for a sketch of
+    precision p; ranks go from 1 to 65-p
+    """
+    hashes = hash_values(values)
+    registers = (hashes >> np.uint64(64 - p)).astype(np.int64)
+    remainder = hashes << np.uint64(p)
+    # Bit length of the remainders, corrected where the float conversion
+    # rounds up to the next power of two
+    _, bit_length = np.frexp(remainder.astype(np.float64))
+    bit_length = np.minimum(bit_length, 64)
+    shift = np.maximum(bit_length - 1, 0).astype(np.uint64)
+    bit_length -= (bit_length > 0) & ((remainder >> shift) == 0)
+    ranks = np.where(remainder == 0, 65 - p, 65 - bit_length)
+    return registers, ranks.astype(np.uint8)
+
+def _sigma(x):
+    """Correction term of the empty registers, for their shares x"""
+    x = np.array(x, dtype=np.float64)
+    full = x >= 1
+    result = x.copy()
+    y = np.ones_like(x)
+    for _ in range(64):
+        x = x * x
+        result = result + x * y
+        y = y + y
+    return np.where(full, np.inf, result)
+
+def _tau(x):
+    """Correction term of the saturated registers, for their shares x"""
+    x = np.array(x, dtype=np.float64)
+    bounds = (x == 0) | (x == 1)
+    result = 1 - x
+    y = np.ones_like(x)
+    for _ in range(64):
+        x = np.sqrt(x)
+        y = y / 2
+        result = result - (1 - x) ** 2 * y
+    return np.where(bounds, 0, result / 3)
+
+def estimate(groups, ranks, nb_groups, p):
+    """Estimate the number of distinct values of each group from the ranks of
+    its non-empty registers
+
+    Parameters
+    ----------
+    groups: np.array
+        group index of each non-empty register (at most one register of each
+    group and register index)
+    ranks: np.array
+        rank of each non-empty register
+    nb_groups: int
+        number of groups
+    p: int
+        sketch precision
+
+    Returns
+    -------
+    np.array
+        estimated numbers of distinct values, as integers
+
+    """
+    m = 1 << p
+    q = 64 - p
+    ranks = np.asarray(ranks, dtype=np.int64)
+    saturated = ranks == q + 1
+    nb_empty = m - np.bincount(groups, minlength=nb_groups)
+    nb_saturated = np.bincount(groups, weights=saturated, minlength=nb_groups)
+    weights = np.where(saturated, 0, np.exp2(-ranks.astype(np.float64)))
+    harmonic = (np.bincount(groups, weights=weights, minlength=nb_groups)
+                + m * _tau(1 - nb_saturated / m) * 2.0 ** -q
+                + m * _sigma(nb_empty / m))
+    counts = m * m / (2 * math.log(2) * harmonic)
+    return np.round(counts).astype(np.int64)
+
+def group_codes(keys):
+    """Return the integer code of the rows defined by key arrays (-1 for rows
+    with null keys), and the position of the first row of each code
+    """
+    codes = np.zeros(len(keys[0]), dtype=np.int64)
+    valid = np.ones(len(codes), dtype=bool)
+    for key in keys:
+        key_codes, uniques = pd.factorize(key)
+        valid &= key_codes >= 0
+        codes, _ = pd.factorize(codes * max(len(uniques), 1) + key_codes)
+    result = np.full(len(codes), -1, dtype=np.int64)
+    result[valid], _ = pd.factorize(codes[valid])
+    _, first = np.unique(result[valid], return_index=True)
+    return result, np.flatnonzero(valid)[first]
+
+def max_ranks(slots, ranks, nb_slots):
+    """Return the distinct register slots, sorted, and their maximal rank
+
+    Registers are gathered into a dense array if it is not much larger than
+    the slots themselves; otherwise, distinct (slot, rank) pairs are sorted,
+    and the last pair of each slot is kept.
+    """
+    if nb_slots <= max(DENSE_SLOTS, 8 * len(slots)):
+        registers = np.zeros(nb_slots, dtype=np.uint8)
+        np.maximum.at(registers, slots, ranks)
+        slots = np.flatnonzero(registers)
+        return slots, registers[slots]
+    pairs = pd.unique(slots * 64 + ranks)
+    pairs.sort()
+    slots = pairs >> 6
+    last = np.append(slots[1:] != slots[:-1], True)
+    return slots[last], (pairs[last] & 63).astype(np.uint8)
+
+def group_registers(groups, values, p):
+    """Return the non-empty register slots (group index * 2^p + register) of
+    the sketches of grouped values, and their rank; null values and values of
+    negative groups are ignored
+    """
+    registers, ranks = register_ranks(values, p)
+    valid = (groups >= 0) & np.asarray(pd.notnull(values))
+    slots = groups[valid].astype(np.int64) * (1 << p) + registers[valid]
+    nb_groups = groups.max() + 1 if len(groups) else 0
+    return max_ranks(slots, ranks[valid], nb_groups << p)
+
+def group_nunique(groups, values, nb_groups, error=DEFAULT_ERROR):
+    """Approximate the number of distinct non-null values of each group
+
+    Parameters
+    ----------
+    groups: np.array
+        group index of each value, from 0 to nb_groups-1
+    values: np.array
+        grouped values
+    nb_groups: int
+        number of groups
+    error: float
+        relative standard error of the sketches
+
+    """
+    p = precision(error)
+    slots, ranks = group_registers(groups, values, p)
+    return estimate(slots >> p, ranks, nb_groups, p)
+
+def sketch(keys, values, error=DEFAULT_ERROR):
+    """Return the register table of the sketches of grouped values
+
+    Parameters
+    ----------
+    keys: pd.DataFrame
+        group key features of each value
+    values: np.array or pd.Series
+        grouped values, aligned with keys
+    error: float
+        relative standard error of the sketches
+
+    """
+    p = precision(error)
+    codes, first = group_codes([keys[feature].values for feature in keys])
+    slots, ranks = group_registers(codes, values, p)
+    table = keys.iloc[first[slots >> p]].reset_index(drop=True)
+    table['register'] = slots & ((1 << p) - 1)
+    table['rank'] = ranks
+    return table
+
+def merge(tables, by):
+    """Merge register tables of the same precision, e.g. sketched from
+    several partitions of a dataset, into the register table of their union
+
+    Parameters
+    ----------
+    tables: list
+        register tables (see sketch)
+    by: list
+        group key features
+
+    """
+    registers = pd.concat(tables, ignore_index=True)
+    codes, first = group_codes([registers[feature].values
+                                for feature in [*by, 'register']])
+    _, ranks = max_ranks(codes, registers['rank'].values, len(first))
+    table = registers.iloc[first].reset_index(drop=True)
+    table['rank'] = ranks
+    return table
+
+def count(table, by, error=DEFAULT_ERROR):
+    """Estimate the number of distinct values of each group of a register
+    table, as a series indexed by the 'by' features (as the nunique
+    aggregation of a pandas groupby)
+    """
+    codes, first = group_codes([table[feature].values for feature in by])
+    counts = estimate(codes, table['rank'].values, len(first),
+                      precision(error))
+    if len(by) == 1:
+        index = pd.Index(table[by[0]].values[first], name=by[0])
+    else:
+        index = pd.MultiIndex.from_arrays([table[feature].values[first]
+                                           for feature in by], names=by)
+    return pd.Series(counts, index=index).sort_index()
+
+def nunique(keys, values, error=DEFAULT_ERROR):
+    """Approximate the number of distinct non-null values of each group of
+    'keys' features (see sketch and count)
+    """
+    return count(sketch(keys, values, error), list(keys.columns), error)
@@ -0,0 +1,721 @@
+# coding: utf-8
+
+"""Extract changesets from the (huge) OSM history changeset XML file, with
+several processes
+
+The file is split into ranges aligned on '<changeset' boundaries: byte ranges
+of the file itself if it is plain XML, so as each worker reads its own range,
+or chunks of the decompressed stream if it is bz2-compressed (decompression
+is sequential, parsing is not). Each range is scanned by a regular expression
+that expects the attribute order of the changeset dumps, or parsed by a
+streaming XML parser (expat) if it does not follow this order, and written
+into its own CSV shard, with one row per changeset tag (or a single row with
+empty 'key' and 'value' if the changeset has no tag), or into its own
+partition of a changeset store (see ChangesetStore), whose typed columns are
+stored separately, so as per-user analyses only read the columns they need.
+
+Changesets without any user id (anonymous edits of the early OSM history) are
+skipped.
+"""
+
+import bz2
+from collections import deque
+import gzip
+import html
+import json
+from multiprocessing import Pool
+import os
+import os.path as osp
+import re
+import shutil
+from xml.parsers import expat
+
+import numpy as np
+import pandas as pd
+
+
+CHANGESET_ATTRIBUTES = [('id', 'id'), ('created', 'created_at'),
+                        ('closed', 'closed_at'), ('uid', 'uid'),
+                        ('min_lat', 'min_lat'), ('min_lon', 'min_lon'),
+                        ('max_lat', 'max_lat'), ('max_lon', 'max_lon'),
+                        ('num_changes', 'num_changes'),
+                        ('comments_count', 'comments_count')]
+CHANGESET_COLUMNS = [name for name, _ in CHANGESET_ATTRIBUTES] + ['key',
+                                                                  'value']
+
+# Types of the changeset store columns, and tag store columns
+CHANGESET_TYPES = {'id': 'int64', 'created': 'datetime64[ns]',
+                   'closed': 'datetime64[ns]', 'uid': 'int64',
+                   'min_lat': 'float64', 'min_lon': 'float64',
+                   'max_lat': 'float64', 'max_lon': 'float64',
+                   'num_changes': 'int32', 'comments_count': 'int32'}
+CHANGESET_TAG_COLUMNS = ['chgset', 'tagkey', 'tagvalue']
+PARTITIONS_FILE = 'partitions.json'
+
+# Tag key of the editors, and columns of the user index
+EDITOR_KEY = 'created_by'
+USER_INDEX_COLUMNS = ['uid', 'n_chgset', 'first_at', 'last_at']
+
+CHANGESET_START = b'<changeset '
+OSM_END = b'</osm>'
+CHUNKSIZE = 256 * 2**20
+
+# Changeset elements and their tags, with the attributes of the changeset
+# dumps (planet-dump-ng), in their order
+SCANNED_ELEMENTS = re.compile(
+    r'<changeset id="(\d+)" created_at="([^"]*)"(?: closed_at="([^"]*)")?'
+    r'(?: open="[^"]*")?(?: user="[^"]*")?(?: uid="(\d+)")?'
+    r'(?: min_lat="([^"]*)" min_lon="([^"]*)"'
+    r' max_lat="([^"]*)" max_lon="([^"]*)")?'
+    r'(?: num_changes="(\d+)")?(?: comments_count="(\d+)")?\s*(/?)>'
+    r'|<tag k="([^"]*)" v="([^"]*)"\s*/>'
+    r'|</changeset>')
+
+
+def quote(value):
+    """Quote a tag key or value as a CSV field"""
+    return '"' + value.replace('"', '""') + '"'
+
+def unescape(value):
+    """Unescape the XML entities of an attribute value"""
+    return html.unescape(value) if '&' in value else value
+
+class ChangesetParser(object):
+    """Streaming XML parser of a sequence of '<changeset>' elements
+
+    Changesets are gathered as lists of attribute values (see
+    CHANGESET_ATTRIBUTES), and their tags as (changeset position, key, value)
+    tuples; changesets without user id are skipped.
+    """
+    def __init__(self):
+        """ Class default constructor"""
+        self.changesets = []
+        self.tags = []
+        self.changeset = None
+        self.parser = expat.ParserCreate()
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+
+    def start_element(self, name, attrs):
+        if name == 'changeset':
+            self.changeset = [attrs.get(attribute, '')
+                              for _, attribute in CHANGESET_ATTRIBUTES]
+            if self.changeset[3]:
+                self.changesets.append(self.changeset)
+            else:
+                self.changeset = None
+        elif name == 'tag' and self.changeset is not None:
+            self.tags.append((len(self.changesets) - 1, attrs.get('k', ''),
+                              attrs.get('v', '')))
+
+    def end_element(self, name):
+        if name == 'changeset':
+            self.changeset = None
+
+    def parse(self, data):
+        """Parse a sequence of changeset elements, given as bytes, and return
+        the changesets and their tags
+        """
+        self.parser.Parse(b'<osm>', False)
+        self.parser.Parse(data, False)
+        self.parser.Parse(b'</osm>', True)
+        return self.changesets, self.tags
+
+def scan_changesets(text):
+    """Scan a sequence of changeset elements with a regular expression that
+    expects the attribute order of the changeset dumps; return the changesets
+    and their tags (see ChangesetParser), and the number of scanned
+    changesets (with or without user id)
+    """
+    changesets, tags = [], []
+    current = None
+    nb_changesets = 0
+    for match in SCANNED_ELEMENTS.finditer(text):
+        groups = match.groups()
+        if groups[0] is not None:
+            nb_changesets += 1
+            current = None
+            if groups[3] is not None:
+                changesets.append([value or '' for value in groups[:10]])
+                if not groups[10]:
+                    current = len(changesets) - 1
+        elif groups[11] is not None:
+            if current is not None:
+                tags.append((current, unescape(groups[11]),
+                             unescape(groups[12])))
+        else:
+            current = None
+    return changesets, tags, nb_changesets
+
+def parse_changesets(data):
+    """Return the changesets of a sequence of changeset elements, given as
+    bytes, and their tags (see ChangesetParser); the elements are scanned
+    with a regular expression, unless some of them do not follow the
+    attribute order of the changeset dumps, in which case they are parsed as
+    XML
+    """
+    text = data.decode('utf-8')
+    changesets, tags, nb_changesets = scan_changesets(text)
+    if nb_changesets != text.count(CHANGESET_START.decode()):
+        changesets, tags = ChangesetParser().parse(data)
+    return changesets, tags
+
+def changeset_lines(changesets, tags):
+    """Return the CSV lines of changesets and their tags, one line per tag, or
+    a single line with empty key and value if a changeset has no tag
+    """
+    lines = []
+    tag_iter = iter(tags)
+    tag = next(tag_iter, None)
+    for position, changeset in enumerate(changesets):
+        prefix = ','.join(changeset) + ','
+        if tag is None or tag[0] != position:
+            lines.append(prefix + ',')
+        while tag is not None and tag[0] == position:
+            lines.append(prefix + quote(tag[1]) + ',' + quote(tag[2]))
+            tag = next(tag_iter, None)
+    return lines
+
+def extract_chunk(data, outpath):
+    """Parse a chunk of changeset elements and write them into a CSV shard,
+    with a header; return the number of written rows
+    """
+    lines = changeset_lines(*parse_changesets(data))
+    with open(outpath, 'w') as fobj:
+        fobj.write(','.join(CHANGESET_COLUMNS) + '\n')
+        if lines:
+            fobj.write('\n'.join(lines) + '\n')
+    return len(lines)
+
+def changeset_tables(changesets, tags):
+    """Build the typed changeset table and the dictionary-encoded tag table of
+    parsed changesets (see ChangesetParser)
+
+    Returns
+    -------
+    tuple
+        changeset table (see CHANGESET_TYPES), sorted by id, tag table
+    ('chgset', 'tagkey' and 'tagvalue' codes), and the tag key and tag value
+    dictionaries, as lists sorted in lexicographical order
+
+    """
+    columns = list(zip(*changesets)) or [()] * len(CHANGESET_ATTRIBUTES)
+    table = pd.DataFrame(index=range(len(changesets)))
+    for (name, _), values in zip(CHANGESET_ATTRIBUTES, columns):
+        dtype = CHANGESET_TYPES[name]
+        values = pd.Series(values, dtype=object)
+        if dtype == 'datetime64[ns]':
+            table[name] = pd.to_datetime(values, format='%Y-%m-%dT%H:%M:%SZ',
+                                         errors='coerce')
+        else:
+            values = pd.to_numeric(values, errors='coerce')
+            if dtype != 'float64':
+                values = values.fillna(0)
+            table[name] = values.astype(dtype)
+    positions, keys, values = (list(column) for column in zip(*tags)) \
+        if tags else ([], [], [])
+    key_codes, tagkeys = pd.factorize(pd.Series(keys, dtype=object),
+                                      sort=True)
+    value_codes, tagvalues = pd.factorize(pd.Series(values, dtype=object),
+                                          sort=True)
+    tag_table = pd.DataFrame({
+        'chgset': table.id.values[np.array(positions, dtype=np.int64)],
+        'tagkey': key_codes.astype(np.int32),
+        'tagvalue': value_codes.astype(np.int32)},
+        columns=CHANGESET_TAG_COLUMNS)
+    order = np.argsort(table.id.values, kind='mergesort')
+    table = table.iloc[order].reset_index(drop=True)
+    tag_table = (tag_table
+                 .iloc[np.argsort(tag_table.chgset.values, kind='mergesort')]
+                 .reset_index(drop=True))
+    return table, tag_table, list(tagkeys), list(tagvalues)
+
+def write_columns(table, path):
+    """Write a table as a directory of raw numpy column files"""
+    os.makedirs(path)
+    for column in table.columns:
+        np.save(osp.join(path, column + ".npy"), table[column].values)
+
+def read_columns(path, columns):
+    """Open the column files of a table written by write_columns, as a
+    dataframe of read-only memory maps
+    """
+    return pd.DataFrame({column: np.load(osp.join(path, column + ".npy"),
+                                         mmap_mode='r')
+                         for column in columns},
+                        columns=columns, copy=False)
+
+def store_chunk(data, outpath):
+    """Parse a chunk of changeset elements and write them as a changeset store
+    partition (see ChangesetStore), created only once completely written;
+    return the partition description
+    """
+    table, tag_table, tagkeys, tagvalues = changeset_tables(
+        *parse_changesets(data))
+    tmppath = outpath + "-tmp"
+    if osp.isdir(tmppath):
+        shutil.rmtree(tmppath)
+    write_columns(table, osp.join(tmppath, 'changesets'))
+    write_columns(tag_table, osp.join(tmppath, 'tags'))
+    with open(osp.join(tmppath, 'dictionaries.json'), 'w') as fobj:
+        json.dump({'tagkeys': tagkeys, 'tagvalues': tagvalues}, fobj)
+    if osp.isdir(outpath):
+        shutil.rmtree(outpath)
+    os.rename(tmppath, outpath)
+    return {'name': osp.basename(outpath),
+            'nb_changesets': len(table),
+            'nb_tags': len(tag_table),
+            'min_id': int(table.id.min()) if len(table) else None,
+            'max_id': int(table.id.max()) if len(table) else None,
+            'min_created': str(table.created.min()) if len(table) else None,
+            'max_created': str(table.created.max()) if len(table) else None}
+
+def extract_range(path, start, stop, outpath, extract=extract_chunk):
+    """Parse the changeset elements located between bytes start and stop of a
+    plain XML file, and write them with the 'extract' function (into a CSV
+    shard by default, see extract_chunk)
+    """
+    with open(path, 'rb') as fobj:
+        fobj.seek(start)
+        data = fobj.read(stop - start)
+    return extract(data, outpath)
+
+def next_changeset(fobj, position, end, blocksize=2**20):
+    """Return the position of the first changeset element starting at or after
+    position in a plain XML file, or end if there is none
+    """
+    overlap = len(CHANGESET_START) - 1
+    while position < end:
+        fobj.seek(position)
+        block = fobj.read(min(blocksize, end - position))
+        found = block.find(CHANGESET_START)
+        if found >= 0:
+            return position + found
+        if len(block) <= overlap:
+            break
+        position += len(block) - overlap
+    return end
+
+def changeset_ranges(path, nb_ranges):
+    """Split a plain changeset XML file into byte ranges aligned on changeset
+    elements; the XML header and the closing '</osm>' tag are left out
+
+    Parameters
+    ----------
+    path: str
+        path to the changeset XML file
+    nb_ranges: int
+        number of ranges (empty ranges are dropped)
+
+    Returns
+    -------
+    list
+        (start, stop) byte positions of each range
+
+    """
+    size = osp.getsize(path)
+    with open(path, 'rb') as fobj:
+        fobj.seek(max(size - 4096, 0))
+        tail = fobj.read()
+        end = tail.rfind(OSM_END)
+        end = size if end < 0 else size - len(tail) + end
+        bounds = sorted({next_changeset(fobj, i * end // nb_ranges, end)
+                         for i in range(nb_ranges)} | {end})
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+def stream_chunks(fobj, chunksize=CHUNKSIZE):
+    """Yield the changeset elements of a (possibly decompressed) file object,
+    as chunks of about chunksize bytes aligned on changeset elements; the XML
+    header and the closing '</osm>' tag are left out
+    """
+    buf = b''
+    started = False
+    while True:
+        data = fobj.read(chunksize)
+        buf += data
+        if not started:
+            first = buf.find(CHANGESET_START)
+            if first < 0 and data:
+                continue
+            started = True
+            buf = buf[max(first, 0):] if first >= 0 else b''
+        if not data:
+            end = buf.rfind(OSM_END)
+            if end >= 0:
+                buf = buf[:end]
+            if buf.strip():
+                yield buf
+            return
+        cut = buf.rfind(CHANGESET_START)
+        if cut > 0:
+            yield buf[:cut]
+            buf = buf[cut:]
+
+def shard_path(outdir, shard, store=False):
+    """Return the path of a CSV shard, or of a store partition"""
+    if store:
+        return osp.join(outdir, "partition{:05d}".format(shard))
+    return osp.join(outdir, "changesets-{:05d}.csv".format(shard))
+
+def extract_changesets(path, outdir, workers=1, chunksize=CHUNKSIZE,
+                       store=False):
+    """Extract the changesets of an OSM changeset XML file into CSV shards, or
+    into a changeset store if 'store' is set (see ChangesetStore)
+
+    Plain XML files are split into byte ranges of about chunksize bytes, that
+    the workers read by themselves; bz2-compressed files ('.bz2' extension)
+    are decompressed by the calling process, and their chunks are parsed by
+    the workers, at most 2*workers chunks being pending at a time.
+
+    Parameters
+    ----------
+    path: str
+        path to the changeset XML file
+    outdir: str
+        directory of the CSV shards, named 'changesets-<shard>.csv', or of the
+    changeset store
+    workers: int
+        number of processes
+    chunksize: int
+        number of XML bytes parsed by shard
+    store: bool
+        if True, write a changeset store instead of CSV shards
+
+    Returns
+    -------
+    list
+        paths of the CSV shards, or of the store partitions, in the file order
+
+    """
+    os.makedirs(outdir, exist_ok=True)
+    extract = store_chunk if store else extract_chunk
+    with Pool(workers) as pool:
+        if not path.endswith('.bz2'):
+            nb_ranges = max(osp.getsize(path) // chunksize, 1)
+            ranges = changeset_ranges(path, nb_ranges)
+            outpaths = [shard_path(outdir, shard, store)
+                        for shard in range(len(ranges))]
+            results = pool.starmap(extract_range,
+                                   [(path, start, stop, outpath, extract)
+                                    for (start, stop), outpath
+                                    in zip(ranges, outpaths)])
+        else:
+            outpaths, results = [], []
+            pending = deque()
+            with bz2.open(path, 'rb') as fobj:
+                for shard, chunk in enumerate(stream_chunks(fobj, chunksize)):
+                    outpaths.append(shard_path(outdir, shard, store))
+                    pending.append(pool.apply_async(extract,
+                                                    (chunk, outpaths[-1])))
+                    if len(pending) >= 2 * workers:
+                        results.append(pending.popleft().get())
+            results += [result.get() for result in pending]
+    if store:
+        with open(osp.join(outdir, PARTITIONS_FILE), 'w') as fobj:
+            json.dump(results, fobj, indent=1)
+    return outpaths
+
+class ChangesetStore(object):
+    """Changeset store, written by extract_changesets: a directory of
+    partitions, i.e. contiguous ranges of changeset ids, described in the
+    'partitions.json' file
+
+    Each partition holds the 'changesets' table, with typed columns (see
+    CHANGESET_TYPES), sorted by id, and the 'tags' table, with the changeset
+    id ('chgset') and the tag key and tag value codes of each tag, sorted by
+    changeset id; codes refer to the 'tagkeys' and 'tagvalues' dictionaries
+    of the partition. Each column is stored as a raw numpy file, so as readers
+    only load the columns they need, through memory maps.
+    """
+    def __init__(self, path):
+        """ Class default constructor"""
+        self.path = path
+        with open(osp.join(path, PARTITIONS_FILE)) as fobj:
+            self.partitions = json.load(fobj)
+
+    def __len__(self):
+        return sum(partition['nb_changesets']
+                   for partition in self.partitions)
+
+    def dictionaries(self, partition):
+        """Return the tag key and tag value dictionaries of a partition"""
+        with open(osp.join(self.path, partition['name'],
+                           'dictionaries.json')) as fobj:
+            dictionaries = json.load(fobj)
+        return (np.array(dictionaries['tagkeys'], dtype=object),
+                np.array(dictionaries['tagvalues'], dtype=object))
+
+    def iter_changesets(self, columns=None):
+        """Yield the changeset table of each partition, restricted to some
+        columns (all of them by default)
+        """
+        columns = columns or list(CHANGESET_TYPES)
+        for partition in self.partitions:
+            yield read_columns(osp.join(self.path, partition['name'],
+                                        'changesets'), columns)
+
+    def iter_tags(self, key=None, columns=None):
+        """Yield the tag table of each partition, restricted to a tag key if
+        given (the table is empty if the partition has no such key), and to
+        some columns (all of them by default); tag keys and values are decoded
+        as categoricals
+        """
+        columns = columns or CHANGESET_TAG_COLUMNS
+        for partition in self.partitions:
+            path = osp.join(self.path, partition['name'], 'tags')
+            tagkeys, tagvalues = self.dictionaries(partition)
+            tags = read_columns(path, sorted(set(columns) | {'tagkey'},
+                                             key=CHANGESET_TAG_COLUMNS.index))
+            if key is not None:
+                code = np.searchsorted(tagkeys, key)
+                if code == len(tagkeys) or tagkeys[code] != key:
+                    code = -1
+                tags = tags[tags.tagkey.values == code]
+            tags = tags[columns].copy()
+            if 'tagkey' in tags:
+                tags['tagkey'] = pd.Categorical.from_codes(
+                    tags.tagkey.values, tagkeys)
+            if 'tagvalue' in tags:
+                tags['tagvalue'] = pd.Categorical.from_codes(
+                    tags.tagvalue.values, tagvalues)
+            yield tags
+
+    def read_changesets(self, columns=None):
+        """Return the changeset table of the whole store, restricted to some
+        columns (all of them by default)
+        """
+        return pd.concat(list(self.iter_changesets(columns)),
+                         ignore_index=True)
+
+    def changeset_count(self, by='uid'):
+        """Return the number of changesets of each 'by' item (e.g. user),
+        reading the 'by' column only
+        """
+        counts = [tables[by].value_counts()
+                  for tables in self.iter_changesets([by])]
+        return (pd.concat(counts).groupby(level=0).sum()
+                .rename_axis(by).rename('n_chgset'))
+
+    def tag_usage(self, key, by='uid'):
+        """Return the number of changesets of each ('by' item, tag value) pair,
+        for a given tag key (e.g. the editors used by each user, with the
+        'created_by' key), reading the changeset ids, the 'by' column and the
+        tags of the key only
+        """
+        usage = []
+        for changesets, tags in zip(self.iter_changesets(['id', by]),
+                                    self.iter_tags(key, ['chgset',
+                                                         'tagvalue'])):
+            positions = np.searchsorted(changesets.id.values,
+                                        tags.chgset.values)
+            usage.append(pd.DataFrame({
+                by: changesets[by].values[positions],
+                'value': tags.tagvalue.astype(object).values}))
+        usage = pd.concat(usage, ignore_index=True)
+        return (usage.groupby([by, 'value']).size()
+                .rename('n_chgset'))
+
+def open_changeset_file(path):
+    """Open a changeset XML file in binary mode, plain or compressed
+    (replication diffs are gzip-compressed, dumps are bz2-compressed)
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    return open(path, 'rb')
+
+def changeset_source(path):
+    """Return the changeset source at path: a changeset store if path is a
+    directory, the path itself (of a changeset XML file) otherwise
+    """
+    return ChangesetStore(path) if osp.isdir(path) else path
+
+def iter_user_tables(source, key=EDITOR_KEY):
+    """Yield the changesets ('id', 'uid' and 'created') and the 'key' tags
+    ('chgset' and 'tagvalue') of a changeset source, by chunks
+
+    Parameters
+    ----------
+    source: ChangesetStore, str or list
+        changeset store, or path(s) to changeset XML files (dumps or
+    replication diffs)
+    key: str
+        tag key
+
+    """
+    if isinstance(source, ChangesetStore):
+        yield from zip(source.iter_changesets(['id', 'uid', 'created']),
+                       source.iter_tags(key, ['chgset', 'tagvalue']))
+        return
+    for path in [source] if isinstance(source, str) else source:
+        with open_changeset_file(path) as fobj:
+            for chunk in stream_chunks(fobj):
+                table, tags, tagkeys, tagvalues = changeset_tables(
+                    *parse_changesets(chunk))
+                code = tagkeys.index(key) if key in tagkeys else -1
+                tags = tags[tags.tagkey.values == code]
+                tagvalues = np.array(tagvalues, dtype=object)
+                yield (table[['id', 'uid', 'created']],
+                       pd.DataFrame({'chgset': tags.chgset.values,
+                                     'tagvalue': tagvalues[
+                                         tags.tagvalue.values]}))
+
+def user_aggregates(changesets, tags):
+    """Aggregate changesets, sorted by id, by user: number of changesets,
+    first and last changeset creation dates, and number of changesets by
+    editor (tag values)
+
+    Returns
+    -------
+    tuple
+        user table ('uid', 'n_chgset', 'first_at', 'last_at'), editor table
+    ('uid', 'value', 'num')
+
+    """
+    users = (changesets.groupby('uid')['created']
+             .agg(['size', 'min', 'max'])
+             .rename(columns={'size': 'n_chgset', 'min': 'first_at',
+                              'max': 'last_at'})
+             .reset_index())
+    positions = np.searchsorted(changesets.id.values, tags.chgset.values)
+    editors = (pd.DataFrame({'uid': changesets.uid.values[positions],
+                             'value': np.asarray(tags.tagvalue.values,
+                                                 dtype=object)})
+               .groupby(['uid', 'value']).size()
+               .rename('num')
+               .reset_index())
+    return users, editors
+
+def aggregate_changesets(source, last_id=-1):
+    """Aggregate the changesets of a source (see iter_user_tables) by user,
+    keeping only the changesets whose id is greater than last_id, this bound
+    being raised after each chunk, so as each changeset is counted once
+
+    Returns
+    -------
+    tuple
+        user table, editor table (see user_aggregates), sorted by uid, last
+    aggregated changeset id
+
+    """
+    users = [pd.DataFrame({'uid': np.array([], dtype=np.int64),
+                           'n_chgset': np.array([], dtype=np.int64),
+                           'first_at': np.array([], dtype='datetime64[ns]'),
+                           'last_at': np.array([], dtype='datetime64[ns]')},
+                          columns=USER_INDEX_COLUMNS)]
+    editors = [pd.DataFrame({'uid': np.array([], dtype=np.int64),
+                             'value': np.array([], dtype=object),
+                             'num': np.array([], dtype=np.int64)},
+                            columns=['uid', 'value', 'num'])]
+    for changesets, tags in iter_user_tables(source):
+        changesets = changesets[changesets.id.values > last_id]
+        tags = tags[tags.chgset.values > last_id]
+        if len(changesets) == 0:
+            continue
+        last_id = int(changesets.id.max())
+        partial_users, partial_editors = user_aggregates(changesets, tags)
+        users.append(partial_users)
+        editors.append(partial_editors)
+    return (*merge_user_tables(users, editors), last_id)
+
+def merge_user_tables(users, editors):
+    """Merge lists of user and editor tables (see user_aggregates) of disjoint
+    sets of changesets; the merged tables are sorted by uid
+    """
+    users = (pd.concat(users, ignore_index=True)
+             .groupby('uid')
+             .agg({'n_chgset': 'sum', 'first_at': 'min', 'last_at': 'max'})
+             .reset_index()
+             [USER_INDEX_COLUMNS])
+    editors = (pd.concat(editors, ignore_index=True)
+               .groupby(['uid', 'value'])['num'].sum()
+               .reset_index())
+    return users, editors
+
+def write_user_index(path, users, editors, last_id):
+    """Write the tables of a user index (see UserIndex) into an HDF5 file"""
+    tmppath = path + "-tmp"
+    with pd.HDFStore(tmppath, mode='w') as store:
+        store.put('users', users, format='fixed')
+        store.put('editors', editors, format='fixed')
+        store.put('state', pd.Series({'last_id': last_id}), format='fixed')
+    os.replace(tmppath, path)
+
+class UserIndex(object):
+    """Per-user changeset index: number of changesets, first and last
+    changeset creation dates, and editor usage ('created_by' tag values) of
+    each user, saved into an HDF5 file
+
+    The file contains the tables 'users' (uid, n_chgset, first_at, last_at)
+    and 'editors' (uid, value, num), both sorted by uid, and 'state', with the
+    last indexed changeset id. The index is built once from a changeset dump
+    or store (see UserIndex.build), then updated from new dumps or changeset
+    replication diffs (see UserIndex.update): only changesets whose id is
+    greater than the last indexed one are counted, so as changesets that
+    appear several times (e.g. when opened, then when closed) are counted
+    once; sources must thus come in id order, as dumps and replication diffs
+    do.
+
+    Users are looked up through a hash index of their uids, i.e. in constant
+    time per user.
+    """
+    def __init__(self, path):
+        """ Class default constructor, from a file written by UserIndex.build"""
+        self.path = path
+        self.load()
+
+    def __len__(self):
+        return len(self.users)
+
+    def load(self):
+        """Read the index tables, and index users by uid"""
+        with pd.HDFStore(self.path, mode='r') as store:
+            self.users = store.get('users').set_index('uid')
+            self.editors = store.get('editors')
+            self.last_id = int(store.get('state')['last_id'])
+        # Editor rows of each user, in the user order
+        self.editor_bounds = np.searchsorted(
+            self.editors.uid.values,
+            np.append(self.users.index.values, np.iinfo(np.int64).max))
+
+    @classmethod
+    def build(cls, source, path):
+        """Build the user index of a changeset source (see iter_user_tables),
+        saved at path
+        """
+        write_user_index(path, *aggregate_changesets(source))
+        return cls(path)
+
+    def update(self, source):
+        """Add the changesets of a source (see iter_user_tables) that are not
+        indexed yet to the index, saved in place; return the uids of the
+        updated users
+        """
+        users, editors, last_id = aggregate_changesets(source, self.last_id)
+        updated = users.uid.values
+        users, editors = merge_user_tables([self.users.reset_index(), users],
+                                           [self.editors, editors])
+        write_user_index(self.path, users, editors, last_id)
+        self.load()
+        return updated
+
+    def lookup(self, uids):
+        """Return the number of changesets, and the first and last changeset
+        creation dates of some users, indexed by uid (NaN for unknown users)
+        """
+        return self.users.reindex(uids)
+
+    def editor_usage(self, uids=None):
+        """Return the number of changesets of some users (all of them by
+        default) by editor, as an ('uid', 'value', 'num') table
+        """
+        if uids is None:
+            return self.editors
+        positions = self.users.index.get_indexer(uids)
+        positions = positions[positions >= 0]
+        rows = [np.arange(start, stop) for start, stop
+                in zip(self.editor_bounds[positions],
+                       self.editor_bounds[positions + 1])]
+        rows = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+        return self.editors.iloc[rows].reset_index(drop=True)
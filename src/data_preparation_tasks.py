@@ -3,7 +3,11 @@
 """ Luigi implementation for OSM data parsing and metadata extraction
 """
 
+import json
+from multiprocessing import Pool
+import os
 import os.path as osp
+import shutil
 
 import luigi
 from luigi.format import MixedUnicodeBytes, UTF8
@@ -21,11 +25,380 @@ import utils
 OUTPUT_DIR = 'output-extracts'
 
 
+def timeline_handler(columnar=False):
+    """Return the OSM history handler class, either the list-based one or the
+    columnar one
+    """
+    if columnar:
+        return osmparsing.ColumnarTimelineHandler
+    return osmparsing.TimelineHandler
+
+# Group of the element history chunks into their HDF5 files
+ELEMENTS_KEY = 'elements'
+# Node of the element histories that supersede the ones of the chunks, in
+# updated HDF5 files (see update_elements)
+DELTA_KEY = 'delta'
+# Maximal number of rows of an element history chunk
+ELEMENTS_CHUNKSIZE = 1000000
+# Explicit dtypes of the element history features
+ELEMENTS_DTYPES = {'id': np.int64, 'version': np.int32, 'visible': bool,
+                   'uid': np.int32, 'chgset': np.int64}
+
+def typed_elements(elements):
+    """Prepare an OSM element history (raw or enriched) for its storage:
+    element types are coded as int8 (see osmparsing.ELEM_CODES), the common
+    features get the ELEMENTS_DTYPES types, and timestamps are naive ones, at
+    the day resolution (as in the former CSV files)
+    """
+    ts = elements.ts
+    if ts.dt.tz is not None:
+        ts = ts.dt.tz_convert(None)
+    elem = (elements.elem.astype(str).map(osmparsing.ELEM_CODES)
+            .astype(np.int8))
+    return elements.astype(ELEMENTS_DTYPES).assign(elem=elem,
+                                                   ts=ts.dt.floor('D'))
+
+def write_elements(chunks, path):
+    """Write a sequence of OSM element history chunks into a typed HDF5 file,
+    each chunk being a fixed-format node (of ELEMENTS_CHUNKSIZE rows at most,
+    so as the file can be read chunk by chunk); the file is replaced only once
+    completely written
+
+    Parameters
+    ----------
+    chunks: list
+        history dataframes, with the same columns
+    path: str
+        path of the HDF5 file
+
+    """
+    tmppath = path + "-tmp"
+    with pd.HDFStore(tmppath, mode='w', complevel=5,
+                     complib='blosc') as store:
+        n = 0
+        for chunk in chunks:
+            for start in range(0, len(chunk), ELEMENTS_CHUNKSIZE):
+                store.put("{}/chunk{}".format(ELEMENTS_KEY, n),
+                          typed_elements(
+                              chunk.iloc[start:start+ELEMENTS_CHUNKSIZE]),
+                          format='fixed')
+                n += 1
+    os.replace(tmppath, path)
+
+def element_keys(elements):
+    """Return int64 keys of the (elem, id) pairs of a stored OSM element
+    history (element types being coded, see typed_elements), in the order of
+    the history
+    """
+    return elements.elem.values.astype(np.int64) * 2**48 + elements.id.values
+
+def merge_delta(chunks, delta):
+    """Merge the element histories of a delta (see update_elements) into the
+    stored chunks of an OSM element history: chunk rows of the delta elements
+    are dropped, and each delta element is inserted into the chunk of its
+    position, so as the history stays sorted by (elem, id, version)
+    """
+    delta_keys = element_keys(delta)
+    start = 0
+    for chunk in chunks:
+        chunk_keys = element_keys(chunk)
+        stop = np.searchsorted(delta_keys, chunk_keys[-1], side='right')
+        chunk = chunk[~np.in1d(chunk_keys, delta_keys)]
+        if stop > start:
+            chunk = pd.concat([chunk, delta.iloc[start:stop]])
+            chunk = chunk.iloc[np.lexsort((chunk.version.values,
+                                           chunk.id.values,
+                                           chunk.elem.values))]
+            start = stop
+        if len(chunk) > 0:
+            yield chunk
+    if start < len(delta):
+        yield delta.iloc[start:]
+
+def chunk_contains(store, node, keys):
+    """Return True if the element range of a stored chunk of OSM element
+    history contains one of the (sorted) element keys, by reading its first
+    and last rows only (chunks are sorted by (elem, id, version))
+    """
+    nb_rows = store.get_storer(node).shape[0]
+    first, last = element_keys(pd.concat([
+        store.select(node, start=0, stop=1),
+        store.select(node, start=nb_rows - 1, stop=nb_rows)]))
+    return (np.searchsorted(keys, last, side='right')
+            > np.searchsorted(keys, first, side='left'))
+
+def stored_chunks(store, key=ELEMENTS_KEY, keys=None):
+    """Yield the chunks of an OSM element history from an open HDF5 store,
+    with coded element types, merged with the delta of the history if any; if
+    (sorted) element keys are given, only the rows of these elements are
+    yielded, and only the chunks whose element range contains one of them are
+    read
+    """
+    if key not in store:
+        return
+    nb_chunks = store.get_node(key)._v_nchildren
+    nodes = ["{}/chunk{}".format(key, n) for n in range(nb_chunks)]
+    if keys is not None:
+        nodes = [node for node in nodes
+                 if chunk_contains(store, node, keys)]
+    chunks = (store.get(node) for node in nodes)
+    if keys is not None:
+        chunks = (chunk[np.in1d(element_keys(chunk), keys)]
+                  for chunk in chunks)
+        chunks = (chunk for chunk in chunks if len(chunk) > 0)
+    if key == ELEMENTS_KEY and DELTA_KEY in store:
+        delta = store.get(DELTA_KEY)
+        if keys is not None:
+            delta = delta[np.in1d(element_keys(delta), keys)]
+        chunks = merge_delta(chunks, delta)
+    for chunk in chunks:
+        yield chunk
+
+def iter_elements(path, key=ELEMENTS_KEY):
+    """Yield the chunks of an OSM element history written by write_elements
+    (and updated by update_elements), or of a partition written by
+    partition_elements, with element types as strings
+    """
+    elem_types = np.array(osmparsing.ELEM_TYPES, dtype=object)
+    with pd.HDFStore(path, mode='r') as store:
+        for chunk in stored_chunks(store, key):
+            chunk['elem'] = elem_types[chunk.elem.values]
+            yield chunk
+
+def read_elements(path, key=ELEMENTS_KEY):
+    """Read an OSM element history written by write_elements (or a partition
+    written by partition_elements), with element types as strings; return None
+    if there is no such history
+    """
+    chunks = list(iter_elements(path, key))
+    if not chunks:
+        return None
+    return pd.concat(chunks)
+
+def read_element_histories(path, elements):
+    """Read the whole history of some elements from an OSM element history
+    written by write_elements (and updated by update_elements), reading only
+    the chunks that may contain them; return None if there is no such history
+
+    Parameters
+    ----------
+    path: str
+        path of the HDF5 file
+    elements: pd.DataFrame
+        (elem, id) keys of the elements, with element types as strings
+
+    """
+    keys = np.unique(element_keys(elements.assign(
+        elem=elements.elem.astype(str).map(osmparsing.ELEM_CODES))))
+    elem_types = np.array(osmparsing.ELEM_TYPES, dtype=object)
+    with pd.HDFStore(path, mode='r') as store:
+        chunks = list(stored_chunks(store, keys=keys))
+    if not chunks:
+        return None
+    histories = pd.concat(chunks)
+    histories['elem'] = elem_types[histories.elem.values]
+    return histories
+
+def update_elements(path, elements):
+    """Replace the whole history of some elements in an OSM element history
+    written by write_elements, without rewriting it: the new histories are
+    stored in the delta node of the file, that supersedes the chunks when
+    they are read (see iter_elements); the former delta histories of the
+    other elements are kept
+
+    An update hence costs the size of the delta, whatever the size of the
+    history; the delta is only merged into the chunks when the history is
+    written again.
+
+    Parameters
+    ----------
+    path: str
+        path of the HDF5 file
+    elements: pd.DataFrame
+        whole history of the updated elements, with the same columns as the
+    stored history
+
+    """
+    elements = typed_elements(elements)
+    with pd.HDFStore(path, mode='a', complevel=5, complib='blosc') as store:
+        if DELTA_KEY in store:
+            delta = store.get(DELTA_KEY)
+            elements = pd.concat([
+                delta[~np.in1d(element_keys(delta), element_keys(elements))],
+                elements])
+        elements = elements.iloc[np.lexsort((elements.version.values,
+                                             elements.id.values,
+                                             elements.elem.values))]
+        store.put(DELTA_KEY, elements, format='fixed')
+
+def element_shards(chunks):
+    """Regroup the chunks of an OSM element history sorted by (elem, id,
+    version) so as each element lies in a single shard: the rows of the last
+    element of a chunk are carried over to the next shard
+    """
+    carried = None
+    for chunk in chunks:
+        if carried is not None:
+            chunk = pd.concat([carried, chunk])
+        elem, elem_id = chunk.elem.values[-1], chunk.id.values[-1]
+        last_element = ((chunk.elem.values == elem)
+                        & (chunk.id.values == elem_id))
+        carried = chunk[last_element]
+        if not last_element.all():
+            yield chunk[~last_element]
+    if carried is not None:
+        yield carried
+
+def partition_elements(chunks, key, nb_partitions, path):
+    """Split the chunks of an OSM element history into nb_partitions
+    partitions, according to a hash of the key feature (e.g. 'uid' or
+    'chgset'), and write them into an HDF5 file (one group per partition,
+    readable with read_elements); return the last timestamp of the history
+
+    Parameters
+    ----------
+    chunks: list
+        history dataframes
+    key: str
+        partitioning feature; its values must be integers
+    nb_partitions: int
+        number of partitions
+    path: str
+        path of the HDF5 file
+
+    """
+    extraction_date = None
+    counts = np.zeros(nb_partitions, dtype=np.int64)
+    with pd.HDFStore(path, mode='w', complevel=5, complib='blosc') as store:
+        for chunk in chunks:
+            last_ts = chunk.ts.max()
+            if extraction_date is None or last_ts > extraction_date:
+                extraction_date = last_ts
+            partition_ids = chunk[key].values % nb_partitions
+            for partition in np.unique(partition_ids):
+                store.put("partition{}/chunk{}".format(partition,
+                                                       counts[partition]),
+                          typed_elements(chunk[partition_ids == partition]),
+                          format='fixed')
+                counts[partition] += 1
+    return extraction_date
+
+def write_mapped_elements(elements, path):
+    """Write an OSM element history as a directory of raw numpy column files
+    (one .npy file per column, plus the index one), typed as by
+    typed_elements; the directory is created only once completely written
+
+    Parameters
+    ----------
+    elements: pd.DataFrame
+        OSM history data (raw or enriched)
+    path: str
+        path of the directory
+
+    """
+    tmppath = path + "-tmp"
+    if osp.isdir(tmppath):
+        shutil.rmtree(tmppath)
+    os.makedirs(tmppath)
+    elements = typed_elements(elements)
+    np.save(osp.join(tmppath, "index.npy"), elements.index.values)
+    for column in elements.columns:
+        np.save(osp.join(tmppath, column + ".npy"), elements[column].values)
+    with open(osp.join(tmppath, "columns.json"), 'w') as fobj:
+        json.dump(list(elements.columns), fobj)
+    os.rename(tmppath, path)
+
+def read_mapped_elements(path, columns=None):
+    """Open an OSM element history written by write_mapped_elements, as a
+    dataframe whose columns are read-only memory maps of the column files
+
+    The columns are not copied into the process memory, hence several tasks
+    that open the same history share a single copy of it, through the OS page
+    cache. Only the element types are materialized, as strings.
+
+    Parameters
+    ----------
+    path: str
+        path of the directory
+    columns: list
+        columns to open (all of them by default)
+
+    """
+    if columns is None:
+        with open(osp.join(path, "columns.json")) as fobj:
+            columns = json.load(fobj)
+    index = np.load(osp.join(path, "index.npy"), mmap_mode='r')
+    data = {column: np.load(osp.join(path, column + ".npy"), mmap_mode='r')
+            for column in columns}
+    if 'elem' in data:
+        elem_types = np.array(osmparsing.ELEM_TYPES, dtype=object)
+        data['elem'] = elem_types[data['elem']]
+    return pd.DataFrame(data, index=pd.Index(index, copy=False),
+                        columns=columns, copy=False)
+
+def write_history(elements, path):
+    """Sort the OSM element history and write it into path"""
+    elements = elements.sort_values(by=['elem', 'id', 'version'])
+    write_elements([elements], path)
+
+def write_tag_genome(tag_genome, outputflow):
+    """Sort the OSM tag genome and write it into outputflow"""
+    tag_genome = tag_genome.sort_values(['elem', 'id', 'version'],
+                                        ascending=False)
+    tag_genome.to_csv(outputflow)
+
+STREAMING_HANDLERS = {'history': osmparsing.StreamingTimelineHandler,
+                      'taggenome': osmparsing.StreamingTagGenomeHandler}
+
+def stream_extracts(datapath, chunkpaths, chunksize):
+    """Parse an OSM history file with streaming handlers, that flush their
+    chunks into on-disk chunk stores; return the stores indexed by extract
+    name ('history' or 'taggenome')
+
+    Parameters
+    ----------
+    datapath: str
+        path to the .osh.pbf file
+    chunkpaths: dict
+        paths of the chunk stores, indexed by extract name
+    chunksize: int
+        number of rows of each flushed chunk
+
+    """
+    stores = {name: osmparsing.ChunkStore(path)
+              for name, path in chunkpaths.items()}
+    handlers = {name: STREAMING_HANDLERS[name](stores[name].append, chunksize)
+                for name in chunkpaths}
+    osmparsing.MultiExtractHandler(**handlers).apply_file(datapath)
+    for handler in handlers.values():
+        handler.flush_chunk()
+    return stores
+
+def write_chunks(chunks, outputflow, **kwargs):
+    """Write a sequence of dataframe chunks into outputflow, as a single CSV
+    file
+    """
+    header = True
+    for chunk in chunks:
+        chunk.to_csv(outputflow, header=header, **kwargs)
+        header = False
+
+
 class OSMTagParsing(luigi.Task):
     """ Luigi task : parse OSM tag genome from a .pbf file
+
+    If 'single_pass' is set, the tag genome is extracted by
+    OSMSinglePassParsing, together with the element history. If 'processes'
+    is greater than 1, the file is parsed by as many processes. If 'streaming'
+    is set, the tag genome is flushed to disk by chunks of 'chunksize' tags
+    during the parsing, hence with a bounded memory footprint.
     """
     datarep = luigi.Parameter("data")
     dsname = luigi.Parameter("bordeaux-metropole")
+    single_pass = luigi.BoolParameter(default=False)
+    processes = luigi.IntParameter(default=1)
+    streaming = luigi.BoolParameter(default=False)
+    chunksize = luigi.IntParameter(default=1000000)
 
     def outputpath(self):
         return osp.join(self.datarep, OUTPUT_DIR, self.dsname, "tag-genome.csv")
@@ -33,63 +406,434 @@ class OSMTagParsing(luigi.Task):
     def output(self):
         return luigi.LocalTarget(self.outputpath())
 
+    def requires(self):
+        if self.single_pass:
+            return OSMSinglePassParsing(self.datarep, self.dsname,
+                                        processes=self.processes,
+                                        streaming=self.streaming,
+                                        chunksize=self.chunksize)
+
     def run(self):
-        taghandler = osmparsing.TagGenomeHandler()
+        if self.single_pass:
+            # The tag genome has already been written by the required task
+            return
         datapath = osp.join(self.datarep, "raw", self.dsname+".osh.pbf")
-        taghandler.apply_file(datapath)
-        tag_genome = pd.DataFrame(taghandler.taggenome)
-        tag_genome.columns = ['elem', 'id', 'version', 'tagkey', 'tagvalue']
-        tag_genome = tag_genome.sort_values(['elem', 'id', 'version'],
-                                            ascending=False)
+        if self.streaming:
+            self.output().makedirs()
+            store = stream_extracts(datapath,
+                                    {'taggenome': self.outputpath() + ".h5"},
+                                    self.chunksize)['taggenome']
+            with self.output().open('w') as outputflow:
+                write_chunks(store.chunks(ascending=False),
+                             outputflow)
+            store.remove()
+            return
+        extracts = osmparsing.apply_handlers(
+            datapath, self.processes, taggenome=osmparsing.TagGenomeHandler)
         with self.output().open('w') as outputflow:
-            tag_genome.to_csv(outputflow)
+            write_tag_genome(extracts['taggenome'], outputflow)
+
+class OSMEncodedTagParsing(luigi.Task):
+    """ Luigi task : parse OSM tag genome from a .pbf file, with
+    dictionary-encoded tag keys and values
+
+    The genome is saved as integer codes into an HDF5 file, together with the
+    tag key and tag value dictionaries.
+    """
+    datarep = luigi.Parameter("data")
+    dsname = luigi.Parameter("bordeaux-metropole")
+
+    def outputpath(self):
+        return osp.join(self.datarep, OUTPUT_DIR, self.dsname, "tag-genome.h5")
+
+    def output(self):
+        return luigi.LocalTarget(self.outputpath(), format=MixedUnicodeBytes)
+
+    def run(self):
+        datapath = osp.join(self.datarep, "raw", self.dsname+".osh.pbf")
+        extracts = osmparsing.apply_handlers(
+            datapath, taggenome=osmparsing.EncodedTagGenomeHandler)
+        self.output().makedirs()
+        osmparsing.save_encoded_genome(extracts['taggenome'],
+                                       self.output().path)
+
+class OSMTagDiffParsing(luigi.Task):
+    """ Luigi task : parse OSM tag change events from a .pbf file, i.e. the
+    tags added, modified or removed by each element version (see
+    osmparsing.TagDiffHandler)
+
+    The events are saved as integer codes into an HDF5 file, together with
+    the tag key and tag value dictionaries.
+    """
+    datarep = luigi.Parameter("data")
+    dsname = luigi.Parameter("bordeaux-metropole")
+
+    def outputpath(self):
+        return osp.join(self.datarep, OUTPUT_DIR, self.dsname, "tag-diff.h5")
+
+    def output(self):
+        return luigi.LocalTarget(self.outputpath(), format=MixedUnicodeBytes)
+
+    def run(self):
+        datapath = osp.join(self.datarep, "raw", self.dsname+".osh.pbf")
+        extracts = osmparsing.apply_handlers(
+            datapath, tagdiff=osmparsing.TagDiffHandler)
+        self.output().makedirs()
+        osmparsing.save_tag_diff(extracts['tagdiff'], self.output().path)
 
 class OSMHistoryParsing(luigi.Task):
     """ Luigi task : parse OSM data history from a .pbf file
+
+    If 'columnar' is set, the history is gathered into typed arrays instead of
+    Python lists, so as to reduce the memory footprint of the parsing. If
+    'single_pass' is set, the history is extracted by OSMSinglePassParsing,
+    together with the tag genome. If 'processes' is greater than 1, the file
+    is parsed by as many processes. If 'streaming' is set, the history is
+    flushed to disk by chunks of 'chunksize' versions during the parsing,
+    hence with a bounded memory footprint (the history is then necessarily
+    columnar). If 'geometry' is set, node coordinates and way/relation members
+    are captured during the same pass, and saved in the companion file
+    'element-geometry.npz' (see osmparsing.GeometryHandler); the output is
+    then a dictionary of both targets ('history' and 'geometry'). This pass is
+    serial and in memory, hence 'geometry' cannot be combined with
+    'single_pass', 'streaming' or several processes.
+
+    The history is stored as a typed HDF5 file (see write_elements), to be
+    loaded by the following tasks without any text parsing.
     """
     datarep = luigi.Parameter("data")
     dsname = luigi.Parameter("bordeaux-metropole")
+    columnar = luigi.BoolParameter(default=False)
+    single_pass = luigi.BoolParameter(default=False)
+    processes = luigi.IntParameter(default=1)
+    streaming = luigi.BoolParameter(default=False)
+    chunksize = luigi.IntParameter(default=1000000)
+    geometry = luigi.BoolParameter(default=False)
 
     def outputpath(self):
-        return osp.join(self.datarep, OUTPUT_DIR, self.dsname, "element.csv")
+        return osp.join(self.datarep, OUTPUT_DIR, self.dsname, "element.h5")
+
+    def geometrypath(self):
+        return osp.join(self.datarep, OUTPUT_DIR, self.dsname,
+                        "element-geometry.npz")
+
+    def output(self):
+        history = luigi.LocalTarget(self.outputpath(),
+                                    format=MixedUnicodeBytes)
+        if self.geometry:
+            return {'history': history,
+                    'geometry': luigi.LocalTarget(self.geometrypath(),
+                                                  format=MixedUnicodeBytes)}
+        return history
+
+    def requires(self):
+        if self.geometry and (self.single_pass or self.streaming
+                              or self.processes > 1):
+            raise ValueError("Geometry is captured by a serial in-memory "
+                             "pass; it cannot be combined with single_pass, "
+                             "streaming or processes > 1")
+        if self.single_pass:
+            return OSMSinglePassParsing(self.datarep, self.dsname,
+                                        self.columnar, self.processes,
+                                        self.streaming, self.chunksize)
+
+    def run(self):
+        if self.single_pass:
+            # The history has already been written by the required task
+            return
+        datapath = osp.join(self.datarep, "raw", self.dsname+".osh.pbf")
+        if self.streaming:
+            self.output().makedirs()
+            store = stream_extracts(datapath,
+                                    {'history': self.outputpath() + "-chunks"},
+                                    self.chunksize)['history']
+            write_elements(store.chunks(), self.outputpath())
+            store.remove()
+            return
+        if self.geometry:
+            handlers = {'history': timeline_handler(self.columnar)(),
+                        'geometry': osmparsing.GeometryHandler()}
+            osmparsing.MultiExtractHandler(**handlers).apply_file(datapath)
+            # The geometry is saved first, so as the history existence
+            # implies the geometry one
+            self.output()['history'].makedirs()
+            handlers['geometry'].save(self.geometrypath())
+            write_history(handlers['history'].to_dataframe(),
+                          self.outputpath())
+            return
+        extracts = osmparsing.apply_handlers(
+            datapath, self.processes, history=timeline_handler(self.columnar))
+        self.output().makedirs()
+        write_history(extracts['history'], self.outputpath())
+
+class OSMSinglePassParsing(luigi.Task):
+    """ Luigi task : parse OSM data history and OSM tag genome from a .pbf
+    file, with a single pass over the file
+
+    The outputs are the ones of OSMHistoryParsing and OSMTagParsing; the
+    history is written last, so as none of them is considered as complete if
+    the parsing fails.
+    """
+    datarep = luigi.Parameter("data")
+    dsname = luigi.Parameter("bordeaux-metropole")
+    columnar = luigi.BoolParameter(default=False)
+    processes = luigi.IntParameter(default=1)
+    streaming = luigi.BoolParameter(default=False)
+    chunksize = luigi.IntParameter(default=1000000)
+
+    def output(self):
+        return {'history': OSMHistoryParsing(self.datarep, self.dsname).output(),
+                'taggenome': OSMTagParsing(self.datarep, self.dsname).output()}
+
+    def run(self):
+        datapath = osp.join(self.datarep, "raw", self.dsname+".osh.pbf")
+        if self.streaming:
+            self.output()['history'].makedirs()
+            stores = stream_extracts(
+                datapath,
+                {name: target.path + "-chunks"
+                 for name, target in self.output().items()},
+                self.chunksize)
+            with self.output()['taggenome'].open('w') as genomeflow:
+                write_chunks(stores['taggenome'].chunks(ascending=False),
+                             genomeflow)
+            write_elements(stores['history'].chunks(),
+                           self.output()['history'].path)
+            for store in stores.values():
+                store.remove()
+            return
+        extracts = osmparsing.apply_handlers(
+            datapath, self.processes,
+            history=timeline_handler(self.columnar),
+            taggenome=osmparsing.TagGenomeHandler)
+        with self.output()['taggenome'].open('w') as genomeflow:
+            write_tag_genome(extracts['taggenome'], genomeflow)
+        write_history(extracts['history'], self.output()['history'].path)
+
+class OSMMultiAreaParsing(luigi.Task):
+    """ Luigi task : parse the OSM data history of several areas from a single
+    (larger) .pbf file, with a single pass over the file
+
+    The areas are described in the JSON file '<datarep>/raw/<areas>.json', that
+    maps each area name to a bounding box ({"bbox": [minlon, minlat, maxlon,
+    maxlat]}) or a polygon ({"polygon": [[lon, lat], ...]}). The history of
+    each area is written as the OSMHistoryParsing output of the dataset named
+    after the area.
+    """
+    datarep = luigi.Parameter("data")
+    dsname = luigi.Parameter("france")
+    areas = luigi.Parameter("areas")
+
+    def regions(self):
+        with open(osp.join(self.datarep, "raw", self.areas+".json")) as fobj:
+            areas = json.load(fobj)
+        return {name: (osmparsing.Region.from_bbox(*area['bbox'])
+                       if 'bbox' in area
+                       else osmparsing.Region(area['polygon']))
+                for name, area in areas.items()}
+
+    def output(self):
+        return {name: OSMHistoryParsing(self.datarep, name).output()
+                for name in self.regions()}
+
+    def run(self):
+        handler = osmparsing.RegionTimelineHandler(self.regions())
+        datapath = osp.join(self.datarep, "raw", self.dsname+".osh.pbf")
+        handler.apply_file(datapath)
+        for name, elements in handler.to_dataframes().items():
+            self.output()[name].makedirs()
+            write_history(elements, self.output()[name].path)
+
+class OSMParallelParsingCheck(luigi.Task):
+    """ Luigi task : check that the parallel parsing of a .pbf file gives the
+    same element history and tag genome than the serial parsing
+
+    The task fails if any extract differs; otherwise it writes a summary of
+    the comparison.
+    """
+    datarep = luigi.Parameter("data")
+    dsname = luigi.Parameter("bordeaux-metropole")
+    columnar = luigi.BoolParameter(default=False)
+    processes = luigi.IntParameter(default=2)
+
+    def outputpath(self):
+        return osp.join(self.datarep, OUTPUT_DIR, self.dsname,
+                        "parallel-parsing-check.csv")
 
     def output(self):
         return luigi.LocalTarget(self.outputpath())
 
     def run(self):
-        tlhandler = osmparsing.TimelineHandler()
         datapath = osp.join(self.datarep, "raw", self.dsname+".osh.pbf")
-        tlhandler.apply_file(datapath)
-        colnames = ['elem', 'id', 'version', 'visible', 'ts',
-                    'uid', 'chgset']
-        elements = pd.DataFrame(tlhandler.elemtimeline, columns=colnames)
-        elements = elements.sort_values(by=['elem', 'id', 'version'])
+        handler_types = {'history': timeline_handler(self.columnar),
+                         'taggenome': osmparsing.TagGenomeHandler}
+        serial = osmparsing.apply_handlers(datapath, 1, **handler_types)
+        parallel = osmparsing.apply_handlers(datapath, self.processes,
+                                             **handler_types)
+        sort_keys = ['elem', 'id', 'version']
+        summary = pd.DataFrame(
+            [[name, len(serial[name]), len(parallel[name]),
+              serial[name].sort_values(sort_keys)
+              .equals(parallel[name].sort_values(sort_keys))]
+             for name in handler_types],
+            columns=['extract', 'n_serial', 'n_parallel', 'identical'])
+        if not summary.identical.all():
+            raise ValueError("Parallel parsing with {} workers differs from "
+                             "serial parsing:\n{}"
+                             .format(self.processes, summary))
         with self.output().open('w') as outputflow:
-            elements.to_csv(outputflow, date_format='%Y-%m-%d')
+            summary.to_csv(outputflow, index=False)
+
+def enriched_shards(shards, workers=1):
+    """Enrich a sequence of OSM element history shards, where each element lies
+    in a single shard (see element_shards), possibly within a process pool;
+    yield the enriched shards, indexed as a single enriched history
+
+    The 'willbe_corr' and 'willbe_autocorr' features of the last row of a
+    shard depend on the first row of the next one (see enrich_osm_elements),
+    hence each enriched shard is only yielded once the next one is known.
+    """
+    pool = Pool(workers) if workers > 1 else None
+    enriched = (pool.imap(utils.enrich_osm_elements, shards) if pool
+                else map(utils.enrich_osm_elements, shards))
+    previous = None
+    nb_rows = 0
+    try:
+        for shard in enriched:
+            shard.index += nb_rows
+            nb_rows += len(shard)
+            if previous is not None:
+                same_id = previous.id.values[-1] == shard.id.values[0]
+                same_uid = previous.uid.values[-1] == shard.uid.values[0]
+                last = previous.index[-1]
+                previous.loc[last, 'willbe_corr'] = same_id and not same_uid
+                previous.loc[last, 'willbe_autocorr'] = same_id and same_uid
+                yield previous
+            previous = shard
+        if previous is not None:
+            yield previous
+    finally:
+        if pool:
+            pool.terminate()
 
 class OSMElementEnrichment(luigi.Task):
     """ Luigi task: building of new features for OSM element history
+
+    If 'partitioned' is set, the history is enriched shard by shard (each
+    shard gathering the whole history of a range of elements), without loading
+    it entirely into memory; shards are enriched by 'processes' processes.
     """
     datarep = luigi.Parameter("data")
     dsname = luigi.Parameter("bordeaux-metropole")
+    partitioned = luigi.BoolParameter(default=False)
+    processes = luigi.IntParameter(default=1)
 
     def outputpath(self):
         return osp.join(self.datarep, OUTPUT_DIR, self.dsname,
-                        "enriched-element.csv")
+                        "enriched-element.h5")
 
     def output(self):
-        return luigi.LocalTarget(self.outputpath())
+        return luigi.LocalTarget(self.outputpath(), format=MixedUnicodeBytes)
 
     def requires(self):
         return OSMHistoryParsing(self.datarep, self.dsname)
 
     def run(self):
-        with self.input().open('r') as inputflow:
-            osm_elements = pd.read_csv(inputflow,
-                                       index_col=0,
-                                       parse_dates=['ts'])
+        if self.partitioned:
+            shards = element_shards(iter_elements(self.input().path))
+            write_elements(enriched_shards(shards, self.processes),
+                           self.outputpath())
+            return
+        osm_elements = read_elements(self.input().path)
         osm_elements.sort_values(by=['elem','id','version'])
         osm_elements = utils.enrich_osm_elements(osm_elements)
-        with self.output().open('w') as outputflow:
-            osm_elements.to_csv(outputflow, date_format='%Y-%m-%d')
+        write_elements([osm_elements], self.outputpath())
+
+
+class OSMMappedEnrichment(luigi.Task):
+    """ Luigi task: store the enriched OSM element history as memory-mappable
+    column files (see write_mapped_elements), so as the tasks that run
+    simultaneously on the same host share it instead of loading their own copy
+    """
+    datarep = luigi.Parameter("data")
+    dsname = luigi.Parameter("bordeaux-metropole")
+
+    def outputpath(self):
+        return osp.join(self.datarep, OUTPUT_DIR, self.dsname,
+                        "enriched-element-columns")
 
+    def output(self):
+        return luigi.LocalTarget(self.outputpath())
+
+    def requires(self):
+        return OSMElementEnrichment(self.datarep, self.dsname)
+
+    def run(self):
+        write_mapped_elements(read_elements(self.input().path),
+                              self.outputpath())
+
+
+class OSMHistoryUpdate(luigi.Task):
+    """ Luigi task: apply OSM change files (.osc) to the element history and
+    to the enriched history, without parsing the whole history again
+
+    Only the histories of the elements that get new versions are read (from
+    the chunks that contain them), and only their enrichment features are
+    recomputed; both files are updated in place, by storing these histories
+    in their delta node (see update_elements), hence without rewriting them.
+    The output lists the users and change sets whose metadata are now dirty.
+    'changefiles' are given relatively to the raw data directory, 'label'
+    names the update (e.g. the replication date).
+
+    As the files are updated in place, Luigi still considers the tasks that
+    derive from them as complete: change set and user metadata are refreshed
+    by MetadataUpdate, and the memory-mapped copy of the enriched history is
+    removed, but the other outputs that derive from the history (e.g. the
+    chronology, the tag cube, the element metadata) must be removed so as to
+    be rebuilt. The outputs parsed from the .osh.pbf file (tag genome, tag
+    changes, streaming tag cube, element geometry) do not see the change
+    files at all; they stay as of the history file.
+    """
+    datarep = luigi.Parameter("data")
+    dsname = luigi.Parameter("bordeaux-metropole")
+    changefiles = luigi.ListParameter()
+    label = luigi.Parameter()
+
+    def outputpath(self):
+        return osp.join(self.datarep, OUTPUT_DIR, self.dsname, "updates",
+                        "dirty-metadata-" + self.label + ".csv")
+
+    def output(self):
+        return luigi.LocalTarget(self.outputpath())
+
+    def requires(self):
+        return {'history': OSMHistoryParsing(self.datarep, self.dsname),
+                'enrichhist': OSMElementEnrichment(self.datarep, self.dsname)}
+
+    def run(self):
+        changes = pd.concat([
+            osmparsing.apply_handlers(
+                osp.join(self.datarep, "raw", changefile),
+                history=osmparsing.ColumnarTimelineHandler)['history']
+            for changefile in self.changefiles], ignore_index=True)
+        # Every element of the change files is considered as touched, so as
+        # the update can be applied again if it fails (already known versions
+        # are skipped); the enriched history is updated first for the same
+        # reason
+        touched = (changes[['elem', 'id']].drop_duplicates()
+                   .assign(elem=lambda df: df.elem.astype(str)))
+        osm_elements = read_element_histories(self.input()['history'].path,
+                                              touched)
+        if osm_elements is None:
+            osm_elements = changes.iloc[:0]
+        osm_elements, _ = utils.append_osm_changes(osm_elements, changes)
+        enriched_elements = utils.enrich_osm_elements(osm_elements)
+        update_elements(self.input()['enrichhist'].path, enriched_elements)
+        update_elements(self.input()['history'].path, osm_elements)
+        # The memory-mapped copy of the enriched history is now outdated
+        mappedpath = OSMMappedEnrichment(self.datarep, self.dsname).outputpath()
+        if osp.isdir(mappedpath):
+            shutil.rmtree(mappedpath)
+        with self.output().open('w') as outputflow:
+            utils.dirty_metadata(enriched_elements, touched).to_csv(
+                outputflow, index=False)
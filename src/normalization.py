@@ -0,0 +1,139 @@
+# coding: utf-8
+
+"""Vectorized normalization of OSM metadata, so as to apply PCA and KMeans
+
+Metadata are normalized following a plan, i.e. a list of steps
+(operation, feature, *arguments) run in order:
+
+- ('scale', feature, scale): divides the feature by the named scale (e.g. the
+  time horizon of the history);
+- ('ratio', pattern): expresses the features whose name contains the pattern
+  as shares of the first of them;
+- ('log1p', feature): applies f:x->log(1+x);
+- ('ecdf', feature[, name]): replaces the feature by its empirical cumulative
+  distribution function, renamed as 'u_...' by default.
+
+Normalized features are gathered into a single float32 matrix, and every step
+transforms whole columns of this matrix.
+"""
+
+import re
+
+import numpy as np
+
+
+# Plans of the user and change set metadata; temporal features are scaled by
+# the 'max_lifespan' and 'timehorizon' scales, expressed in their own units
+TEMPORAL_PLAN = [('scale', 'lifespan', 'max_lifespan'),
+                 ('scale', 'n_inscription_days', 'timehorizon'),
+                 ('ecdf', 'n_activity_days', 'n_activity_days')]
+USER_PLAN = TEMPORAL_PLAN + [
+    ('ratio', 'n_total_modif'),
+    ('ratio', 'n_node_modif'),
+    ('ratio', 'n_way_modif'),
+    ('ratio', 'n_relation_modif'),
+    ('ecdf', 'nmean_modif_byelem'),
+    ('ecdf', 'n_total_modif'),
+    ('ecdf', 'n_node_modif'),
+    ('ecdf', 'n_way_modif'),
+    ('ecdf', 'n_relation_modif'),
+    # Editor-related features
+    ('ratio', 'n_total_chgset'),
+    ('ecdf', 'n_chgset'),
+    ('ecdf', 'n_total_chgset')]
+CHGSET_PLAN = TEMPORAL_PLAN + [
+    ('log1p', 'user_lastchgset_h'),
+    ('ecdf', 'user_chgset_rank', 'u_user_chgset_rank'),
+    ('scale', 't10_update_d', 'timehorizon'),
+    ('scale', 't90_update_d', 'timehorizon'),
+    ('log1p', 'n10_modif_byelem'),
+    ('log1p', 'n90_modif_byelem'),
+    *[('ecdf', 'n_' + element_type + status)
+      for element_type in ['node', 'way', 'relation']
+      for status in ['_cr', '_imp', '_del']]]
+PLANS = {'user': USER_PLAN, 'changeset': CHGSET_PLAN}
+
+
+def scale(matrix, columns, factor):
+    """Divide the matrix columns by a scale factor"""
+    matrix[:, columns] /= factor
+
+def ratio(matrix, columns):
+    """Express the matrix columns as shares of the first one; shares of a null
+    total are null
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = matrix[:, columns[1:]] / matrix[:, columns[:1]]
+    shares[np.isnan(shares)] = 0
+    matrix[:, columns[1:]] = shares
+
+def log1p(matrix, columns):
+    """Apply f:x->log(1+x) on the matrix columns"""
+    matrix[:, columns] = np.log1p(matrix[:, columns])
+
+def ecdf(matrix, columns):
+    """Replace the matrix columns by their empirical cumulative distribution
+    function, i.e. the share of values lower or equal to each value
+    """
+    nb_rows = matrix.shape[0]
+    for column in columns:
+        values = matrix[:, column]
+        ranks = np.searchsorted(np.sort(values), values, side='right')
+        matrix[:, column] = ranks / nb_rows
+
+def plan_columns(features, step):
+    """Return the features concerned by a normalization step"""
+    operation, feature = step[:2]
+    if operation == 'ratio':
+        return [name for name in features if re.search(feature, name)]
+    return [feature] if feature in features else []
+
+def normalize_metadata(metadata, plan, dtype=np.float32, **scales):
+    """Normalize metadata features following a plan (see the module
+    documentation); features that are not in metadata are skipped
+
+    Parameters
+    ----------
+    metadata: pd.DataFrame
+        Metadata table
+    plan: list
+        normalization steps
+    dtype: np.dtype
+        type of the normalized features
+    scales: dict
+        scale factors of the 'scale' steps, by name
+
+    Return
+    ------
+    New metadata, with normalized (and possibly renamed) features
+
+    """
+    features = list(metadata.columns)
+    normalized = [name for name in features
+                  if any(name in plan_columns(features, step)
+                         for step in plan)]
+    matrix = metadata[normalized].values.astype(dtype)
+    positions = {name: position for position, name in enumerate(normalized)}
+    names = {}
+    for step in plan:
+        operation, feature, *arguments = step
+        columns = [positions[name] for name in plan_columns(features, step)]
+        if not columns:
+            continue
+        if operation == 'scale':
+            scale(matrix, columns, scales[arguments[0]])
+        elif operation == 'ratio':
+            ratio(matrix, columns)
+        elif operation == 'log1p':
+            log1p(matrix, columns)
+        elif operation == 'ecdf':
+            ecdf(matrix, columns)
+            names[feature] = (arguments[0] if arguments
+                              else 'u_' + feature.split('_', 1)[1])
+        else:
+            raise ValueError("Normalization operation '{}' not known"
+                             .format(operation))
+    metadata = metadata.copy()
+    for position, name in enumerate(normalized):
+        metadata[name] = matrix[:, position]
+    return metadata.rename(columns=names)
@@ -7,6 +7,13 @@ further investigations.
 
 """
 
+import array
+from multiprocessing import Pool
+import os
+import struct
+import warnings
+
+import numpy as np
 import pandas as pd
 import osmium as osm
 
@@ -14,6 +21,30 @@ import osmium as osm
 
 DEFAULT_START = pd.Timestamp("2000-01-01T00:00:00Z")
 
+# OSM element types, sorted in lexicographical order so as the element codes
+# are sorted in the same way than the element labels
+ELEM_TYPES = ['node', 'relation', 'way']
+ELEM_CODES = {elem: code for code, elem in enumerate(ELEM_TYPES)}
+
+# Timeline features, with their typecode (common to 'array' and 'numpy')
+TIMELINE_COLUMNS = [('elem', 'b'), ('id', 'q'), ('version', 'i'),
+                    ('visible', 'b'), ('ts', 'q'), ('uid', 'i'),
+                    ('chgset', 'q')]
+
+TAGGENOME_COLUMNS = ['elem', 'id', 'version', 'tagkey', 'tagvalue']
+
+# Dictionary-encoded tag genome features, with their typecode
+ENCODED_TAGGENOME_COLUMNS = [('elem', 'b'), ('id', 'q'), ('version', 'i'),
+                             ('tagkey', 'i'), ('tagvalue', 'i')]
+
+# Tag change events, sorted in lexicographical order (see ELEM_TYPES), and
+# dictionary-encoded tag diff features, with their typecode
+TAG_EVENTS = ['add', 'modify', 'remove']
+TAG_EVENT_CODES = {event: code for code, event in enumerate(TAG_EVENTS)}
+TAGDIFF_COLUMNS = [('elem', 'b'), ('id', 'q'), ('version', 'i'), ('ts', 'q'),
+                   ('uid', 'i'), ('chgset', 'q'), ('event', 'b'),
+                   ('tagkey', 'i'), ('oldvalue', 'i'), ('newvalue', 'i')]
+
 #####
 
 class TagGenomeHandler(osm.SimpleHandler):
@@ -47,6 +78,10 @@ class TagGenomeHandler(osm.SimpleHandler):
     def relation(self, r):
         self.tag_inventory(r, "relation")
 
+    def to_dataframe(self):
+        """Build the tag genome as a pandas DataFrame"""
+        return pd.DataFrame(self.taggenome, columns=TAGGENOME_COLUMNS)
+
 #####
         
 class TimelineHandler(osm.SimpleHandler):
@@ -120,3 +155,965 @@ class TimelineHandler(osm.SimpleHandler):
                                   pd.Timestamp(r.timestamp),
                                   r.uid,
                                   r.changeset])
+
+    def to_dataframe(self):
+        """Build the OSM element timeline as a pandas DataFrame"""
+        return pd.DataFrame(self.elemtimeline,
+                            columns=[name for name, _ in TIMELINE_COLUMNS])
+
+#####
+
+class ColumnarTimelineHandler(osm.SimpleHandler):
+    """Encapsulates the recovery of elements inside the OSM history, with a
+    columnar storage.
+
+    The recovered features are the same than the TimelineHandler ones, however
+    each feature is appended to a growable typed array instead of building a
+    list of Python objects for each OSM element version. Element types are
+    stored as integer codes (see ELEM_CODES) and timestamps as epoch seconds,
+    so as a version costs 34 bytes instead of a dozen of Python objects.
+
+    """
+    def __init__(self):
+        """ Class default constructor"""
+        osm.SimpleHandler.__init__(self)
+        self.elemtimeline = {name: array.array(typecode)
+                             for name, typecode in TIMELINE_COLUMNS}
+
+    def __len__(self):
+        return len(self.elemtimeline['id'])
+
+    def record(self, elem, elem_code):
+        """Append the features of an OSM element version to the feature
+        arrays: elem code, id, version, visible?, timestamp (in seconds),
+        userid, chgsetid
+
+        """
+        timeline = self.elemtimeline
+        timeline['elem'].append(elem_code)
+        timeline['id'].append(elem.id)
+        timeline['version'].append(elem.version)
+        timeline['visible'].append(elem.visible)
+        timeline['ts'].append(int(elem.timestamp.timestamp()))
+        timeline['uid'].append(elem.uid)
+        timeline['chgset'].append(elem.changeset)
+
+    def node(self, n):
+        self.record(n, ELEM_CODES['node'])
+
+    def way(self, w):
+        self.record(w, ELEM_CODES['way'])
+
+    def relation(self, r):
+        self.record(r, ELEM_CODES['relation'])
+
+    def to_dataframe(self):
+        """Build the OSM element timeline as a pandas DataFrame, on top of the
+        feature arrays
+
+        """
+        return timeline_dataframe(self.elemtimeline)
+
+def timeline_dataframe(columns):
+    """Build an OSM element timeline dataframe from typed feature arrays, as
+    filled by a ColumnarTimelineHandler; the arrays are read through the buffer
+    protocol, hence without any Python object creation
+
+    Parameters
+    ----------
+    columns: dict
+        typed arrays (or any buffer) indexed by feature names, see
+    TIMELINE_COLUMNS
+
+    """
+    data = {name: np.frombuffer(columns[name], dtype=typecode)
+            for name, typecode in TIMELINE_COLUMNS}
+    data['elem'] = pd.Categorical.from_codes(data['elem'], ELEM_TYPES)
+    data['visible'] = data['visible'].view(np.bool_)
+    data['ts'] = pd.to_datetime(data['ts'], unit='s')
+    return pd.DataFrame(data, columns=[name for name, _ in TIMELINE_COLUMNS])
+
+#####
+
+class MultiExtractHandler(osm.SimpleHandler):
+    """Encapsulates several extraction handlers, so as to fill all of them
+    with a single pass over the OSM history file.
+
+    Each OSM element is forwarded to every handler, that keep their own
+    storage. Handlers are identified by a name, and may be any object that
+    implements the 'node', 'way' and 'relation' callbacks (typically a
+    TimelineHandler and a TagGenomeHandler).
+
+    """
+    def __init__(self, **handlers):
+        """ Class default constructor"""
+        osm.SimpleHandler.__init__(self)
+        self.handlers = handlers
+        self.node_callbacks = [h.node for h in handlers.values()]
+        self.way_callbacks = [h.way for h in handlers.values()]
+        self.relation_callbacks = [h.relation for h in handlers.values()]
+
+    def __getitem__(self, name):
+        return self.handlers[name]
+
+    def node(self, n):
+        for callback in self.node_callbacks:
+            callback(n)
+
+    def way(self, w):
+        for callback in self.way_callbacks:
+            callback(w)
+
+    def relation(self, r):
+        for callback in self.relation_callbacks:
+            callback(r)
+
+#####
+
+def read_varint(buf, pos):
+    """Decode a protobuf varint starting at position pos in buf; return the
+    value and the position that follows it
+
+    """
+    value, shift = 0, 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def read_blob_header(buf):
+    """Decode a PBF BlobHeader message, and return the blob type ('OSMHeader'
+    or 'OSMData') as well as the size of the blob that follows the header
+
+    """
+    pos, blobtype, datasize = 0, None, None
+    while pos < len(buf):
+        key, pos = read_varint(buf, pos)
+        field, wiretype = key >> 3, key & 0x07
+        if wiretype == 0:
+            value, pos = read_varint(buf, pos)
+        elif wiretype == 2:
+            length, pos = read_varint(buf, pos)
+            value = buf[pos:pos+length]
+            pos += length
+        else:
+            raise ValueError("Unexpected wire type {} in PBF blob header"
+                             .format(wiretype))
+        if field == 1:
+            blobtype = value.decode('utf-8')
+        elif field == 3:
+            datasize = value
+    return blobtype, datasize
+
+def pbf_blobs(datapath):
+    """Scan a PBF file and yield its blobs as (type, offset, size) tuples,
+    without decoding them
+
+    """
+    offset = 0
+    with open(datapath, 'rb') as fobj:
+        while True:
+            rawsize = fobj.read(4)
+            if len(rawsize) < 4:
+                break
+            headersize = struct.unpack('!I', rawsize)[0]
+            blobtype, datasize = read_blob_header(fobj.read(headersize))
+            fobj.seek(datasize, 1)
+            size = 4 + headersize + datasize
+            yield blobtype, offset, size
+            offset += size
+
+def blob_ranges(datapath, nb_shards):
+    """Split the data blobs of a PBF file into nb_shards contiguous byte
+    ranges; return the bytes of the file header blob, and the list of (start,
+    stop) byte ranges
+
+    """
+    header = None
+    blobs = []
+    for blobtype, offset, size in pbf_blobs(datapath):
+        if blobtype == 'OSMHeader':
+            with open(datapath, 'rb') as fobj:
+                fobj.seek(offset)
+                header = fobj.read(size)
+        else:
+            blobs.append((offset, offset + size))
+    bounds = np.linspace(0, len(blobs), min(nb_shards, len(blobs)) + 1)
+    bounds = bounds.astype(int)
+    ranges = [(blobs[first][0], blobs[last-1][1])
+              for first, last in zip(bounds[:-1], bounds[1:])]
+    return header, ranges
+
+def apply_blob_range(datapath, header, start, stop, handler_types):
+    """Parse the blobs located between bytes start and stop of a PBF file,
+    with a new instance of each handler type; return the extracted dataframes
+    indexed by handler name
+
+    """
+    with open(datapath, 'rb') as fobj:
+        fobj.seek(start)
+        data = fobj.read(stop - start)
+    handler = MultiExtractHandler(**{name: handler_type()
+                                     for name, handler_type
+                                     in handler_types.items()})
+    handler.apply_buffer(header + data, 'osh.pbf')
+    return {name: h.to_dataframe() for name, h in handler.handlers.items()}
+
+def apply_handlers(datapath, workers=1, **handler_types):
+    """Parse an OSM history file with a set of handlers, and return the
+    dataframes they extract (indexed by handler name)
+
+    If workers is greater than 1, the data blobs of the file are split into
+    contiguous ranges, that are decoded in a process pool with their own
+    handlers. Partial results are concatenated in the file order, hence the
+    dataframes are the same than the ones produced by a serial parsing.
+
+    Parameters
+    ----------
+    datapath: str
+        path to the .osh.pbf file
+    workers: int
+        number of processes
+    handler_types: dict
+        handler classes indexed by name; each handler must implement a
+    'to_dataframe' method
+
+    """
+    if workers <= 1:
+        handlers = {name: handler_type()
+                    for name, handler_type in handler_types.items()}
+        if len(handlers) == 1:
+            next(iter(handlers.values())).apply_file(datapath)
+        else:
+            MultiExtractHandler(**handlers).apply_file(datapath)
+        return {name: h.to_dataframe() for name, h in handlers.items()}
+    # Several shards per worker, to balance the load between processes
+    header, ranges = blob_ranges(datapath, 4 * workers)
+    if not ranges:
+        return apply_handlers(datapath, 1, **handler_types)
+    with Pool(workers) as pool:
+        shards = pool.starmap(apply_blob_range,
+                              [(datapath, header, start, stop, handler_types)
+                               for start, stop in ranges])
+    return {name: pd.concat([shard[name] for shard in shards],
+                            ignore_index=True)
+            for name in handler_types}
+
+#####
+
+class StreamingTimelineHandler(ColumnarTimelineHandler):
+    """Columnar timeline handler that flushes its feature arrays as dataframe
+    chunks every 'chunksize' element versions, so as its memory footprint
+    does not depend on the history size.
+
+    Chunks are given to the 'flush' callable, with an index that continues
+    from one chunk to the next one (as if the whole history was in a single
+    dataframe). The last chunk must be flushed explicitly with 'flush_chunk'
+    once the file has been parsed.
+
+    """
+    def __init__(self, flush, chunksize=1000000):
+        """ Class default constructor"""
+        ColumnarTimelineHandler.__init__(self)
+        self.flush = flush
+        self.chunksize = chunksize
+        self.nb_flushed = 0
+
+    def record(self, elem, elem_code):
+        ColumnarTimelineHandler.record(self, elem, elem_code)
+        if len(self) >= self.chunksize:
+            self.flush_chunk()
+
+    def flush_chunk(self):
+        """Give the current chunk to the flush callable, and reset the feature
+        arrays
+        """
+        if len(self) == 0:
+            return
+        chunk = self.to_dataframe()
+        chunk.index = chunk.index + self.nb_flushed
+        self.nb_flushed += len(chunk)
+        self.flush(chunk)
+        self.elemtimeline = {name: array.array(typecode)
+                             for name, typecode in TIMELINE_COLUMNS}
+
+class StreamingTagGenomeHandler(TagGenomeHandler):
+    """Tag genome handler that flushes its tags as dataframe chunks every
+    'chunksize' tags, see StreamingTimelineHandler.
+
+    """
+    def __init__(self, flush, chunksize=1000000):
+        """ Class default constructor"""
+        TagGenomeHandler.__init__(self)
+        self.flush = flush
+        self.chunksize = chunksize
+        self.nb_flushed = 0
+
+    def tag_inventory(self, elem, elem_type):
+        TagGenomeHandler.tag_inventory(self, elem, elem_type)
+        if len(self.taggenome) >= self.chunksize:
+            self.flush_chunk()
+
+    def flush_chunk(self):
+        """Give the current chunk to the flush callable, and reset the tag
+        list
+        """
+        if len(self.taggenome) == 0:
+            return
+        chunk = self.to_dataframe()
+        chunk.index = chunk.index + self.nb_flushed
+        self.nb_flushed += len(chunk)
+        self.flush(chunk)
+        self.taggenome = []
+
+class ChunkStore(object):
+    """On-disk columnar store (HDF5) of the chunks flushed by a streaming
+    handler.
+
+    Chunks are split by element type, and each part is stored as its own HDF5
+    node. As osmium delivers history files sorted by type, id and version,
+    the parts of a given type are already sorted by (id, version): the store
+    checks it when appending, so as the full history can be read back sorted
+    by (elem, id, version), chunk by chunk, without any in-memory sort.
+
+    """
+    def __init__(self, path):
+        """ Class default constructor"""
+        self.path = path
+        self.store = pd.HDFStore(path, mode='w', complevel=5, complib='blosc')
+        self.last_keys = {}
+        self.nodes = {elem: [] for elem in ELEM_TYPES}
+
+    def append(self, chunk):
+        """Append a chunk of OSM history to the store"""
+        for elem in ELEM_TYPES:
+            group = chunk[chunk.elem == elem]
+            if len(group) == 0:
+                continue
+            ids = group.id.values
+            versions = group.version.values
+            if elem in self.last_keys:
+                ids = np.insert(ids, 0, self.last_keys[elem][0])
+                versions = np.insert(versions, 0, self.last_keys[elem][1])
+            id_diff = np.diff(ids)
+            if np.any(id_diff < 0) or np.any((id_diff == 0)
+                                             & (np.diff(versions) < 0)):
+                raise ValueError("{} history is not sorted by id and version; "
+                                 "please sort the file first (e.g. with "
+                                 "'osmium sort')".format(elem))
+            self.last_keys[elem] = (ids[-1], versions[-1])
+            # The element type is implied by the node name; tag keys and
+            # values are pickled by PyTables, which is fine for this
+            # write-once, read-once store
+            node = "{}/chunk{}".format(elem, len(self.nodes[elem]))
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', pd.errors.PerformanceWarning)
+                self.store.put(node, group.drop('elem', axis=1),
+                               format='fixed')
+            self.nodes[elem].append(node)
+
+    def chunks(self, ascending=True):
+        """Yield the stored history chunk by chunk, sorted by (elem, id,
+        version) in ascending or descending order
+        """
+        elem_types = ELEM_TYPES if ascending else ELEM_TYPES[::-1]
+        for elem in elem_types:
+            nodes = self.nodes[elem] if ascending else self.nodes[elem][::-1]
+            for node in nodes:
+                chunk = self.store.get(node)
+                if not ascending:
+                    chunk = chunk.iloc[::-1]
+                chunk.insert(0, 'elem',
+                             pd.Categorical.from_codes(
+                                 np.full(len(chunk), ELEM_CODES[elem], 'b'),
+                                 ELEM_TYPES))
+                yield chunk
+
+    def remove(self):
+        """Close the store and delete the underlying file"""
+        self.store.close()
+        os.remove(self.path)
+
+#####
+
+class EncodedTagGenomeHandler(osm.SimpleHandler):
+    """Encapsulates the recovery of tag genome history, with dictionary-encoded
+    tag keys and values.
+
+    Tag keys and values are interned into dictionaries during the parsing, so
+    as each tag is stored as a pair of integer codes in typed arrays, like the
+    ColumnarTimelineHandler features. The resulting dataframe describes keys
+    and values as pandas categoricals.
+
+    """
+    def __init__(self):
+        """ Class default constructor"""
+        osm.SimpleHandler.__init__(self)
+        self.tagkeys = {}
+        self.tagvalues = {}
+        self.taggenome = {name: array.array(typecode)
+                          for name, typecode in ENCODED_TAGGENOME_COLUMNS}
+
+    def tag_inventory(self, elem, elem_code):
+        genome = self.taggenome
+        for tag in elem.tags:
+            genome['elem'].append(elem_code)
+            genome['id'].append(elem.id)
+            genome['version'].append(elem.version)
+            genome['tagkey'].append(self.tagkeys.setdefault(tag.k,
+                                                            len(self.tagkeys)))
+            genome['tagvalue'].append(self.tagvalues.setdefault(
+                tag.v, len(self.tagvalues)))
+
+    def node(self, n):
+        self.tag_inventory(n, ELEM_CODES['node'])
+
+    def way(self, w):
+        self.tag_inventory(w, ELEM_CODES['way'])
+
+    def relation(self, r):
+        self.tag_inventory(r, ELEM_CODES['relation'])
+
+    def to_dataframe(self):
+        """Build the tag genome as a pandas DataFrame, with categorical element
+        types, tag keys and tag values
+        """
+        data = {name: np.frombuffer(self.taggenome[name], dtype=typecode)
+                for name, typecode in ENCODED_TAGGENOME_COLUMNS}
+        data['elem'] = pd.Categorical.from_codes(data['elem'], ELEM_TYPES)
+        data['tagkey'] = sorted_categorical(data['tagkey'], list(self.tagkeys))
+        data['tagvalue'] = sorted_categorical(data['tagvalue'],
+                                              list(self.tagvalues))
+        return pd.DataFrame(data, columns=TAGGENOME_COLUMNS)
+
+def sorted_categorical(codes, labels):
+    """Build a categorical from integer codes and the labels they refer to,
+    with categories sorted in lexicographical order (hence code order and
+    label order are the same); negative codes are missing values
+
+    Parameters
+    ----------
+    codes: np.array
+        integer codes, in the order of labels
+    labels: list
+        labels of each code
+
+    """
+    labels = np.array(labels, dtype=object)
+    order = np.argsort(labels, kind='mergesort')
+    recoding = np.empty(len(labels), dtype=np.int32)
+    recoding[order] = np.arange(len(labels), dtype=np.int32)
+    codes = np.asarray(codes)
+    if len(labels) == 0:
+        return pd.Categorical.from_codes(np.full(len(codes), -1, np.int32),
+                                         labels)
+    return pd.Categorical.from_codes(np.where(codes >= 0,
+                                              recoding[codes], -1),
+                                     labels[order])
+
+def save_encoded_genome(tag_genome, path):
+    """Save a tag genome with categorical features into an HDF5 file: integer
+    codes are stored in the 'genome' table, tag key and tag value
+    dictionaries in 'tagkeys' and 'tagvalues'
+
+    """
+    codes = pd.DataFrame({'elem': tag_genome.elem.cat.codes,
+                          'id': tag_genome.id,
+                          'version': tag_genome.version,
+                          'tagkey': tag_genome.tagkey.cat.codes,
+                          'tagvalue': tag_genome.tagvalue.cat.codes},
+                         columns=TAGGENOME_COLUMNS)
+    with pd.HDFStore(path, mode='w', complevel=5, complib='blosc') as store:
+        store.put('genome', codes, format='fixed')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', pd.errors.PerformanceWarning)
+            store.put('tagkeys',
+                      pd.Series(tag_genome.tagkey.cat.categories),
+                      format='fixed')
+            store.put('tagvalues',
+                      pd.Series(tag_genome.tagvalue.cat.categories),
+                      format='fixed')
+
+def load_encoded_genome(path):
+    """Load a tag genome saved with save_encoded_genome, as a dataframe with
+    categorical element types, tag keys and tag values
+    """
+    with pd.HDFStore(path, mode='r') as store:
+        genome = store.get('genome')
+        tagkeys = store.get('tagkeys').values
+        tagvalues = store.get('tagvalues').values
+    genome['elem'] = pd.Categorical.from_codes(genome.elem.values, ELEM_TYPES)
+    genome['tagkey'] = pd.Categorical.from_codes(genome.tagkey.values, tagkeys)
+    genome['tagvalue'] = pd.Categorical.from_codes(genome.tagvalue.values,
+                                                   tagvalues)
+    return genome
+
+#####
+
+class TagDiffHandler(osm.SimpleHandler):
+    """Encapsulates the recovery of tag change events, i.e. the tags added,
+    modified or removed by each OSM element version.
+
+    As osmium delivers history files sorted by type, id and version, the
+    versions of an element are consecutive: each version is compared to the
+    previous visible version of the element, whose tags are the only ones
+    kept in memory. The first version of an element adds all its tags;
+    deleted versions do not produce any event (a recreated element is
+    compared to its last visible version).
+
+    Events are stored as typed arrays, tag keys and values being
+    dictionary-encoded as with EncodedTagGenomeHandler; old (resp. new)
+    values are missing for added (resp. removed) tags.
+
+    """
+    def __init__(self):
+        """ Class default constructor"""
+        osm.SimpleHandler.__init__(self)
+        self.tagkeys = {}
+        self.tagvalues = {}
+        self.tagdiff = {name: array.array(typecode)
+                        for name, typecode in TAGDIFF_COLUMNS}
+        self.current = None
+        self.current_tags = {}
+
+    def __len__(self):
+        return len(self.tagdiff['id'])
+
+    def record(self, elem, elem_code, event, key, oldvalue, newvalue):
+        """Append a tag change event to the feature arrays"""
+        tagdiff = self.tagdiff
+        tagdiff['elem'].append(elem_code)
+        tagdiff['id'].append(elem.id)
+        tagdiff['version'].append(elem.version)
+        tagdiff['ts'].append(int(elem.timestamp.timestamp()))
+        tagdiff['uid'].append(elem.uid)
+        tagdiff['chgset'].append(elem.changeset)
+        tagdiff['event'].append(TAG_EVENT_CODES[event])
+        tagdiff['tagkey'].append(self.tagkeys.setdefault(key,
+                                                         len(self.tagkeys)))
+        for name, value in [('oldvalue', oldvalue), ('newvalue', newvalue)]:
+            tagdiff[name].append(-1 if value is None
+                                 else self.tagvalues.setdefault(
+                                     value, len(self.tagvalues)))
+
+    def tag_diff(self, elem, elem_code):
+        if (elem_code, elem.id) != self.current:
+            self.current = (elem_code, elem.id)
+            self.current_tags = {}
+        if not elem.visible:
+            return
+        tags = {tag.k: tag.v for tag in elem.tags}
+        previous = self.current_tags
+        for key, value in tags.items():
+            oldvalue = previous.get(key)
+            if oldvalue is None:
+                self.record(elem, elem_code, 'add', key, None, value)
+            elif oldvalue != value:
+                self.record(elem, elem_code, 'modify', key, oldvalue, value)
+        for key, oldvalue in previous.items():
+            if key not in tags:
+                self.record(elem, elem_code, 'remove', key, oldvalue, None)
+        self.current_tags = tags
+
+    def node(self, n):
+        self.tag_diff(n, ELEM_CODES['node'])
+
+    def way(self, w):
+        self.tag_diff(w, ELEM_CODES['way'])
+
+    def relation(self, r):
+        self.tag_diff(r, ELEM_CODES['relation'])
+
+    def to_dataframe(self):
+        """Build the tag change events as a pandas DataFrame, with categorical
+        element types, events, tag keys and tag values
+        """
+        data = {name: np.frombuffer(self.tagdiff[name], dtype=typecode)
+                for name, typecode in TAGDIFF_COLUMNS}
+        data['elem'] = pd.Categorical.from_codes(data['elem'], ELEM_TYPES)
+        data['ts'] = pd.to_datetime(data['ts'], unit='s')
+        data['event'] = pd.Categorical.from_codes(data['event'], TAG_EVENTS)
+        data['tagkey'] = sorted_categorical(data['tagkey'], list(self.tagkeys))
+        for name in ['oldvalue', 'newvalue']:
+            data[name] = sorted_categorical(data[name], list(self.tagvalues))
+        return pd.DataFrame(data,
+                            columns=[name for name, _ in TAGDIFF_COLUMNS])
+
+def save_tag_diff(tag_diff, path):
+    """Save tag change events with categorical features into an HDF5 file:
+    integer codes are stored in the 'tagdiff' table, tag key and tag value
+    dictionaries in 'tagkeys' and 'tagvalues' (see save_encoded_genome)
+
+    """
+    codes = tag_diff.copy()
+    for name in ['elem', 'event', 'tagkey', 'oldvalue', 'newvalue']:
+        codes[name] = tag_diff[name].cat.codes
+    codes['ts'] = tag_diff.ts.values.astype('datetime64[s]').astype(np.int64)
+    with pd.HDFStore(path, mode='w', complevel=5, complib='blosc') as store:
+        store.put('tagdiff', codes, format='fixed')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', pd.errors.PerformanceWarning)
+            store.put('tagkeys', pd.Series(tag_diff.tagkey.cat.categories),
+                      format='fixed')
+            store.put('tagvalues',
+                      pd.Series(tag_diff.newvalue.cat.categories),
+                      format='fixed')
+
+def load_tag_diff(path):
+    """Load tag change events saved with save_tag_diff, as a dataframe with
+    categorical element types, events, tag keys and tag values
+    """
+    with pd.HDFStore(path, mode='r') as store:
+        tag_diff = store.get('tagdiff')
+        tagkeys = store.get('tagkeys').values
+        tagvalues = store.get('tagvalues').values
+    tag_diff['elem'] = pd.Categorical.from_codes(tag_diff.elem.values,
+                                                 ELEM_TYPES)
+    tag_diff['ts'] = pd.to_datetime(tag_diff.ts.values, unit='s')
+    tag_diff['event'] = pd.Categorical.from_codes(tag_diff.event.values,
+                                                  TAG_EVENTS)
+    tag_diff['tagkey'] = pd.Categorical.from_codes(tag_diff.tagkey.values,
+                                                   tagkeys)
+    for name in ['oldvalue', 'newvalue']:
+        tag_diff[name] = pd.Categorical.from_codes(tag_diff[name].values,
+                                                   tagvalues)
+    return tag_diff
+
+#####
+
+class TagStatisticsHandler(osm.SimpleHandler):
+    """Aggregates the tag statistics of the tag meta-analysis during the
+    parsing, instead of recovering the whole tag genome.
+
+    The handler counts the element versions of each (elem, version) pair, of
+    each (tag key, elem, version) and (tag key, tag value, elem, version)
+    combination, and the distinct elements that held each (tag key, tag
+    value) pair, by element type. As osmium delivers history files sorted by
+    type, id and version, the versions of an element are consecutive, hence
+    distinct elements are counted with the tags of the current element only.
+
+    Tag keys with a lot of values (e.g. 'name') only keep track of their
+    'topk' most frequent values: when a key reaches twice this number of
+    values, its least frequent values are dropped. Counts of values that have
+    been dropped then seen again start from zero, hence they are lower bounds
+    for such keys. Tag key counts are always exact. Every value is kept if
+    topk is 0.
+
+    """
+    def __init__(self, topk=1000):
+        """ Class default constructor"""
+        osm.SimpleHandler.__init__(self)
+        self.topk = topk
+        self.totals = {}
+        self.tagkeys = {}
+        # Tag value records, by tag key and tag value: counts of element
+        # versions by (elem, version), and of distinct elements by elem code
+        self.tagvalues = {}
+        self.current = None
+        self.current_tags = set()
+
+    def tag_inventory(self, elem, elem_code):
+        version = elem.version
+        if (elem_code, elem.id) != self.current:
+            self.current = (elem_code, elem.id)
+            self.current_tags = set()
+        pivot = (elem_code, version)
+        self.totals[pivot] = self.totals.get(pivot, 0) + 1
+        for tag in elem.tags:
+            key, value = tag.k, tag.v
+            keycount = (key, elem_code, version)
+            self.tagkeys[keycount] = self.tagkeys.get(keycount, 0) + 1
+            values = self.tagvalues.setdefault(key, {})
+            record = values.get(value)
+            if record is None:
+                if self.topk and len(values) >= 2 * self.topk:
+                    values = self.prune(key)
+                record = values[value] = ({}, [0] * len(ELEM_TYPES))
+            record[0][pivot] = record[0].get(pivot, 0) + 1
+            if (key, value) not in self.current_tags:
+                self.current_tags.add((key, value))
+                record[1][elem_code] += 1
+
+    def prune(self, key):
+        """Keep the 'topk' most frequent values of a tag key, and return them
+        """
+        values = self.tagvalues[key]
+        frequencies = sorted(((sum(record[0].values()), value)
+                              for value, record in values.items()),
+                             reverse=True)
+        self.tagvalues[key] = {value: values[value]
+                               for _, value in frequencies[:self.topk]}
+        return self.tagvalues[key]
+
+    def node(self, n):
+        self.tag_inventory(n, ELEM_CODES['node'])
+
+    def way(self, w):
+        self.tag_inventory(w, ELEM_CODES['way'])
+
+    def relation(self, r):
+        self.tag_inventory(r, ELEM_CODES['relation'])
+
+    def to_dataframes(self):
+        """Build the tag statistics as pandas DataFrames, indexed by name:
+
+        - 'totals' (elem, version, n);
+        - 'keys' (tagkey, elem, version, n);
+        - 'values' (tagkey, tagvalue, elem, version, n);
+        - 'elements' (tagkey, tagvalue, elem, n), n being a number of distinct
+          elements;
+
+        element types are categoricals, and n are numbers of element versions
+        unless stated otherwise
+        """
+        for key, values in self.tagvalues.items():
+            if self.topk and len(values) > self.topk:
+                self.prune(key)
+        totals = pd.DataFrame([(elem_code, version, n)
+                               for (elem_code, version), n
+                               in self.totals.items()],
+                              columns=['elem', 'version', 'n'])
+        keys = pd.DataFrame([(key, elem_code, version, n)
+                             for (key, elem_code, version), n
+                             in self.tagkeys.items()],
+                            columns=['tagkey', 'elem', 'version', 'n'])
+        values = pd.DataFrame([(key, value, elem_code, version, n)
+                               for key, records in self.tagvalues.items()
+                               for value, (counts, _) in records.items()
+                               for (elem_code, version), n in counts.items()],
+                              columns=['tagkey', 'tagvalue', 'elem',
+                                       'version', 'n'])
+        elements = pd.DataFrame([(key, value, elem_code, n)
+                                 for key, records in self.tagvalues.items()
+                                 for value, (_, elems) in records.items()
+                                 for elem_code, n in enumerate(elems)
+                                 if n > 0],
+                                columns=['tagkey', 'tagvalue', 'elem', 'n'])
+        for table in [totals, keys, values, elements]:
+            table['elem'] = pd.Categorical.from_codes(
+                table.elem.values.astype('b'), ELEM_TYPES)
+        return {'totals': totals, 'keys': keys, 'values': values,
+                'elements': elements}
+
+#####
+
+class Region(object):
+    """Polygon used to route OSM elements to an area; coordinates are given in
+    (longitude, latitude) order, the polygon being implicitly closed.
+
+    """
+    def __init__(self, polygon, is_bbox=False):
+        """ Class default constructor"""
+        self.polygon = [tuple(point) for point in polygon]
+        lons, lats = zip(*self.polygon)
+        self.bbox = (min(lons), min(lats), max(lons), max(lats))
+        self.is_bbox = is_bbox
+
+    @classmethod
+    def from_bbox(cls, minlon, minlat, maxlon, maxlat):
+        """Build a rectangular region from its bounding box"""
+        return cls([(minlon, minlat), (maxlon, minlat),
+                    (maxlon, maxlat), (minlon, maxlat)], is_bbox=True)
+
+    def contains(self, lon, lat):
+        """Return True if the point (lon, lat) is inside the region (ray
+        casting algorithm, after a bounding box pre-filter)
+        """
+        minlon, minlat, maxlon, maxlat = self.bbox
+        if not (minlon <= lon <= maxlon and minlat <= lat <= maxlat):
+            return False
+        if self.is_bbox:
+            return True
+        inside = False
+        x1, y1 = self.polygon[-1]
+        for x2, y2 in self.polygon:
+            if (y1 > lat) != (y2 > lat):
+                if lon < (x2 - x1) * (lat - y1) / (y2 - y1) + x1:
+                    inside = not inside
+            x1, y1 = x2, y2
+        return inside
+
+class RegionTimelineHandler(osm.SimpleHandler):
+    """Encapsulates the recovery of elements inside the OSM history, for
+    several regions at once.
+
+    An element belongs to a region if any of its versions does: a node version
+    when its location is inside the region polygon, a way version when it
+    refers to a node of the region, a relation version when one of its members
+    belongs to the region. As history files are sorted by type (nodes, ways,
+    then relations), id and version, the versions of an element are buffered
+    until the next element arrives, and then appended to the columnar
+    timeline (see ColumnarTimelineHandler) of each matching region. Relations
+    that are members of relations with a lower id are not propagated.
+
+    """
+    def __init__(self, regions):
+        """ Class default constructor
+
+        regions: dict
+            Region instances indexed by name
+        """
+        osm.SimpleHandler.__init__(self)
+        self.regions = regions
+        self.elemtimelines = {name: {col: array.array(typecode)
+                                     for col, typecode in TIMELINE_COLUMNS}
+                              for name in regions}
+        # Ids of the elements that belong to each region, by member type
+        self.members = {name: {'n': set(), 'w': set(), 'r': set()}
+                        for name in regions}
+        self.current = None
+        self.versions = []
+        self.matched = set()
+
+    def record(self, elem, elem_code, matched):
+        """Buffer the features of an OSM element version, as well as the
+        regions it belongs to
+        """
+        if (elem_code, elem.id) != self.current:
+            self.flush_element()
+            self.current = (elem_code, elem.id)
+        self.versions.append((elem_code,
+                              elem.id,
+                              elem.version,
+                              elem.visible,
+                              int(elem.timestamp.timestamp()),
+                              elem.uid,
+                              elem.changeset))
+        self.matched.update(matched)
+
+    def flush_element(self):
+        """Append the buffered versions to the timeline of each matching
+        region
+        """
+        if self.current is not None:
+            elem_code, elem_id = self.current
+            for name in self.matched:
+                timeline = self.elemtimelines[name]
+                for version in self.versions:
+                    for (col, _), value in zip(TIMELINE_COLUMNS, version):
+                        timeline[col].append(value)
+                self.members[name][ELEM_TYPES[elem_code][0]].add(elem_id)
+        self.current = None
+        self.versions = []
+        self.matched = set()
+
+    def node(self, n):
+        matched = []
+        if n.visible and n.location.valid():
+            lon, lat = n.location.lon, n.location.lat
+            matched = [name for name, region in self.regions.items()
+                       if region.contains(lon, lat)]
+        self.record(n, ELEM_CODES['node'], matched)
+
+    def way(self, w):
+        refs = [node.ref for node in w.nodes]
+        matched = [name for name, members in self.members.items()
+                   if any(ref in members['n'] for ref in refs)]
+        self.record(w, ELEM_CODES['way'], matched)
+
+    def relation(self, r):
+        refs = [(member.type, member.ref) for member in r.members]
+        matched = [name for name, members in self.members.items()
+                   if any(ref in members[mtype] for mtype, ref in refs)]
+        self.record(r, ELEM_CODES['relation'], matched)
+
+    def to_dataframes(self):
+        """Build the OSM element timeline of each region, as pandas
+        DataFrames indexed by region name
+        """
+        self.flush_element()
+        return {name: timeline_dataframe(timeline)
+                for name, timeline in self.elemtimelines.items()}
+
+#####
+
+# Fixed-point precision of node coordinates, as stored by osmium
+COORDINATE_PRECISION = 10000000
+# Member types, as given by osmium ('n', 'w' or 'r'), coded as element types
+MEMBER_CODES = {elem[0]: code for elem, code in ELEM_CODES.items()}
+
+class GeometryHandler(osm.SimpleHandler):
+    """Encapsulates the recovery of the element descriptions ('descr' in
+    TimelineHandler) inside the OSM history, with a compact storage.
+
+    Node coordinates are kept as fixed-point int32 values (degrees multiplied
+    by COORDINATE_PRECISION, undefined for deleted nodes); way node refs and
+    relation members are flattened into int64 arrays, indexed by offset arrays
+    (CSR layout: the refs of the i-th way version are
+    way_refs[way_offsets[i]:way_offsets[i+1]]). Relation member roles are
+    dictionary-encoded.
+
+    """
+    def __init__(self):
+        """ Class default constructor"""
+        osm.SimpleHandler.__init__(self)
+        self.arrays = {'node_id': array.array('q'),
+                       'node_version': array.array('i'),
+                       'node_x': array.array('i'),
+                       'node_y': array.array('i'),
+                       'way_id': array.array('q'),
+                       'way_version': array.array('i'),
+                       'way_offsets': array.array('q', [0]),
+                       'way_refs': array.array('q'),
+                       'relation_id': array.array('q'),
+                       'relation_version': array.array('i'),
+                       'relation_offsets': array.array('q', [0]),
+                       'member_type': array.array('b'),
+                       'member_ref': array.array('q'),
+                       'member_role': array.array('i')}
+        self.roles = {}
+
+    def node(self, n):
+        self.arrays['node_id'].append(n.id)
+        self.arrays['node_version'].append(n.version)
+        self.arrays['node_x'].append(n.location.x)
+        self.arrays['node_y'].append(n.location.y)
+
+    def way(self, w):
+        self.arrays['way_id'].append(w.id)
+        self.arrays['way_version'].append(w.version)
+        self.arrays['way_refs'].extend(node.ref for node in w.nodes)
+        self.arrays['way_offsets'].append(len(self.arrays['way_refs']))
+
+    def relation(self, r):
+        self.arrays['relation_id'].append(r.id)
+        self.arrays['relation_version'].append(r.version)
+        for member in r.members:
+            self.arrays['member_type'].append(MEMBER_CODES[member.type])
+            self.arrays['member_ref'].append(member.ref)
+            self.arrays['member_role'].append(
+                self.roles.setdefault(member.role, len(self.roles)))
+        self.arrays['relation_offsets'].append(len(self.arrays['member_ref']))
+
+    def save(self, path):
+        """Save the element descriptions as a numpy .npz file"""
+        np.savez(path, roles=np.array(list(self.roles), dtype=str),
+                 **{name: np.frombuffer(values, dtype=values.typecode)
+                    for name, values in self.arrays.items()})
+
+def load_geometry(path):
+    """Load the element descriptions saved by GeometryHandler.save, as a dict
+    of numpy arrays
+    """
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+def csr_slice(values, offsets, index):
+    """Return the items of the index-th row of a CSR array, e.g. the node refs
+    of a way version with csr_slice(geometry['way_refs'],
+    geometry['way_offsets'], index)
+    """
+    return values[offsets[index]:offsets[index + 1]]
+
+def node_coordinates(geometry):
+    """Return node longitudes and latitudes as floating degrees (NaN for
+    deleted node versions)
+    """
+    undefined = np.iinfo(np.int32).max
+    return pd.DataFrame({coord: np.where(geometry[col] == undefined, np.nan,
+                                         geometry[col] / COORDINATE_PRECISION)
+                         for coord, col in [('lon', 'node_x'),
+                                            ('lat', 'node_y')]})
@@ -3,17 +3,21 @@
 """Count the number changesets by user, i.e. uid
 
 This script used the dask library to handle the large input CSV file, ~210Go,
-about the changesets history.
+about the changesets history. If a changeset store is given instead (see the
+changesets module and 'extract-changesets.py --store'), only the needed columns
+are read: the user ids for the changeset counts, and the changeset ids, user
+ids and 'created_by' tags for the editors.
 """
 
 
 import numpy as np
 
-from dask import dataframe as dd
+import changesets
 
 # Column types of the input CSV file
 DTYPE = {'id': np.dtype(int),
          'created': np.dtype(str),
+         'closed': np.dtype(str),
          'uid': np.dtype(int),
          'min_lat': np.dtype(float),
          'min_lon': np.dtype(float),
@@ -47,6 +51,22 @@ def distinct_software_by_uid(data):
            .count())
     return grp.compute()
 
+def store_nb_changeset_by_uid(store):
+    """count the number of changesets by user id, from a changeset store
+
+    store: changesets.ChangesetStore
+
+    return a pandas.Series
+    """
+    return store.changeset_count('uid').rename('uid')
+
+def store_distinct_software_by_uid(store):
+    """retrieve the software used to edited OSM by user, from a changeset store
+
+    return a multi-index pandas.Series
+    """
+    return store.tag_usage('created_by', 'uid').rename('value')
+
 
 if __name__ == '__main__':
     import os
@@ -55,24 +75,37 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('analyze', help='type of the analyze: changeset or editor', type=str)
     parser.add_argument('-o', '--output', help='name of the output file')
+    parser.add_argument('-s', '--store',
+                        help='changeset store directory, read instead of the CSV file')
     args = parser.parse_args()
 
     analyze = args.analyze
     if analyze not in ['changeset', 'editor']:
         raise ValueError("wrong analyze name: 'changeset' or 'editor'")
 
-    if args.output is None:
+    outpath = args.output
+    if outpath is None:
         outpath = os.path.join('./data', 'output-extracts', 'all-' + analyze  + 's-by-user.csv')
     print(outpath)
 
-    fname = "data/output-extracts/changesets-full-17-03-22.csv"
-    print("dask read the CSV '{}'".format(fname))
-    data = dd.read_csv(fname, blocksize=2**32, dtype=DTYPE)
-
-    print("data processing")
-    if analyze == 'changeset':
-        result = nb_changeset_by_uid(data)
-    if analyze == 'editor':
-        result = distinct_software_by_uid(data)
+    if args.store is not None:
+        print("read the changeset store '{}'".format(args.store))
+        store = changesets.ChangesetStore(args.store)
+        print("data processing")
+        if analyze == 'changeset':
+            result = store_nb_changeset_by_uid(store)
+        if analyze == 'editor':
+            result = store_distinct_software_by_uid(store)
+    else:
+        from dask import dataframe as dd
+        fname = "data/output-extracts/changesets-full-17-03-22.csv"
+        print("dask read the CSV '{}'".format(fname))
+        data = dd.read_csv(fname, blocksize=2**32, dtype=DTYPE)
+
+        print("data processing")
+        if analyze == 'changeset':
+            result = nb_changeset_by_uid(data)
+        if analyze == 'editor':
+            result = distinct_software_by_uid(data)
     print("writing results")
     result.to_csv(outpath)
@@ -2,81 +2,401 @@
 
 """ Implement some functions useful to analysis OSM tag genome """
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import is_categorical_dtype
+
+import cardinality
 
 ########################################
 
-def tagvalue_analysis(genome, key, pivot_var=['elem','version'], vrank=1):
+def group_aggregate(genome, by, column='id', aggfunc='nunique', error=None):
+    """Aggregate a genome feature for each group of 'by' features
+
+    Categorical features (e.g. a dictionary-encoded tag genome) are grouped
+    through their integer codes, and decoded once the aggregation is done;
+    rows with missing categories are ignored, as with a plain groupby.
+
+    INPUT: genome = pandas DataFrame with OSM element tag history, by = list of
+    grouping features, column = aggregated feature, aggfunc = name of the
+    aggregation function (e.g. 'nunique' or 'count'), error = if given,
+    'nunique' aggregations are approximated with sketches of this relative
+    standard error (see cardinality)
+
+    """
+    categorical = [feature for feature in by
+                   if is_categorical_dtype(genome[feature])]
+    keys = [genome[feature].cat.codes if feature in categorical
+            else genome[feature] for feature in by]
+    if categorical:
+        observed = (pd.concat([genome[feature].cat.codes
+                               for feature in categorical], axis=1)
+                    >= 0).all(axis=1)
+        genome = genome[observed]
+        keys = [key[observed] for key in keys]
+    if aggfunc == 'nunique' and error is not None:
+        keys = pd.DataFrame({feature: pd.Series(key).values
+                             for feature, key in zip(by, keys)}, columns=by)
+        result = cardinality.nunique(keys, genome[column].values, error)
+    else:
+        result = genome.groupby(keys)[column].agg(aggfunc)
+    if len(by) == 1:
+        if categorical:
+            result.index = genome[by[0]].cat.categories.take(result.index)
+        result.index.name = by[0]
+        return result
+    levels = [genome[feature].cat.categories.take(level)
+              if feature in categorical else level
+              for feature, level in zip(by, result.index.levels)]
+    result.index = result.index.set_levels(levels).set_names(by)
+    return result
+
+def tagvalue_analysis(genome, key, pivot_var=['elem','version'], vrank=1,
+                      error=None):
     """Return a table that contains the number of unique elements for each tag
     value, element type and version, for a given tag key 
 
     INPUT: genome = pandas DataFrame with OSM element tag history, key = tag key
     that will be focused on, pivot_var = genome feature(s) taken into account
     to build the tag analysis, vrank = version number used to sort the
-    resulting table
+    resulting table, error = if given, relative standard error of approximate
+    unique element counts (see group_aggregate)
 
     """
-    return (genome.query("tagkey==@key")
-            .groupby(['tagvalue', *pivot_var])['id']
-            .nunique()
+    return (group_aggregate(genome[genome.tagkey == key],
+                            ['tagvalue', *pivot_var], error=error)
             .unstack()
             .fillna(0))
 
-def tagvalue_frequency(genome, key, pivot_var=['elem', 'version'], nround=2, vrank=1):
+def tagvalue_frequency(genome, key, pivot_var=['elem', 'version'], nround=2, vrank=1,
+                       error=None):
     """Return a table that contains the frequency of each tag value, for given
     element type, version and tag key 
 
     INPUT: genome = pandas DataFrame with OSM element tag history, key = tag
     key that will be focused on, pivot_var = genome feature(s) taken into
     account to build the tag analysis, nround = number of digits, vrank =
-    version number used to sort the resulting table
+    version number used to sort the resulting table, error = if given,
+    relative standard error of approximate unique element counts (see
+    group_aggregate)
 
     """
-    total_uniqelem = (genome.query("tagkey==@key")
-                      .groupby(pivot_var)['id']
-                      .nunique()
+    key_genome = genome[genome.tagkey == key]
+    total_uniqelem = (group_aggregate(key_genome, pivot_var, error=error)
                       .unstack()
                       .fillna(0))
-    tagcount = tagvalue_analysis(genome, key, pivot_var=['elem','version'])
-    tagcount_groups = tagcount.groupby(level='elem')
-    tag_freq = []
-    for key, group in tagcount_groups:
-        tag_freq.append( group / total_uniqelem.loc[key])
-    tag_freq = pd.concat(tag_freq)
+    tagcount = (group_aggregate(key_genome, ['tagvalue', 'elem', 'version'],
+                                error=error)
+                .unstack()
+                .fillna(0))
+    tag_freq = elem_frequency(tagcount, total_uniqelem)
     return (100*tag_freq).round(nround)
 
-def tagkey_analysis(genome, pivot_var=['elem']):
+def tagkey_analysis(genome, pivot_var=['elem'], error=None):
     """Return a table that contains the number of unique elements for
     each tag key, element type and version 
 
     INPUT: genome = pandas DataFrame with OSM element tag history, pivot_var =
-    genome feature(s) taken into account to build the tag analysis
+    genome feature(s) taken into account to build the tag analysis, error =
+    if given, relative standard error of approximate unique element counts
+    (see group_aggregate)
 
     """
-    return (genome.groupby(['tagkey', *pivot_var])['id']
-            .nunique()
+    return (group_aggregate(genome, ['tagkey', *pivot_var], error=error)
             .unstack()
             .fillna(0))
 
-def tag_frequency(genome, pivot_var=['elem', 'version'], nround=2, vrank=1):
+def tag_frequency(genome, pivot_var=['elem', 'version'], nround=2, vrank=1,
+                  error=None):
     """Return a table that contains the frequency of each tag key, for given
     element type and version
 
     INPUT: genome = pandas DataFrame with OSM element tag history,
     pivot_var = genome feature(s) taken into account to build
     the tag analysis, nround = number of digits, vrank = version number
-    used to sort the resulting table
+    used to sort the resulting table, error = if given, relative standard
+    error of approximate unique element counts (see group_aggregate)
 
     """
-    total_uniqelem = (genome
-                      .groupby(pivot_var)['id']
-                      .nunique()
+    total_uniqelem = (group_aggregate(genome, pivot_var, error=error)
                       .unstack()
                       .fillna(0))
-    tagcount = tagkey_analysis(genome, pivot_var)
-    tagcount_groups = tagcount.groupby(level='elem')
-    tag_freq = []
-    for key, group in tagcount_groups:
-        tag_freq.append( group / total_uniqelem.loc[key])
-    tag_freq = pd.concat(tag_freq)
+    tagcount = tagkey_analysis(genome, pivot_var, error)
+    tag_freq = elem_frequency(tagcount, total_uniqelem)
     return 100*tag_freq.round(4)
+
+def elem_frequency(tagcount, total_uniqelem):
+    """Divide tag counts by the number of unique elements of the same type
+
+    INPUT: tagcount = table of tag counts, indexed by (at least) element type,
+    total_uniqelem = table of unique element counts, indexed by element type
+
+    """
+    tag_freq = []
+    for key, group in tagcount.groupby(level='elem'):
+        tag_freq.append(group / total_uniqelem.loc[key])
+    if not tag_freq:
+        # No tagged element at all
+        return tagcount.astype(np.float64)
+    return pd.concat(tag_freq)
+
+def tag_event_count(tag_diff, pivot_var=['event']):
+    """Return a table that contains the number of tag change events for each
+    tag key
+
+    INPUT: tag_diff = pandas DataFrame with OSM tag change events (see
+    osmparsing.TagDiffHandler), pivot_var = tag diff feature(s) taken into
+    account to build the tag analysis
+
+    """
+    return (group_aggregate(tag_diff, ['tagkey', *pivot_var], 'id', 'count')
+            .unstack()
+            .fillna(0))
+
+def tag_event_users(tag_diff, key, event='add'):
+    """Return the number of events of a given type on a tag key (e.g. 'highway'
+    additions) made by each user, sorted in decreasing order
+
+    INPUT: tag_diff = pandas DataFrame with OSM tag change events, key = tag
+    key that will be focused on, event = type of tag change event ('add',
+    'modify' or 'remove')
+
+    """
+    events = tag_diff[(tag_diff.tagkey == key) & (tag_diff.event == event)]
+    return (events.groupby('uid').size()
+            .rename('n_' + event)
+            .sort_values(ascending=False))
+
+def tag_change_frequency(tag_diff, key, pivot_var=['elem']):
+    """Return the mean number of value modifications of a tag key, per element
+    that held the key
+
+    INPUT: tag_diff = pandas DataFrame with OSM tag change events, key = tag
+    key that will be focused on, pivot_var = tag diff feature(s) taken into
+    account to build the tag analysis
+
+    """
+    key_diff = tag_diff[tag_diff.tagkey == key]
+    changes = group_aggregate(key_diff[key_diff.event == 'modify'], pivot_var,
+                              'id', 'count')
+    elements = group_aggregate(key_diff[key_diff.event == 'add'], pivot_var)
+    return (changes / elements).fillna(0)
+
+CUBE_FEATURES = ['tagkey', 'tagvalue', 'elem', 'version']
+# Columns of the tag cube tables
+CUBE_TABLES = {'values': CUBE_FEATURES + ['n'],
+               'keys': ['tagkey', 'elem', 'version', 'n'],
+               'totals': ['elem', 'version', 'n'],
+               'elements': ['tagkey', 'tagvalue', 'elem', 'n']}
+
+class TagCube(object):
+    """Numbers of unique elements of an OSM tag genome, aggregated once for
+    every tag key, and saved into an HDF5 file whose tables are indexed by tag
+    key, so as to analyse any tag key without scanning the genome again
+
+    The file contains the tables 'values' (tagkey, tagvalue, elem, version,
+    n), 'keys' (tagkey, elem, version, n) and 'totals' (elem, version, n),
+    where n is a number of unique elements, and 'elements' (tagkey, tagvalue,
+    elem, n), where n is the number of unique elements that held the tag in
+    any version; tag keys, tag values and element types are stored as integer
+    codes of the 'tagkeys', 'tagvalues' and 'elems' dictionaries.
+
+    A cube is built either from a tag genome (see TagCube.build), or from the
+    statistics aggregated while parsing the OSM history (see
+    TagCube.from_statistics).
+
+    Elements are identified by their type and id, hence analyses that are not
+    pivoted by element type count elements of different types sharing an id
+    separately.
+    """
+    def __init__(self, path):
+        """ Class default constructor, from a file written by TagCube.build"""
+        self.path = path
+        with pd.HDFStore(path, mode='r') as store:
+            self.tagkeys = store.get('tagkeys').values
+            self.tagvalues = store.get('tagvalues').values
+            self.elems = store.get('elems').values
+        self.tagkey_codes = {key: code for code, key in enumerate(self.tagkeys)}
+
+    @classmethod
+    def build(cls, genome, path, history=None, error=None):
+        """Aggregate a dictionary-encoded tag genome (see
+        osmparsing.load_encoded_genome) into a tag cube saved at path; the
+        total numbers of unique elements come from the OSM element history if
+        given (so as to count untagged elements), from the genome otherwise;
+        numbers of unique elements are approximated with sketches of relative
+        standard error 'error' if given (see group_aggregate)
+
+        An element version has one value per tag key, hence the numbers of
+        unique elements of tag keys are summed from the ones of tag values.
+        """
+        codes = pd.DataFrame({'tagkey': genome.tagkey.cat.codes.values,
+                              'tagvalue': genome.tagvalue.cat.codes.values,
+                              'elem': genome.elem.cat.codes.values,
+                              'version': genome.version.values,
+                              'id': genome.id.values})
+        codes = codes[codes.tagkey >= 0]
+        values = (group_aggregate(codes, CUBE_FEATURES, error=error)
+                  .rename('n'))
+        keys = (values.groupby(level=['tagkey', 'elem', 'version']).sum()
+                .reset_index())
+        elements = (group_aggregate(codes, ['tagkey', 'tagvalue', 'elem'],
+                                    error=error)
+                    .rename('n')
+                    .reset_index())
+        elems = genome.elem.cat.categories
+        if history is None:
+            totals = codes
+        else:
+            totals = pd.DataFrame({
+                'elem': pd.Categorical(history.elem, categories=elems).codes,
+                'version': history.version.values,
+                'id': history.id.values})
+        totals = (group_aggregate(totals, ['elem', 'version'], error=error)
+                  .rename('n')
+                  .reset_index())
+        return cls.write(path, {'values': values.reset_index(), 'keys': keys,
+                                'totals': totals, 'elements': elements},
+                         genome.tagkey.cat.categories,
+                         genome.tagvalue.cat.categories, elems)
+
+    @classmethod
+    def from_statistics(cls, statistics, path):
+        """Save the tag statistics of an OSM history (see
+        osmparsing.TagStatisticsHandler.to_dataframes) into a tag cube saved
+        at path
+
+        Each element version being parsed once, numbers of element versions
+        are numbers of unique elements by version.
+        """
+        tables = dict(statistics)
+        tagkeys = pd.Index(np.unique(tables['keys'].tagkey.values.astype(str)))
+        tagvalues = pd.Index(np.unique(tables['values'].tagvalue.values
+                                       .astype(str)))
+        elems = tables['totals'].elem.cat.categories
+        for name, table in tables.items():
+            table = table.copy()
+            table['elem'] = table.elem.cat.codes.values
+            for feature, categories in [('tagkey', tagkeys),
+                                        ('tagvalue', tagvalues)]:
+                if feature in table:
+                    table[feature] = categories.get_indexer(
+                        table[feature].values.astype(str))
+            table = table.sort_values([feature for feature in CUBE_FEATURES
+                                       if feature in table])
+            tables[name] = table.reset_index(drop=True)
+        return cls.write(path, tables, tagkeys, tagvalues, elems)
+
+    @classmethod
+    def write(cls, path, tables, tagkeys, tagvalues, elems):
+        """Write the cube tables, coded with the tagkeys, tagvalues and elems
+        dictionaries, into an HDF5 file
+        """
+        with pd.HDFStore(path, mode='w', complevel=5,
+                         complib='blosc') as store:
+            for name in ['values', 'keys', 'elements']:
+                store.append(name, tables[name], data_columns=['tagkey'])
+            store.put('totals', tables['totals'])
+            store.put('tagkeys', pd.Series(tagkeys))
+            store.put('tagvalues', pd.Series(tagvalues))
+            store.put('elems', pd.Series(elems))
+        return cls(path)
+
+    def select(self, table, key=None):
+        """Return a cube table, restricted to a tag key if given, with decoded
+        tag keys, tag values and element types
+
+        Empty tables are not written into HDF5 files (e.g. for an history
+        without any tag), hence missing tables are read as empty ones.
+        """
+        with pd.HDFStore(self.path, mode='r') as store:
+            if '/' + table not in store.keys():
+                cube = pd.DataFrame({feature: np.array([], dtype=np.int64)
+                                     for feature in CUBE_TABLES[table]},
+                                    columns=CUBE_TABLES[table])
+            elif key is None:
+                cube = store.select(table)
+            else:
+                code = self.tagkey_codes.get(key, -1)
+                cube = store.select(table, where='tagkey == code')
+        for feature, categories in [('tagkey', self.tagkeys),
+                                    ('tagvalue', self.tagvalues),
+                                    ('elem', self.elems)]:
+            if feature in cube:
+                cube[feature] = pd.Categorical.from_codes(cube[feature].values,
+                                                          categories)
+        return cube
+
+    def check_pivot(self, pivot_var, versioned=True):
+        """Raise a ValueError if the cube can not answer an analysis pivoted by
+        pivot_var features: they must be element type and version, the latter
+        being mandatory if 'versioned' is set (numbers of unique elements by
+        version can not be summed over versions)
+        """
+        unknown = set(pivot_var) - {'elem', 'version'}
+        if unknown:
+            raise ValueError("Tag cube analyses can not be pivoted by {}"
+                             .format(sorted(unknown)))
+        if versioned and 'version' not in pivot_var:
+            raise ValueError("Tag cube frequencies must be pivoted by "
+                             "'version'; use the tag genome functions "
+                             "otherwise")
+
+    def tagvalue_analysis(self, key, pivot_var=['elem','version']):
+        """Return the number of unique elements for each tag value and
+        pivot_var features, for a given tag key (see tagvalue_analysis); if
+        'version' is not a pivot feature, elements are counted once over all
+        their versions, from the 'elements' table
+        """
+        self.check_pivot(pivot_var, versioned=False)
+        table = 'values' if 'version' in pivot_var else 'elements'
+        return (group_aggregate(self.select(table, key),
+                                ['tagvalue', *pivot_var], 'n', 'sum')
+                .unstack()
+                .fillna(0))
+
+    def tagvalue_frequency(self, key, pivot_var=['elem', 'version'],
+                           nround=2):
+        """Return the frequency of each tag value, for given element type,
+        version and tag key (see tagvalue_frequency); pivot_var must contain
+        'version'
+        """
+        self.check_pivot(pivot_var)
+        total_uniqelem = (group_aggregate(self.select('keys', key), pivot_var,
+                                          'n', 'sum')
+                          .unstack()
+                          .fillna(0))
+        tagcount = self.tagvalue_analysis(key, ['elem', 'version'])
+        tag_freq = elem_frequency(tagcount, total_uniqelem)
+        return (100*tag_freq).round(nround)
+
+    def tag_frequency(self, pivot_var=['elem', 'version']):
+        """Return the frequency of each tag key, for given element type and
+        version (see tag_frequency); pivot_var must contain 'version'
+        """
+        self.check_pivot(pivot_var)
+        total_uniqelem = (group_aggregate(self.select('totals'), pivot_var,
+                                          'n', 'sum')
+                          .unstack()
+                          .fillna(0))
+        tagcount = (group_aggregate(self.select('keys'),
+                                    ['tagkey', *pivot_var], 'n', 'sum')
+                    .unstack()
+                    .fillna(0))
+        tag_freq = elem_frequency(tagcount, total_uniqelem)
+        return 100*tag_freq.round(4)
+
+    def tag_count(self):
+        """Return the number of distinct tag keys of each element type (as
+        OSMTagCount)
+        """
+        return group_aggregate(self.select('keys'), ['elem'], 'tagkey')
+
+    def tagkey_count(self):
+        """Return the number of tags of each tag key and element type (as
+        OSMTagKeyCount)
+        """
+        return (group_aggregate(self.select('keys'), ['tagkey', 'elem'], 'n',
+                                'sum')
+                .unstack()
+                .fillna(0))
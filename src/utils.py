@@ -6,14 +6,15 @@ Some utility functions aiming to analyse OSM data
 """
 
 import datetime as dt
+from collections import namedtuple
 import pandas as pd
 import numpy as np
 from datetime import timedelta
 import re
-import math
-import statsmodels.api as sm
 
 from extract_user_editor import editor_name
+import cardinality
+import normalization
 
 ### OSM data exploration ######################
 def updatedelem(data):
@@ -29,7 +30,8 @@ def updatedelem(data):
     return pd.merge(updata, data, on=['id','version'])
 
 def datedelems(history, date):
-    """Return an updated version of history data at date
+    """Return an updated version of history data at date (see SnapshotIndex
+    for repeated queries)
 
     Parameters
     ----------
@@ -45,36 +47,244 @@ def datedelems(history, date):
                   .reset_index())
     return pd.merge(datedelems, history, on=['elem','id','version'])
 
-def osm_stats(osm_history, timestamp):
+def osm_stats(osm_history, timestamp, error=None):
     """Compute some simple statistics about OSM elements (number of nodes,
     ways, relations, number of active contributors, number of change sets
 
     Parameters
     ----------
-    osm_history: df
-        OSM element up-to-date at timestamp
+    osm_history: df or SnapshotIndex
+        OSM element timeline, or its as-of index (for repeated evaluations)
     timestamp: datetime
         date at which OSM elements are evaluated
+    error: float
+        if given, numbers of contributors and change sets are approximated
+    with sketches of this relative standard error (see cardinality)
     """
-    osmdata = datedelems(osm_history, timestamp)
+    if isinstance(osm_history, SnapshotIndex):
+        osmdata = osm_history.snapshot(timestamp)
+    else:
+        osmdata = datedelems(osm_history, timestamp)
     nb_nodes = len(osmdata.query('elem=="node"'))
     nb_ways = len(osmdata.query('elem=="way"'))
     nb_relations = len(osmdata.query('elem=="relation"'))
-    nb_users = osmdata.uid.nunique()
-    nb_chgsets = osmdata.chgset.nunique()
+    if error is None:
+        nb_users = osmdata.uid.nunique()
+        nb_chgsets = osmdata.chgset.nunique()
+    else:
+        single = np.zeros(len(osmdata), dtype=np.int64)
+        nb_users, = cardinality.group_nunique(single, osmdata.uid.values, 1,
+                                              error)
+        nb_chgsets, = cardinality.group_nunique(single,
+                                                osmdata.chgset.values, 1,
+                                                error)
     return [nb_nodes, nb_ways, nb_relations, nb_users, nb_chgsets]
 
-def osm_chronology(history, start_date, end_date=dt.datetime.now()):
+def current_version_periods(history):
+    """Return the periods during which each version of the OSM elements is
+    the current one, i.e. the highest version created at or before a given
+    date (as in datedelems)
+
+    Parameters
+    ----------
+    history: df
+        OSM element timeline
+
+    Returns
+    -------
+    tuple
+        positions of the current versions into history, sorted by element,
+    with the 'start' and 'end' dates of their periods, as int64 nanoseconds
+    ('end' is excluded, and is the maximal int64 value if the version is still
+    the current one)
+
+    """
+    elem_codes, _ = pd.factorize(history.elem, sort=True)
+    ids = history.id.values
+    versions = history.version.values.astype(np.int64)
+    ts = history.ts.values.astype('datetime64[ns]').astype(np.int64)
+    order = np.lexsort((versions, ts, ids, elem_codes))
+    elem_codes, ids = elem_codes[order], ids[order]
+    versions, ts = versions[order], ts[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (elem_codes[1:] != elem_codes[:-1]) | (ids[1:] != ids[:-1])
+    # Running maximal version within each element: elements are shifted by
+    # increasing offsets, so as a global running maximum does not cross them
+    offsets = np.cumsum(first) * (versions.max() + 1)
+    runmax = np.maximum.accumulate(versions + offsets) - offsets
+    record = first.copy()
+    record[1:] |= versions[1:] > runmax[:-1]
+    rows = order[record]
+    starts = ts[record]
+    ends = np.full(len(rows), np.iinfo(np.int64).max)
+    same_elem = ~first[record][1:]
+    ends[:-1][same_elem] = starts[1:][same_elem]
+    # Versions replaced at their creation date are never current
+    valid = starts < ends
+    return rows[valid], starts[valid], ends[valid]
+
+def current_versions(history):
+    """Return the 'elem', 'id', 'uid' and 'chgset' of each current version of
+    the OSM elements, with the 'start' and 'end' dates of their periods (see
+    current_version_periods)
+
+    Parameters
+    ----------
+    history: df
+        OSM element timeline
+
+    """
+    rows, starts, ends = current_version_periods(history)
+    periods = history.iloc[rows][['elem', 'id', 'uid', 'chgset']]
+    return periods.assign(start=starts, end=ends).reset_index(drop=True)
+
+class SnapshotIndex(object):
+    """As-of index of an OSM element history, to query the state of OSM at
+    any date without scanning the whole history
+
+    Each current version (see current_version_periods) is valid from its
+    creation date to the creation of the next version; validity bounds are
+    kept as sorted arrays, hence counts are evaluated by binary search, in
+    O(log N) for N versions.
+
+    Snapshots start from the closest checkpoint before the date, i.e. the
+    versions that are current at one of (at most) 'checkpoints' dates evenly
+    spaced amongst the version creations, and add the versions created in between,
+    found by binary search. As a version only ends when the next version of
+    its element is created, a snapshot of k elements costs O(log N + k +
+    N / checkpoints), instead of O(N) for a filter of all the versions created
+    before the date; checkpoints cost O(checkpoints * N) memory at most.
+
+    """
+    def __init__(self, history, checkpoints=16):
+        """ Class default constructor
+
+        history: df
+            OSM element timeline
+        checkpoints: int
+            number of checkpoints of the snapshots
+        """
+        self.history = history
+        rows, starts, ends = current_version_periods(history)
+        order = np.argsort(starts, kind='mergesort')
+        self.rows = rows
+        self.ranks = order
+        self.valid_from = starts[order]
+        self.valid_to = ends[order]
+        # Checkpoint k holds the positions into valid_from of the versions
+        # that are current at its date, all created before nb_created[k]
+        step = max(1, -(-len(order) // max(1, checkpoints)))
+        self.checkpoint_dates = self.valid_from[step - 1::step]
+        self.checkpoint_created = np.searchsorted(
+            self.valid_from, self.checkpoint_dates, side='right')
+        self.checkpoint_alive = [
+            np.flatnonzero(self.valid_to[:nb_created] > date)
+            for date, nb_created in zip(self.checkpoint_dates,
+                                        self.checkpoint_created)]
+        elems = history.elem.values[rows]
+        self.bounds = {elem: (np.sort(starts[elems == elem]),
+                              np.sort(ends[elems == elem]))
+                       for elem in np.unique(elems)}
+        self.bounds[None] = (self.valid_from, np.sort(ends))
+
+    @staticmethod
+    def timestamp(date):
+        """Convert a date (string, datetime or numpy datetime) into int64
+        nanoseconds
+        """
+        return pd.Timestamp(date).value
+
+    def positions(self, date):
+        """Return the positions into the history of the versions that are
+        current at date, sorted by element
+        """
+        date = self.timestamp(date)
+        nb_created = np.searchsorted(self.valid_from, date, side='right')
+        checkpoint = np.searchsorted(self.checkpoint_dates, date,
+                                     side='right') - 1
+        if checkpoint < 0:
+            candidates = np.arange(nb_created)
+        else:
+            candidates = np.concatenate([
+                self.checkpoint_alive[checkpoint],
+                np.arange(self.checkpoint_created[checkpoint], nb_created)])
+        alive = candidates[self.valid_to[candidates] > date]
+        return self.rows[np.sort(self.ranks[alive])]
+
+    def snapshot(self, date):
+        """Return the OSM elements at date, i.e. their highest version created
+        at or before date (same result as datedelems)
+        """
+        return self.history.iloc[self.positions(date)].reset_index(drop=True)
+
+    def count(self, date, elem=None):
+        """Return the number of OSM elements at date, either all of them or
+        only the ones of type elem
+        """
+        if elem not in self.bounds:
+            return 0
+        date = self.timestamp(date)
+        valid_from, valid_to = self.bounds[elem]
+        return int(np.searchsorted(valid_from, date, side='right')
+                   - np.searchsorted(valid_to, date, side='right'))
+
+def distinct_count_timeline(periods, key, dates):
+    """Count, at each date, the distinct values of key amongst the periods
+    that contain this date
+
+    Parameters
+    ----------
+    periods: pd.DataFrame
+        periods with a 'start' and an 'end' (excluded) column, as int64
+    key: str
+        feature whose distinct values are counted
+    dates: np.array
+        int64 dates
+
+    """
+    periods = periods.sort_values([key, 'start'])
+    keys = periods[key].values
+    starts = periods.start.values
+    ends = periods.end.values
+    runmax_end = periods.groupby(key).end.cummax().values
+    # Overlapping or contiguous periods of a same key are merged into segments
+    new_segment = np.ones(len(periods), dtype=bool)
+    new_segment[1:] = (keys[1:] != keys[:-1]) | (starts[1:] > runmax_end[:-1])
+    segment_ends = np.maximum.reduceat(ends, np.flatnonzero(new_segment))
+    segment_starts = starts[new_segment]
+    return (np.searchsorted(np.sort(segment_starts), dates, side='right')
+            - np.searchsorted(np.sort(segment_ends), dates, side='right'))
+
+def osm_chronology(history, start_date, end_date=dt.datetime.now(),
+                   freq="1M"):
     """Evaluate the chronological evolution of OSM element numbers
 
+    The statistics are the ones of osm_stats, evaluated at each date of the
+    time range with a single sweep over the history, instead of one full
+    history scan per date.
+
     Parameters
     ----------
     history: df
         OSM element timeline
+    start_date: str
+        first date of the time range
+    end_date: str
+        last date of the time range
+    freq: str
+        time range frequency (pandas offset alias, e.g. '1D', '1W', '1M')
 
     """
-    timerange = pd.date_range(start_date, end_date, freq="1M").values
-    osmstats = [osm_stats(history, str(date)) for date in timerange]
+    timerange = pd.date_range(start_date, end_date, freq=freq).values
+    dates = timerange.astype('datetime64[ns]').astype(np.int64)
+    periods = current_versions(history)
+    # An element is counted since its first version
+    first_versions = periods.drop_duplicates(['elem', 'id'])
+    osmstats = {'n_' + elem + 's': np.searchsorted(
+        np.sort(first_versions.start.values[first_versions.elem == elem]),
+        dates, side='right') for elem in ['node', 'way', 'relation']}
+    osmstats['n_users'] = distinct_count_timeline(periods, 'uid', dates)
+    osmstats['n_chgsets'] = distinct_count_timeline(periods, 'chgset', dates)
     osmstats = pd.DataFrame(osmstats, index=timerange,
                             columns=['n_nodes', 'n_ways', 'n_relations',
                                      'n_users', 'n_chgsets'])
@@ -175,7 +385,247 @@ def group_stats(metadata, data, grp_feat, res_feat, nameprefix, namesuffix):
     md_ext.columns = [grp_feat, *colnames]
     return pd.merge(metadata, md_ext, on=grp_feat, how='outer').fillna(0)
 
-def init_metadata(osm_elements, init_feat, timeunit='1d'):
+# Metadata feature declaration: the feature 'name' is the 'agg' aggregation
+# of the 'column' values of the rows of each 'key' group, restricted to rows
+# that hold the 'filter' flag, if any; 'column' and 'filter' are either
+# feature names or functions of a GroupPlan
+Feature = namedtuple('Feature', ['name', 'key', 'column', 'agg', 'filter'])
+Feature.__new__.__defaults__ = (None,)
+
+def group_starts(sorted_codes):
+    """Return the start positions of the groups of sorted group codes"""
+    if len(sorted_codes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    boundaries = np.append(True, sorted_codes[1:] != sorted_codes[:-1])
+    return np.flatnonzero(boundaries)
+
+class GroupPlan(object):
+    """Groups of OSM history data according to some keys, factorized once and
+    shared by every metadata feature aggregated over the same key
+
+    Groups are numbered in the lexicographic order of their key values.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._groups = {}
+
+    def groups(self, key):
+        """Return the group codes of the data rows, the row positions sorted by
+        group, and the key values of each group, for the key feature list
+        """
+        key = tuple(key)
+        if key not in self._groups:
+            codes = None
+            for feature in key:
+                feature_codes, uniques = pd.factorize(self.data[feature],
+                                                      sort=True)
+                if codes is None:
+                    codes = feature_codes.astype(np.int64)
+                else:
+                    codes, _ = pd.factorize(codes * len(uniques)
+                                            + feature_codes, sort=True)
+            order = np.argsort(codes, kind='mergesort')
+            starts = group_starts(codes[order])
+            keys = (self.data[list(key)].iloc[order[starts]]
+                    .reset_index(drop=True))
+            self._groups[key] = (codes, order, keys)
+        return self._groups[key]
+
+    def rows(self, metadata, key):
+        """Return the group number of each metadata item, according to its key
+        values (-1 if the item is not in the data)
+        """
+        _, _, keys = self.groups(key)
+        key = list(key)
+        if len(key) == 1:
+            return pd.Index(keys[key[0]]).get_indexer(metadata[key[0]])
+        return (pd.MultiIndex.from_arrays([keys[k].values for k in key])
+                .get_indexer(pd.MultiIndex.from_arrays(
+                    [metadata[k].values for k in key])))
+
+    def values(self, column):
+        """Return the values of a feature column, or computed by a function of
+        the plan
+        """
+        if callable(column):
+            return column(self)
+        return self.data[column].values
+
+    def aggregate(self, feature):
+        """Aggregate a declared feature over its key groups; groups without
+        any row holding the feature filter get a NaN value
+        """
+        codes, order, keys = self.groups(feature.key)
+        if feature.filter is not None:
+            order = order[self.values(feature.filter)[order]]
+        sorted_codes = codes[order]
+        starts = group_starts(sorted_codes)
+        aggregated = feature.agg(self.values(feature.column)[order], starts)
+        if len(starts) == len(keys):
+            return aggregated
+        result = np.full(len(keys), np.nan)
+        result[sorted_codes[starts]] = aggregated
+        return result
+
+def agg_count(values, starts):
+    """Number of non-null values of each group, from values sorted by group
+    and group start positions (as every following aggregation)
+    """
+    ends = np.append(starts[1:], len(values))
+    notnull = np.append(0, np.cumsum(pd.notnull(values)))
+    return notnull[ends] - notnull[starts]
+
+def agg_sum(values, starts):
+    """Sum of the values of each group, as integers for boolean values"""
+    if values.dtype == bool:
+        values = values.astype(np.int64)
+    return np.add.reduceat(values, starts) if len(values) else values[:0]
+
+def agg_mean(values, starts):
+    """Mean of the values of each group"""
+    return agg_sum(values, starts) / agg_count(values, starts)
+
+def agg_min(values, starts):
+    """Minimal value of each group"""
+    return np.minimum.reduceat(values, starts) if len(values) else values[:0]
+
+def agg_max(values, starts):
+    """Maximal value of each group"""
+    return np.maximum.reduceat(values, starts) if len(values) else values[:0]
+
+def group_ids(values, starts):
+    """Group index of each value"""
+    sizes = np.diff(np.append(starts, len(values)))
+    return np.repeat(np.arange(len(starts)), sizes)
+
+def agg_nunique(values, starts):
+    """Number of distinct non-null values of each group"""
+    ids = group_ids(values, starts)
+    value_codes, uniques = pd.factorize(values)
+    nb_values = max(len(uniques), 1)
+    pairs = pd.unique(ids[value_codes >= 0] * nb_values
+                      + value_codes[value_codes >= 0])
+    return np.bincount(pairs // nb_values, minlength=len(starts))
+
+def agg_approx_nunique(error=cardinality.DEFAULT_ERROR):
+    """Return the aggregation approximating the number of distinct non-null
+    values of each group, with sketches of relative standard error 'error'
+    (see cardinality)
+    """
+    def aggregation(values, starts):
+        return cardinality.group_nunique(group_ids(values, starts), values,
+                                         len(starts), error)
+    return aggregation
+
+def agg_quantile(q):
+    """Return the aggregation computing the q-quantile of the non-null values
+    of each group, with a linear interpolation (as pd.DataFrame.quantile)
+    """
+    def aggregation(values, starts):
+        ids = group_ids(values, starts)
+        valid = pd.notnull(values)
+        values, ids = values[valid], ids[valid]
+        order = np.lexsort((values, ids))
+        values = values[order]
+        sizes = np.bincount(ids, minlength=len(starts))
+        first = np.cumsum(sizes) - sizes
+        position = q * (sizes - 1)
+        frac = position % 1
+        lower = first + np.floor(position).astype(np.int64)
+        upper = np.where(frac == 0, lower, lower + 1)
+        result = np.full(len(starts), np.nan)
+        nonempty = sizes > 0
+        val = values[lower[nonempty]]
+        next_val = values[upper[nonempty]]
+        result[nonempty] = np.where(frac[nonempty] == 0, val,
+                                    val + (next_val - val) * frac[nonempty])
+        return result
+    return aggregation
+
+def subgroup_size(key):
+    """Return the column function giving, for each row, the number of rows of
+    its 'key' group
+    """
+    def column(plan):
+        codes, _, _ = plan.groups(key)
+        return np.bincount(codes)[codes]
+    return column
+
+def subgroup_first(key):
+    """Return the filter function flagging the first row of each 'key' group
+    """
+    def row_filter(plan):
+        codes, order, _ = plan.groups(key)
+        first = np.zeros(len(codes), dtype=bool)
+        first[order[group_starts(codes[order])]] = True
+        return first
+    return row_filter
+
+def add_features(metadata, plan, features):
+    """Add declared features to metadata, aligned on their key; metadata items
+    absent from the plan data get NaN values
+
+    Parameters
+    ----------
+    metadata: pd.DataFrame
+        Metadata table, with the key features as columns
+    plan: GroupPlan
+        groups of the data from which features are aggregated
+    features: list
+        Feature declarations
+
+    """
+    rows = {}
+    for feature in features:
+        key = tuple(feature.key)
+        if key not in rows:
+            rows[key] = plan.rows(metadata, key)
+        values = plan.aggregate(feature)[rows[key]]
+        if (rows[key] == -1).any():
+            values = np.where(rows[key] == -1, np.nan, values)
+        metadata[feature.name] = values
+    return metadata
+
+def init_features(init_feat, error=None):
+    """Declare the timestamp features of the metadata of 'init_feat' items;
+    distinct timestamps are approximately counted if 'error' is given
+    """
+    distinct = agg_nunique if error is None else agg_approx_nunique(error)
+    return [Feature('first_at', init_feat, 'ts', agg_min),
+            Feature('last_at', init_feat, 'ts', agg_max),
+            Feature('n_activity_days', init_feat, 'ts', distinct)]
+
+def per_element(grp_feat):
+    """Return the column and filter of features aggregating the number of
+    modifications per unique element of 'grp_feat' items
+    """
+    key = ['elem', 'id', grp_feat]
+    return {'column': subgroup_size(key), 'filter': subgroup_first(key)}
+
+ELEM_KEY = ['elem', 'id']
+ELEM_FEATURES = [Feature('version', ELEM_KEY, 'version', agg_max),
+                 Feature('n_chgset', ELEM_KEY, 'chgset', agg_nunique),
+                 Feature('n_user', ELEM_KEY, 'uid', agg_nunique),
+                 Feature('n_autocorr', ELEM_KEY, 'willbe_autocorr', agg_sum),
+                 Feature('n_corr', ELEM_KEY, 'willbe_corr', agg_sum)]
+CHGSET_FEATURES = [Feature('t10_update_d', ['chgset'], 'nextmodif_in',
+                           agg_quantile(.1)),
+                   Feature('t90_update_d', ['chgset'], 'nextmodif_in',
+                           agg_quantile(.9)),
+                   Feature('n10_modif_byelem', ['chgset'],
+                           agg=agg_quantile(.1), **per_element('chgset')),
+                   Feature('n90_modif_byelem', ['chgset'],
+                           agg=agg_quantile(.9), **per_element('chgset'))]
+# User features aggregated from change set metadata
+USER_CHGSET_FEATURES = [Feature('n_chgset', ['uid'], 'chgset', agg_count),
+                        Feature('dmean_chgset', ['uid'], 'lifespan',
+                                agg_mean)]
+USER_FEATURES = [Feature('nmean_modif_byelem', ['uid'], agg=agg_mean,
+                         **per_element('uid'))]
+
+def init_metadata(osm_elements, init_feat, timeunit='1d',
+                  extraction_date=None, plan=None, error=None):
     """ This function produces an init metadata table based on 'init_feature'
     in table 'osm_elements'. The intialization consider timestamp measurements
     (generated for each metadata tables, i.e. elements, change sets and users).
@@ -188,108 +638,217 @@ def init_metadata(osm_elements, init_feat, timeunit='1d'):
         metadata duration feature name in string format
     timeunit: object
         time unit in which 'duration_feature' will be expressed
+    extraction_date: datetime
+        date of the history extraction; the last timestamp of osm_elements by
+    default (it must be given if osm_elements is only a part of the history)
+    plan: GroupPlan
+        groups of osm_elements, shared with further metadata features
+    error: float
+        if given, 'n_activity_days' is approximated with sketches of this
+    relative standard error (see cardinality)
 
     """
-    metadata = (osm_elements.groupby(init_feat)['ts']
-                .agg(["min", "max"])
-                .reset_index())
-    metadata.columns = [*init_feat, 'first_at', 'last_at']
+    if plan is None:
+        plan = GroupPlan(osm_elements)
+    _, _, keys = plan.groups(init_feat)
+    metadata = keys.copy()
+    for feature in init_features(init_feat, error):
+        metadata[feature.name] = plan.aggregate(feature)
     metadata['lifespan'] = ((metadata.last_at - metadata.first_at)
                             / pd.Timedelta(timeunit))
-    extraction_date = osm_elements.ts.max()
+    if extraction_date is None:
+        extraction_date = osm_elements.ts.max()
     metadata['n_inscription_days'] = ((extraction_date - metadata.first_at)
                                       / pd.Timedelta('1d'))
-    metadata['n_activity_days'] = (osm_elements
-                                   .groupby(init_feat)['ts']
-                                   .nunique()
-                                   .reset_index())['ts']
-    return metadata.sort_values(by=['first_at'])
+    metadata = metadata[[*init_feat, 'first_at', 'last_at', 'lifespan',
+                         'n_inscription_days', 'n_activity_days']]
+    return metadata.sort_values(by=['first_at', *init_feat])
+
+def lexsorted(keys):
+    """Return True if the rows defined by the key arrays are sorted in
+    lexicographic order
+    """
+    undecided = np.ones(len(keys[0]) - 1, dtype=bool)
+    for key in keys:
+        if np.any(undecided & (key[1:] < key[:-1])):
+            return False
+        undecided &= key[1:] == key[:-1]
+    return True
+
+def group_bounds(*keys):
+    """Return, for each row, the positions of the first and of the last rows
+    of its group, groups being defined by the key arrays and rows being taken
+    in their order
+
+    If the rows are already sorted by keys (e.g. OSM history sorted by elem,
+    id and version), groups are contiguous and no sort is done; otherwise
+    rows are stably sorted by keys first.
+
+    Parameters
+    ----------
+    keys: list
+        key arrays, of the same length
+
+    """
+    nb_rows = len(keys[0])
+    if nb_rows == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if lexsorted(keys):
+        order = np.arange(nb_rows)
+    else:
+        order = np.lexsort((np.arange(nb_rows),) + keys[::-1])
+    new_group = np.zeros(nb_rows, dtype=bool)
+    new_group[0] = True
+    for key in keys:
+        sorted_key = key[order]
+        new_group[1:] |= sorted_key[1:] != sorted_key[:-1]
+    starts = np.flatnonzero(new_group)
+    ends = np.append(starts[1:], nb_rows) - 1
+    group_ids = np.cumsum(new_group) - 1
+    first = np.empty(nb_rows, dtype=np.int64)
+    last = np.empty(nb_rows, dtype=np.int64)
+    first[order] = order[starts][group_ids]
+    last[order] = order[ends][group_ids]
+    return first, last
 
 def enrich_osm_elements(osm_elements):
     """Enrich OSM history data by computing additional features
 
+    Every feature is gathered from the first or last version of each element
+    (or of each element change set), located with group_bounds, hence the
+    history is neither merged nor copied once per feature. Rows are sorted by
+    (elem, id, version) if they are not yet, and get a new range index.
+
     Parameters
     ----------
     osm_elements: pd.DataFrame
         OSM history data
 
     """
-    # Extract information from first and last versions
-    osmelem_first_version = (osm_elements
-                             .groupby(['elem','id'])['version', 'uid']
-                             .first()
-                             .reset_index())
-    osm_elements = pd.merge(osm_elements, osmelem_first_version,
-                                on=['elem','id'])
-    osm_elements.columns = ['elem', 'id', 'version', 'visible', 'ts',
-                                'uid', 'chgset', 'vmin', 'first_uid']
-    osmelem_last_version = (osm_elements
-                             .groupby(['elem','id'])['version', 'uid',
-                                                     'visible']
-                             .last()
-                             .reset_index())
-    osm_elements = pd.merge(osm_elements, osmelem_last_version,
-                                on=['elem','id'])
-    osm_elements.columns = ['elem', 'id', 'version', 'visible', 'ts', 'uid',
-                            'chgset', 'vmin', 'first_uid', 'vmax', 'last_uid',
-                            'available']
-    osmelem_last_bychgset = (osm_elements
-                             .groupby(['elem','id','chgset'])['version',
-                                                              'visible']
-                             .last()
-                             .reset_index())
-    osm_elements = pd.merge(osm_elements,
-                            osmelem_last_bychgset[['elem', 'id',
-                                                   'chgset', 'visible']],
-                            on=['elem','id', 'chgset'])
-    osm_elements.columns = ['elem', 'id', 'version', 'visible', 'ts', 'uid',
-                            'chgset', 'vmin', 'first_uid', 'vmax', 'last_uid',
-                            'available', 'open']
+    elem_codes, _ = pd.factorize(osm_elements.elem, sort=True)
+    ids = osm_elements.id.values
+    versions = osm_elements.version.values
+    if len(osm_elements) > 0 and not lexsorted((elem_codes, ids, versions)):
+        order = np.lexsort((versions, ids, elem_codes))
+        osm_elements = osm_elements.iloc[order]
+        elem_codes, ids, versions = (elem_codes[order], ids[order],
+                                     versions[order])
+    visible = osm_elements.visible.values
+    uids = osm_elements.uid.values
+    chgsets = osm_elements.chgset.values
+    first, last = group_bounds(elem_codes, ids)
+    first_bychgset, last_bychgset = group_bounds(elem_codes, ids, chgsets)
+
+    # Information from first and last versions, and from the last version of
+    # each change set
+    enriched = osm_elements[['elem', 'id', 'version', 'visible', 'ts', 'uid',
+                             'chgset']].reset_index(drop=True)
+    enriched['first_uid'] = uids[first]
+    enriched['vmax'] = versions[last]
+    enriched['last_uid'] = uids[last]
+    enriched['available'] = visible[last]
+    enriched['open'] = visible[last_bychgset]
 
     # New version-related features
-    osm_elements['init'] = osm_elements.version == osm_elements.vmin
-    osm_elements['up_to_date'] = osm_elements.version == osm_elements.vmax
-    osm_elements = osm_elements.drop(['vmin'], axis=1)
-
-    osmelem_first_bychgset = (osm_elements
-                             .groupby(['elem','id','chgset'])['version', 'init']
-                             .first()
-                             .reset_index())
-    osm_elements = pd.merge(osm_elements,
-                            osmelem_first_bychgset[['elem', 'id',
-                                                    'chgset', 'init']],
-                            on=['elem','id','chgset'])
-    osm_elements.columns = ['elem', 'id', 'version', 'visible', 'ts', 'uid',
-                            'chgset', 'first_uid', 'vmax', 'last_uid',
-                            'available', 'open', 'init', 'up_to_date',
-                            'created']
+    init = versions == versions[first]
+    up_to_date = versions == versions[last]
+    enriched['init'] = init
+    enriched['up_to_date'] = up_to_date
+    enriched['created'] = init[first_bychgset]
 
     # Whether or not an element will be corrected in the last version
-    osm_elements['willbe_corr'] = np.logical_and(osm_elements.id.diff(-1)==0,
-                                              osm_elements.uid.diff(-1)!=0)
-    osm_elements['willbe_autocorr'] = np.logical_and(osm_elements.id.diff(-1)==0,
-                                                     osm_elements.uid
-                                                     .diff(-1)==0)
+    next_same_id = np.zeros(len(ids), dtype=bool)
+    next_same_id[:-1] = ids[1:] == ids[:-1]
+    next_same_uid = np.zeros(len(uids), dtype=bool)
+    next_same_uid[:-1] = uids[1:] == uids[:-1]
+    enriched['willbe_corr'] = next_same_id & ~next_same_uid
+    enriched['willbe_autocorr'] = next_same_id & next_same_uid
 
     # Time before the next modification
-    osm_elements['nextmodif_in'] = - osm_elements.ts.diff(-1)
-    osm_elements.loc[osm_elements.up_to_date,['nextmodif_in']] = pd.NaT
-    osm_elements.nextmodif_in = (osm_elements.nextmodif_in
-                                 .astype('timedelta64[D]'))
+    nextmodif_in = - enriched.ts.diff(-1)
+    nextmodif_in[up_to_date] = pd.NaT
+    nextmodif_in = nextmodif_in.astype('timedelta64[D]')
+    enriched['nextmodif_in'] = nextmodif_in
 
     # Time before the next modification, if it is done by another user
-    osm_elements['nextcorr_in'] = osm_elements.nextmodif_in
-    osm_elements['nextcorr_in'] = (osm_elements.nextcorr_in
-                                   .where(osm_elements.willbe_corr,
-                                          other=pd.NaT))
+    enriched['nextcorr_in'] = nextmodif_in.where(enriched.willbe_corr)
 
     # Time before the next modification, if it is done by the same user
-    osm_elements['nextauto_in'] = osm_elements.nextmodif_in
-    osm_elements['nextauto_in'] = (osm_elements.nextauto_in
-                                   .where(osm_elements.willbe_autocorr,
-                                                   other=pd.NaT))
+    enriched['nextauto_in'] = nextmodif_in.where(enriched.willbe_autocorr)
+
+    return enriched
 
-    return osm_elements
+def key_mask(data, keys, key_feats=['elem', 'id']):
+    """Return a boolean mask that indicates which rows of data correspond to
+    one of the given keys
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        Data to filter, must contain key_feats columns
+    keys: pd.DataFrame
+        Keys to look for, must contain key_feats columns
+    key_feats: list of objects
+        Strings designing the key features
+
+    """
+    data_keys = pd.MultiIndex.from_arrays([data[feat] for feat in key_feats])
+    return data_keys.isin(pd.MultiIndex.from_arrays([keys[feat]
+                                                     for feat in key_feats]))
+
+def append_osm_changes(osm_elements, changes):
+    """Append OSM element versions coming from change files to the OSM history;
+    versions that are already known are skipped
+
+    Parameters
+    ----------
+    osm_elements: pd.DataFrame
+        OSM history data, or at least the history of the elements of changes
+    changes: pd.DataFrame
+        OSM element versions parsed from change files, with the same features
+    than osm_elements
+
+    Return
+    ------
+    osm_elements: pd.DataFrame
+        Updated OSM history, sorted by element type, id and version
+    touched: pd.DataFrame
+        (elem, id) keys of the elements that have new versions
+
+    """
+    changes = changes.drop_duplicates(['elem', 'id', 'version'], keep='last')
+    changes = changes.assign(elem=changes.elem.astype(str),
+                             # The history is stored with a daily precision
+                             ts=changes.ts.dt.normalize())
+    new_versions = changes[~key_mask(changes, osm_elements,
+                                     ['elem', 'id', 'version'])]
+    first_index = osm_elements.index.max() + 1 if len(osm_elements) > 0 else 0
+    new_versions.index = np.arange(first_index,
+                                   first_index + len(new_versions))
+    osm_elements = (pd.concat([osm_elements, new_versions])
+                    .sort_values(by=['elem', 'id', 'version']))
+    touched = new_versions[['elem', 'id']].drop_duplicates()
+    return osm_elements, touched
+
+def dirty_metadata(enriched_elements, touched):
+    """List the users and change sets whose metadata must be recomputed, i.e.
+    the ones that contributed to touched elements
+
+    Parameters
+    ----------
+    enriched_elements: pd.DataFrame
+        Enriched OSM history data, or at least the enriched history of the
+    touched elements
+    touched: pd.DataFrame
+        (elem, id) keys of the elements that have new versions
+
+    """
+    contribs = enriched_elements[key_mask(enriched_elements, touched)]
+    return pd.concat([pd.DataFrame({'metadata': 'user',
+                                    'key': contribs.uid.unique()}),
+                      pd.DataFrame({'metadata': 'changeset',
+                                    'key': contribs.chgset.unique()})],
+                     ignore_index=True)[['metadata', 'key']]
 
 def extract_elem_metadata(osm_elements, user_groups, drop_ts=True):
     """ Extract element metadata from OSM history data
@@ -306,26 +865,9 @@ def extract_elem_metadata(osm_elements, user_groups, drop_ts=True):
     and number of unique change sets (resp. users)
 
     """
-    elem_md = init_metadata(osm_elements, ['elem','id'])
-    elem_md['version'] = (osm_elements.groupby(['elem','id'])['version']
-                          .max()
-                          .reset_index())['version']
-    elem_md['n_chgset'] = (osm_elements.groupby(['elem', 'id'])['chgset']
-                           .nunique()
-                           .reset_index())['chgset']
-    elem_md['n_user'] = (osm_elements.groupby(['elem', 'id'])['uid']
-                         .nunique()
-                         .reset_index())['uid']
-    elem_md['n_autocorr'] = (osm_elements
-                             .groupby(['elem','id'])['willbe_autocorr']
-                             .sum()
-                             .reset_index()['willbe_autocorr']
-                             .astype('int'))
-    elem_md['n_corr'] = (osm_elements
-                             .groupby(['elem','id'])['willbe_corr']
-                             .sum()
-                             .reset_index()['willbe_corr']
-                             .astype('int'))
+    plan = GroupPlan(osm_elements)
+    elem_md = init_metadata(osm_elements, ELEM_KEY, plan=plan)
+    elem_md = add_features(elem_md, plan, ELEM_FEATURES)
     elem_md = pd.merge(elem_md, osm_elements[['elem', 'id',
                                               'version', 'visible',
                                               'first_uid', 'last_uid']],
@@ -341,13 +883,20 @@ def extract_elem_metadata(osm_elements, user_groups, drop_ts=True):
     else:
         return elem_md
 
-def extract_chgset_metadata(osm_elements, drop_ts=True):
+def extract_chgset_metadata(osm_elements, drop_ts=True, extraction_date=None,
+                            error=None):
     """ Extract change set metadata from OSM history data
 
     Parameters
     ----------
     osm_elements: pd.DataFrame
         OSM history data
+    extraction_date: datetime
+        date of the history extraction (see init_metadata)
+    error: float
+        if given, distinct counts ('n_activity_days' and unique elements) are
+    approximated with sketches of this relative standard error (see
+    cardinality and metadata_registers)
 
     Return
     ------
@@ -356,38 +905,262 @@ def extract_chgset_metadata(osm_elements, drop_ts=True):
     and other features describing modification and OSM elements themselves
 
     """
-    chgset_md = init_metadata(osm_elements, ['chgset'], '1m')
+    plan = GroupPlan(osm_elements)
+    chgset_md = init_metadata(osm_elements, ['chgset'], '1m', extraction_date,
+                              plan, error)
     # User-related features
     chgset_md = pd.merge(chgset_md,
                          osm_elements[['chgset','uid']].drop_duplicates(),
                          on=['chgset'])
+    add_chgset_user_features(chgset_md)
+    # Update features and number of modifications per unique element
+    chgset_md = add_features(chgset_md, plan, CHGSET_FEATURES).fillna(0)
+    # Element-related features
+    chgset_md = extract_element_features(chgset_md, osm_elements, 'chgset',
+                                         error=error)
+    chset_md = chgset_md.set_index('chgset')
+    if drop_ts:
+        return drop_features(chgset_md, '_at')
+    else:
+        return chgset_md
+
+def add_chgset_user_features(chgset_md):
+    """Add the user-related features of change set metadata (time since the
+    previous change set of the user, rank of the change set amongst the user
+    ones); change sets must be sorted by creation date, as by init_metadata
+
+    Parameters
+    ----------
+    chgset_md: pd.DataFrame
+        change set metadata, with 'uid' and 'first_at' features
+
+    """
     chgset_md['user_lastchgset_h'] = (chgset_md.groupby('uid')['first_at']
                                       .diff())
     chgset_md.user_lastchgset_h = (chgset_md.user_lastchgset_h /
                                    timedelta(hours=1))
     chgset_md['user_chgset_rank'] = chgset_md.groupby('uid')['first_at'].rank()
-    # Update features
-    chgset_md = group_stats(chgset_md, osm_elements, 'chgset', 'nextmodif_in',
-                              't', '_update_d')
-    # Number of modifications per unique element
-    contrib_byelem = (osm_elements.groupby(['elem', 'id', 'chgset'])['version']
-                      .count()
-                      .reset_index())
-    chgset_md = group_stats(chgset_md, contrib_byelem, 'chgset', 'version',
-                              'n', '_modif_byelem')
-    # Element-related features
-    chgset_md = extract_element_features(chgset_md, osm_elements,
-                                       'node', 'chgset')
-    chgset_md = extract_element_features(chgset_md, osm_elements,
-                                       'way', 'chgset')
-    chgset_md = extract_element_features(chgset_md, osm_elements,
-                                       'relation', 'chgset')
-    chset_md = chgset_md.set_index('chgset')
+
+def combine_metadata(parts, grp_feat):
+    """Concatenate metadata extracted from partitions of the OSM history (each
+    partition gathering all the modifications of some 'grp_feat' items), in
+    the order of init_metadata
+
+    Parameters
+    ----------
+    parts: list of pd.DataFrame
+        partial metadata, with timestamp features
+    grp_feat: str
+        metadata item feature ('chgset' or 'uid'), as a column or as the index
+
+    """
+    metadata = pd.concat(parts)
+    keys = metadata[grp_feat] if grp_feat in metadata else metadata.index
+    order = np.lexsort((keys.values, metadata.first_at.values))
+    return metadata.iloc[order]
+
+def combine_chgset_metadata(parts, drop_ts=True, registers=None, error=None):
+    """Combine change set metadata extracted from partitions of the OSM history
+    that group all the modifications of a change set (see
+    extract_chgset_metadata, called with drop_ts=False); user-related features
+    cross the partitions, and are computed again on the whole table
+
+    Parameters
+    ----------
+    parts: list of pd.DataFrame
+        partial change set metadata
+    registers: pd.DataFrame
+        in approximate mode, merged register tables of the parts (see
+    merge_registers), from which distinct counts are estimated again
+    error: float
+        relative standard error of the register tables
+
+    """
+    chgset_md = combine_metadata(parts, 'chgset').reset_index(drop=True)
+    if registers is not None:
+        chgset_md = apply_registers(chgset_md, registers, 'chgset', error)
+    add_chgset_user_features(chgset_md)
+    user_features = ['user_lastchgset_h', 'user_chgset_rank']
+    chgset_md[user_features] = chgset_md[user_features].fillna(0)
     if drop_ts:
         return drop_features(chgset_md, '_at')
     else:
         return chgset_md
 
+def combine_user_metadata(parts, drop_ts=True, registers=None, error=None):
+    """Combine user metadata extracted from partitions of the OSM history that
+    group all the modifications of a user (see extract_user_metadata, called
+    with drop_ts=False)
+
+    Parameters
+    ----------
+    parts: list of pd.DataFrame
+        partial user metadata, indexed by 'uid'
+    registers: pd.DataFrame
+        in approximate mode, merged register tables of the parts (see
+    merge_registers), from which distinct counts are estimated again
+    error: float
+        relative standard error of the register tables
+
+    """
+    user_md = combine_metadata(parts, 'uid')
+    if registers is not None:
+        user_md = apply_registers(user_md, registers, 'uid', error)
+    if drop_ts:
+        return drop_features(user_md, '_at')
+    else:
+        return user_md
+
+def metadata_registers(data, grp_feat, error, element_types=None):
+    """Return the register table of the approximate distinct counts of the
+    metadata of 'grp_feat' items (see cardinality.sketch): 'n_activity_days'
+    and, if element_types are given, the numbers of unique elements of
+    extract_element_features (the 'wrong' ones being counts, not shares)
+
+    Register tables of several partitions of the history are merged with
+    merge_registers, then counted again with apply_registers; the registers of
+    updated items are replaced with refresh_registers.
+
+    Parameters
+    ----------
+    data: pd.DataFrame
+        enriched OSM history data
+    grp_feat: str
+        metadata item feature ('chgset' or 'uid')
+    error: float
+        relative standard error of the sketches
+    element_types: list
+        element types of the unique element counts
+
+    Return
+    ------
+    registers: pd.DataFrame
+        register table, with grp_feat, 'feature', 'register' and 'rank'
+    columns
+
+    """
+    keys = pd.DataFrame({grp_feat: data[grp_feat].values,
+                         'feature': 'n_activity_days'},
+                        columns=[grp_feat, 'feature'])
+    tables = [cardinality.sketch(keys, data.ts.values, error)]
+    if element_types is not None:
+        elems = data.elem.astype(str).values
+        for suffix, flag in element_flags(data):
+            flag = flag & np.in1d(elems, element_types)
+            keys = pd.DataFrame({grp_feat: data[grp_feat].values[flag],
+                                 'feature': 'n_' + pd.Series(elems[flag])
+                                 + suffix},
+                                columns=[grp_feat, 'feature'])
+            tables.append(cardinality.sketch(keys, data.id.values[flag],
+                                             error))
+    return pd.concat(tables, ignore_index=True)
+
+def merge_registers(registers, grp_feat):
+    """Merge the register tables of several partitions of the history (see
+    metadata_registers), whose items are disjoint or whose histories are
+    parts of a same history; None tables are skipped
+    """
+    return cardinality.merge([table for table in registers
+                              if table is not None],
+                             [grp_feat, 'feature'])
+
+def apply_registers(metadata, registers, grp_feat, error,
+                    element_types=None):
+    """Set the approximate distinct counts of metadata from a register table
+    (see metadata_registers), as well as the shares of wrong modifications
+    that derive from them; items without registers get 0 counts
+
+    Parameters
+    ----------
+    metadata: pd.DataFrame
+        metadata, with grp_feat as a column or as the index
+    registers: pd.DataFrame
+        register table of the metadata items
+    grp_feat: str
+        metadata item feature ('chgset' or 'uid')
+    error: float
+        relative standard error of the register table
+    element_types: list
+        element types of the unique element counts (ELEMENT_TYPES by default)
+
+    """
+    if element_types is None:
+        element_types = ELEMENT_TYPES
+    counts = (cardinality.count(registers, [grp_feat, 'feature'], error)
+              .unstack('feature', fill_value=0))
+    keys = metadata[grp_feat] if grp_feat in metadata else metadata.index
+    counts = counts.reindex(keys.values, fill_value=0)
+    metadata = metadata.copy()
+    metadata['n_activity_days'] = counts['n_activity_days'].values
+    for element_type in element_types:
+        for status in ['_cr', '_imp', '_del']:
+            total = 'n_' + element_type + status
+            if total not in metadata:
+                continue
+            values = {feature: (counts[feature].values if feature in counts
+                                else np.zeros(len(counts), dtype=np.int64))
+                      for feature in [total, total + 'wrong']}
+            metadata[total] = values[total]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                metadata[total + 'wrong'] = np.nan_to_num(
+                    values[total + 'wrong']
+                    / values[total].astype(np.float64))
+    return metadata
+
+def refresh_registers(registers, dirty_registers, grp_feat, dirty_keys):
+    """Replace the register rows of dirty items by their recomputed ones (see
+    metadata_registers)
+
+    Registers cannot be merged with the ones of a former state: flags such as
+    the 'wrong' ones depend on the last version of the elements (see
+    element_flags), hence an update may remove elements from the counts of an
+    item, whereas a merge only adds some.
+
+    Parameters
+    ----------
+    registers: pd.DataFrame
+        register table before the update
+    dirty_registers: pd.DataFrame
+        register table of the dirty items, built from their whole history
+    grp_feat: str
+        metadata item feature ('chgset' or 'uid')
+    dirty_keys: np.array
+        dirty items
+
+    """
+    clean = registers[~registers[grp_feat].isin(dirty_keys)]
+    return pd.concat([clean, dirty_registers], ignore_index=True)
+
+def refresh_metadata(metadata, dirty_md, grp_feat, extraction_date):
+    """Replace the dirty items of metadata by their recomputed metadata, and
+    refresh the features of the other items that depend on the extraction
+    date; return the parts to combine (see combine_chgset_metadata and
+    combine_user_metadata)
+
+    The metadata of an item only depend on the history rows of this item, on
+    the extraction date and, for change sets, on the other change sets of the
+    user (features that are recomputed by combine_chgset_metadata).
+
+    Parameters
+    ----------
+    metadata: pd.DataFrame
+        metadata before the update, with timestamp features
+    dirty_md: pd.DataFrame
+        metadata of the dirty items, extracted from their whole history with
+    drop_ts=False
+    grp_feat: str
+        metadata item feature ('chgset' or 'uid'), as a column or as the index
+    extraction_date: datetime
+        date of the updated history extraction
+
+    """
+    keys = metadata[grp_feat] if grp_feat in metadata else metadata.index
+    dirty_keys = dirty_md[grp_feat] if grp_feat in dirty_md else dirty_md.index
+    clean_md = metadata[~keys.isin(dirty_keys)].copy()
+    clean_md['n_inscription_days'] = ((extraction_date - clean_md.first_at)
+                                      / pd.Timedelta('1d'))
+    return [clean_md, dirty_md]
+
 def metadata_version(metadata, osmelem, grp_feat, res_feat, feature_suffix):
     """Compute the version-related features of metadata and append them into
     the metadata table
@@ -416,7 +1189,8 @@ def metadata_version(metadata, osmelem, grp_feat, res_feat, feature_suffix):
                               'v', '_relation'+feature_suffix)
     return metadata
 
-def extract_user_metadata(osm_elements, chgset_md, drop_ts=True):
+def extract_user_metadata(osm_elements, chgset_md, drop_ts=True,
+                          extraction_date=None, error=None):
     """ Extract user metadata from OSM history data
 
     Parameters
@@ -425,6 +1199,11 @@ def extract_user_metadata(osm_elements, chgset_md, drop_ts=True):
         OSM history data
     chgset_md: pd.DataFrame
         OSM change set metadata
+    extraction_date: datetime
+        date of the history extraction (see init_metadata)
+    error: float
+        if given, 'n_activity_days' is approximated with sketches of this
+    relative standard error (see cardinality and metadata_registers)
 
     Return
     ------
@@ -433,26 +1212,17 @@ def extract_user_metadata(osm_elements, chgset_md, drop_ts=True):
     and other features describing modification and OSM elements themselves
 
     """
-    user_md = init_metadata(osm_elements, ['uid'])
+    plan = GroupPlan(osm_elements)
+    user_md = init_metadata(osm_elements, ['uid'],
+                            extraction_date=extraction_date, plan=plan,
+                            error=error)
     # Change set-related features
-    user_md['n_chgset'] = (chgset_md.groupby('uid')['chgset']
-                           .count()
-                           .reset_index())['chgset']
-    user_md['dmean_chgset'] = (chgset_md.groupby('uid')['lifespan']
-                               .mean()
-                               .reset_index())['lifespan']
+    user_md = add_features(user_md, GroupPlan(chgset_md),
+                           USER_CHGSET_FEATURES)
     # Number of modifications per unique element
-    contrib_byelem = (osm_elements.groupby(['elem', 'id', 'uid'])['version']
-                      .count()
-                      .reset_index())
-    user_md['nmean_modif_byelem'] = (contrib_byelem.groupby('uid')['version']
-                                    .mean()
-                                     .reset_index())['version']
+    user_md = add_features(user_md, plan, USER_FEATURES)
     # Modification-related features
-    user_md = extract_generic_modif_features(user_md, osm_elements, 'uid')
-    user_md = extract_modif_features(user_md, osm_elements, 'node', 'uid')
-    user_md = extract_modif_features(user_md, osm_elements, 'way', 'uid')
-    user_md = extract_modif_features(user_md, osm_elements, 'relation', 'uid')
+    user_md = extract_modif_features(user_md, osm_elements, 'uid')
     user_md = user_md.set_index('uid')
     if drop_ts:
         return drop_features(user_md, '_at')
@@ -532,126 +1302,145 @@ def ecdf_transform(metadata, feature):
     original data
 
     """
-    ecdf = sm.distributions.ECDF(metadata[feature])
-    metadata[feature] = ecdf(metadata[feature])
+    values = metadata[[feature]].values.astype(np.float64)
+    normalization.ecdf(values, [0])
+    metadata[feature] = values[:, 0]
     new_feature_name = 'u_' + feature.split('_', 1)[1]
     return metadata.rename(columns={feature: new_feature_name})
 
-def extract_generic_modif_features(metadata, data, grp_feat):
-    """Extract generic features about modifications done by each individuals: number
-    of modifications, number of modifications per element type
-    
+# OSM element types, in the feature order of the metadata tables
+ELEMENT_TYPES = ['node', 'way', 'relation']
+
+def modif_flags(data):
+    """Return the status flags of OSM element modifications, as (feature
+    suffix, boolean array) pairs: every modification, creations,
+    improvements, deletions, up-to-date versions, and versions that will be
+    corrected by another user or by the same user
+
     Parameters
     ----------
-    metadata: pd.DataFrame
-        metadata table
     data: pd.DataFrame
-        original data
-    grp_feat: ojbect
-        string designing the grouping feature: it characterizes the metadata
-    ("chgset", or "user")
-    
+        enriched OSM history data
+
     """
-    newfeature = (data.groupby([grp_feat])['id']
-                  .count()
-                  .reset_index()
-                  .fillna(0))
-    newfeature.columns = [grp_feat, "n_total_modif"]
-    metadata = pd.merge(metadata, newfeature, on=grp_feat, how="outer").fillna(0)
-    newfeature = (data.query('elem=="node"').groupby([grp_feat])['id']
-                  .count()
-                  .reset_index()
-                  .fillna(0))
-    newfeature.columns = [grp_feat, "n_total_modif_node"]
-    metadata = pd.merge(metadata, newfeature, on=grp_feat, how="outer").fillna(0)
-    newfeature = (data.query('elem=="way"').groupby([grp_feat])['id']
-                  .count()
-                  .reset_index()
-                  .fillna(0))
-    newfeature.columns = [grp_feat, "n_total_modif_way"]
-    metadata = pd.merge(metadata, newfeature, on=grp_feat, how="outer").fillna(0)
-    newfeature = (data.query('elem=="relation"').groupby([grp_feat])['id']
-                  .count()
-                  .reset_index()
-                  .fillna(0))
-    newfeature.columns = [grp_feat, "n_total_modif_relation"]
-    metadata = pd.merge(metadata, newfeature, on=grp_feat, how="outer").fillna(0)
+    init = data.init.values
+    visible = data.visible.values
+    return [('', np.ones(len(data), dtype=bool)),
+            ('_cr', init),
+            ('_imp', ~init & visible),
+            ('_del', ~init & ~visible),
+            ('_utd', data.up_to_date.values),
+            ('_cor', data.willbe_corr.values),
+            ('_autocor', data.willbe_autocorr.values)]
+
+def element_flags(data):
+    """Return the status flags of OSM elements within their change set, as
+    (feature suffix, boolean array) pairs: created, improved or deleted
+    elements, and whether these modifications were wrong according to the
+    last element version
 
-    return metadata
+    Parameters
+    ----------
+    data: pd.DataFrame
+        enriched OSM history data
 
-def extract_modif_features(metadata, data, element_type, grp_feat):
-    """Extract a set of metadata features corresponding to a specific element
-    type; centered on modifications
+    """
+    created = data.created.values
+    opened = data.open.values
+    available = data.available.values
+    return [('_cr', created & opened),
+            ('_crwrong', created & opened & ~available),
+            ('_imp', ~created & opened),
+            ('_impwrong', ~created & opened & ~available),
+            ('_del', ~created & ~opened),
+            ('_delwrong', ~created & ~opened & available)]
+
+def feature_cube(data, grp_feat, flags, distinct=None, error=None):
+    """Count, for every (grp_feat item, element type, flag) combination, the
+    modifications of data that hold the flag (or the distinct values of the
+    'distinct' feature amongst them), within a single grouped aggregation
 
     Parameters
     ----------
-    metadata: pd.DataFrame
-        Metadata table
     data: pd.DataFrame
-        Original data
-    element_type: object
-        string designing the element type ("node", "way", or "relation")
+        enriched OSM history data
     grp_feat: object
         string designing the grouping feature; it characterizes the metadata
-    ("chgset", or "user")
-
-    """
-    typed_data = data.query('elem==@element_type')
-    metadata = create_count_features(metadata, element_type, typed_data,
-                               grp_feat, 'id', '')
-    metadata = create_count_features(metadata, element_type,
-                               typed_data.query("init"),
-                               grp_feat, 'id', "_cr")
-    metadata = create_count_features(metadata, element_type,
-                               typed_data.query("not init and visible"),
-                               grp_feat, 'id', "_imp")
-    metadata = create_count_features(metadata, element_type,
-                               typed_data.query("not init and not visible"),
-                               grp_feat, 'id', "_del")
-    metadata = create_count_features(metadata, element_type,
-                               typed_data.query("up_to_date"),
-                               grp_feat, 'id', "_utd")
-    metadata = create_count_features(metadata, element_type,
-                               typed_data.query("willbe_corr"),
-                               grp_feat, 'id', "_cor")
-    metadata = create_count_features(metadata, element_type,
-                               typed_data.query("willbe_autocorr"),
-                               grp_feat, 'id', "_autocor")
-    return metadata
+    ("chgset", or "uid")
+    flags: list
+        (feature suffix, boolean array) pairs, see modif_flags and
+    element_flags
+    distinct: object
+        string designing the feature whose distinct values are counted;
+    modifications are counted if None
+    error: float
+        if given, distinct values are approximately counted, with sketches of
+    this relative standard error (see cardinality)
 
-def create_count_features(metadata, element_type, data, grp_feat, res_feat, feature_suffix):
-    """Create an additional feature to metadata by counting number of
-    occurrences in data, for a specific element_type
+    Return
+    ------
+    cube: pd.DataFrame
+        counts indexed by grp_feat items, with (feature suffix, element type)
+    columns
+
+    """
+    keys = [grp_feat, 'elem']
+    cube = pd.DataFrame({suffix: flag for suffix, flag in flags},
+                        columns=[suffix for suffix, _ in flags])
+    for key in keys:
+        cube[key] = data[key].values
+    if distinct is not None and error is not None:
+        codes, first = cardinality.group_codes([data[key].values
+                                                for key in keys])
+        counts = {suffix: cardinality.group_nunique(
+                      np.where(flag, codes, -1), data[distinct].values,
+                      len(first), error)
+                  for suffix, flag in flags}
+        cube = pd.DataFrame(counts, columns=[suffix for suffix, _ in flags],
+                            index=pd.MultiIndex.from_arrays(
+                                [data[key].values[first] for key in keys],
+                                names=keys))
+        return cube.unstack('elem', fill_value=0)
+    if distinct is not None:
+        cube[distinct] = data[distinct].values
+        cube = cube.groupby(keys + [distinct], sort=False).max()
+    cube = cube.groupby(keys, sort=False).sum().astype(np.int64)
+    return cube.unstack('elem', fill_value=0)
+
+def add_cube_features(metadata, cube, grp_feat, features):
+    """Add features from a feature cube to metadata; as with an outer merge
+    followed by a 'fillna(0)', a feature is an integer one only if every
+    metadata item has a positive count
 
     Parameters
     ----------
     metadata: pd.DataFrame
         Metadata table
-    element_type: object
-        string designing the element type ("node", "way", or "relation")
-    data: pd.DataFrame
-        Original data
+    cube: pd.DataFrame
+        feature cube, see feature_cube
     grp_feat: object
-        string designing the grouping feature; it characterizes the metadata
-    ("chgset", or "user")
-    res_feat: object
-        string that indicates the measured feature (how many items correspond
-    feature_suffix: type
-        description
+        string designing the grouping feature
+    features: list
+        (feature name, cube column) pairs
 
     """
-    feature_name = 'n_'+ element_type + '_modif' + feature_suffix
-    newfeature = (data.groupby([grp_feat])[res_feat]
-                  .count()
-                  .reset_index()
-                  .fillna(0))
-    newfeature.columns = [grp_feat, feature_name]
-    metadata = pd.merge(metadata, newfeature, on=grp_feat, how="outer").fillna(0)
-    return metadata
-
-def extract_element_features(metadata, data, element_type, grp_feat):
-    """Extract a set of metadata features corresponding to a specific element
-    type; centered on unique elements
+    metadata = metadata.reset_index(drop=True)
+    rows = cube.index.get_indexer(metadata[grp_feat].values)
+    for name, column in features:
+        if column in cube:
+            values = cube[column].values[rows]
+            values[rows == -1] = 0
+        else:
+            values = np.zeros(len(metadata), dtype=np.int64)
+        if not values.all():
+            values = values.astype(np.float64)
+        metadata[name] = values
+    return metadata.fillna(0)
+
+def extract_modif_features(metadata, data, grp_feat,
+                           element_types=ELEMENT_TYPES):
+    """Extract a set of metadata features centered on modifications: number
+    of modifications, per element type, and per element type and status
 
     Parameters
     ----------
@@ -659,65 +1448,59 @@ def extract_element_features(metadata, data, element_type, grp_feat):
         Metadata table
     data: pd.DataFrame
         Original data
-    element_type: object
-        string designing the element type ("node", "way", or "relation")
     grp_feat: object
         string designing the grouping feature; it characterizes the metadata
-    ("chgset", or "user")
-
-    """
-    typed_data = data.query('elem==@element_type')
-    metadata = create_unique_features(metadata, element_type,
-                               typed_data.query("created and open"),
-                                      grp_feat, 'id', "_cr")
-    metadata = create_unique_features(metadata, element_type,
-                               typed_data.query("created and open and not available"),
-                               grp_feat, 'id', "_crwrong")
-    normalize_features(metadata, 'n_'+element_type+'_cr')
-    metadata = create_unique_features(metadata, element_type,
-                               typed_data.query("not created and open"),
-                               grp_feat, 'id', "_imp")
-    metadata = create_unique_features(metadata, element_type,
-                               typed_data.query("not created and open and not available"),
-                               grp_feat, 'id', "_impwrong")
-    normalize_features(metadata, 'n_'+element_type+'_imp')
-    metadata = create_unique_features(metadata, element_type,
-                               typed_data.query("not created and not open"),
-                               grp_feat, 'id', "_del")
-    metadata = create_unique_features(metadata, element_type,
-                               typed_data.query("not created and not open and available"),
-                               grp_feat, 'id', "_delwrong")
-    normalize_features(metadata, 'n_'+element_type+'_del')
-    return metadata
+    ("chgset", or "uid")
+    element_types: list
+        element types ("node", "way", or "relation") of typed features
 
-def create_unique_features(metadata, element_type, data, grp_feat, res_feat, feature_suffix):
-    """Create an additional feature to metadata by counting number of unique
-    occurrences in data, for a specific element_type
+    """
+    flags = modif_flags(data)
+    cube = feature_cube(data, grp_feat, flags)
+    total_modif = cube[''].sum(axis=1)
+    cube[('', 'total')] = total_modif
+    features = [("n_total_modif", ('', 'total'))]
+    features += [("n_total_modif_" + element_type, ('', element_type))
+                 for element_type in element_types]
+    features += [('n_' + element_type + '_modif' + suffix,
+                  (suffix, element_type))
+                 for element_type in element_types
+                 for suffix, _ in flags]
+    return add_cube_features(metadata, cube, grp_feat, features)
+
+def extract_element_features(metadata, data, grp_feat,
+                             element_types=ELEMENT_TYPES, error=None):
+    """Extract a set of metadata features centered on unique elements: number
+    of created, improved and deleted elements per element type, and shares of
+    these modifications that were wrong
 
     Parameters
     ----------
     metadata: pd.DataFrame
         Metadata table
-    element_type: object
-        string designing the element type ("node", "way", or "relation")
     data: pd.DataFrame
         Original data
     grp_feat: object
         string designing the grouping feature; it characterizes the metadata
-    ("chgset", or "user")
-    res_feat: object
-        string that indicates the measured feature (how many items correspond
-    feature_suffix: type
-        description
+    ("chgset", or "uid")
+    element_types: list
+        element types ("node", "way", or "relation") of typed features
+    error: float
+        if given, unique elements are approximately counted, with sketches of
+    this relative standard error (see cardinality)
 
     """
-    feature_name = 'n_'+ element_type + feature_suffix
-    newfeature = (data.groupby([grp_feat])[res_feat]
-                  .nunique()
-                  .reset_index()
-                  .fillna(0))
-    newfeature.columns = [grp_feat, feature_name]
-    metadata = pd.merge(metadata, newfeature, on=grp_feat, how="outer").fillna(0)
+    flags = element_flags(data)
+    cube = feature_cube(data, grp_feat, flags, distinct='id', error=error)
+    features = [('n_' + element_type + suffix, (suffix, element_type))
+                for element_type in element_types
+                for suffix, _ in flags]
+    metadata = add_cube_features(metadata, cube, grp_feat, features)
+    for element_type in element_types:
+        for status in ['_cr', '_imp', '_del']:
+            total = 'n_' + element_type + status
+            metadata[total + 'wrong'] = (metadata[total + 'wrong']
+                                         / metadata[total]).fillna(0)
     return metadata
 
 def extract_features(data, pattern, copy=True):
@@ -792,7 +1575,9 @@ def normalize_features(metadata, total_column):
     """
     transformed_columns = metadata.columns[metadata.columns.to_series()
                                            .str.contains(total_column)]
-    metadata[transformed_columns[1:]] = metadata[transformed_columns].apply(lambda x: (x[1:]/x[0]).fillna(0), axis=1)
+    values = metadata[transformed_columns].values.astype(np.float64)
+    normalization.ratio(values, list(range(len(transformed_columns))))
+    metadata[transformed_columns[1:]] = values[:, 1:]
 
 def logtransform_feature(metadata, column):
     """Apply a logarithm transformation to the column within
@@ -806,4 +1591,4 @@ def logtransform_feature(metadata, column):
         string designing the name of the column to transform
 
     """
-    metadata[column] = metadata[column].apply(lambda x: math.log(1+x))
+    metadata[column] = np.log1p(metadata[column].values)
@@ -0,0 +1,64 @@
+# coding: utf-8
+
+"""Regression tests of the approximate distinct counts of the change set
+metadata, when they are updated incrementally
+"""
+
+import os.path as osp
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..', 'src'))
+
+import utils
+
+ERROR = 0.02
+
+def history(versions):
+    """Build an OSM node history from (id, version, visible, date, uid,
+    chgset) tuples
+    """
+    elements = pd.DataFrame(versions, columns=['id', 'version', 'visible',
+                                               'ts', 'uid', 'chgset'])
+    return elements.assign(elem='node', ts=pd.to_datetime(elements.ts))[
+        ['elem', 'id', 'version', 'visible', 'ts', 'uid', 'chgset']]
+
+def approximate_metadata(enriched, registers):
+    """Change set metadata of an enriched history, with the distinct counts of
+    a register table
+    """
+    metadata = utils.extract_chgset_metadata(enriched, drop_ts=False,
+                                             error=ERROR)
+    return utils.combine_chgset_metadata([metadata], drop_ts=False,
+                                         registers=registers,
+                                         error=ERROR).set_index('chgset')
+
+def test_refresh_registers_after_delete_then_restore():
+    # Change set 10 creates nodes 1 and 2, change set 11 deletes node 1
+    before = history([(1, 1, True, '2017-01-01', 1, 10),
+                      (1, 2, False, '2017-01-02', 2, 11),
+                      (2, 1, True, '2017-01-01', 1, 10)])
+    # An update restores node 1 in change set 12
+    after = pd.concat([before, history([(1, 3, True, '2017-01-03', 3, 12)])],
+                      ignore_index=True)
+    before = utils.enrich_osm_elements(before)
+    after = utils.enrich_osm_elements(after)
+    state = utils.metadata_registers(before, 'chgset', ERROR,
+                                     utils.ELEMENT_TYPES)
+    assert approximate_metadata(before, state).loc[10, 'n_node_crwrong'] == .5
+    dirty_keys = after.chgset[after.id == 1].unique()
+    dirty = after[after.chgset.isin(dirty_keys)]
+    registers = utils.refresh_registers(
+        state, utils.metadata_registers(dirty, 'chgset', ERROR,
+                                        utils.ELEMENT_TYPES),
+        'chgset', dirty_keys)
+    expected = utils.extract_chgset_metadata(after, drop_ts=False)
+    updated = approximate_metadata(after, registers)
+    assert updated.loc[10, 'n_node_crwrong'] == 0.
+    features = [feature for feature in expected.columns
+                if feature.startswith('n_node')]
+    np.testing.assert_array_equal(
+        updated.loc[expected.chgset, features].values,
+        expected[features].values)